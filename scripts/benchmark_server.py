@@ -0,0 +1,151 @@
+import re
+import time
+import zlib
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Fraction of the fixture patents without each optional section.
+DEFAULT_MISSING_RATES = {'citations': 0.1, 'classifications': 0.1, 'images': 0.1}
+
+
+
+def fixture_png(width=600, height=800):
+    ''' Returns a valid grayscale PNG of the given size (a gradient, so it does not compress to nothing). '''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b''.join(b'\x00' + bytes((x * y) % 256 for x in range(width)) for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows, 6)) + chunk(b'IEND', b''))
+
+
+
+def fixture_sections(patent_ID, missing_rates):
+    ''' Decides deterministically (from a hash of the patent ID) which optional sections a fixture patent has. '''
+    rng = random.Random(int(hashlib.sha1(patent_ID.encode()).hexdigest(), 16))
+    return {section: rng.random() >= rate for section, rate in missing_rates.items()}, rng
+
+
+
+def fixture_page(patent_ID, base_url, missing_rates=DEFAULT_MISSING_RATES, n_citations=12):
+    '''
+    Returns the HTML of a fixture patent page with the markup of both backends: the rendered DOM addressed by the
+    XPaths of scraping_functions.py, and the microdata parsed by html_scraping.py. Cited patents and CPC codes are
+    derived from the patent ID, so the same pages are served on every run.
+    '''
+    has, rng = fixture_sections(patent_ID, missing_rates)
+    citations = [(f'US{rng.randrange(1000000, 9999999)}B2', rng.random() < 0.6) for _ in range(n_citations)]
+    codes = [f'{rng.choice("ABCDEFGH")}{rng.randrange(10, 99)}{rng.choice("ABCDEFGH")}{rng.randrange(1, 99)}/{rng.randrange(0, 99):02d}' for _ in range(6)]
+    img_url = f'{base_url}/images/{patent_ID}.png'
+    title = f'Fixture patent {patent_ID}'
+    abstract = f'Abstract of the fixture patent {patent_ID}. ' * 8
+    claim = f'1. A device according to the fixture patent {patent_ID}, comprising a part. ' * 4
+
+    citation_rows = ''.join(f'<div>{PN} {"* " if examiner else ""}2001-01-01 Cited patent</div>' for PN, examiner in citations)
+    CPC_rows = ''.join(f'<div>{code} Classification description</div>' for code in codes)
+    rendered = f'''
+<search-app><search-result><search-ui><div><div><div><div><div><result-container><patent-result>
+<div>
+  <div>
+    <div><h1>{title}</h1>
+      <div><div>
+        <section><patent-text><div><section><abstract><div>{abstract}</div></abstract></section></div></patent-text></section>
+        <section>{f'<image-carousel><div><img src="{img_url}"></div></image-carousel>' if has['images'] else ''}</section>
+        <section>{f'<classification-viewer><div><div><div>Classifications</div></div></div></classification-viewer>{CPC_rows}' if has['classifications'] else ''}</section>
+      </div></div>
+      <div><div></div><div><section><patent-text><div><section><div><div><div>{claim}</div></div></div></section></div></patent-text></section></div></div>
+      <div>{f'<h3>Patent Citations ({len(citations)})</h3><div>{citation_rows}</div>' if has['citations'] else '<h3>Cited By</h3>'}</div>
+    </div>
+  </div>
+  <div><div></div><div>{f'<image-viewer><div><div></div><div><div><img src="{img_url}"></div></div></div></image-viewer>' if has['images'] else ''}</div></div>
+</div>
+</patent-result></result-container></div></div></div></div></div></search-ui></search-result></search-app>'''
+
+    citation_microdata = ''.join(
+        f'<tr itemprop="backwardReferencesOrig"><td><span itemprop="publicationNumber">{PN}</span>'
+        f'{"<span itemprop=examinerCited>*</span>" if examiner else ""}</td></tr>' for PN, examiner in citations)
+    CPC_microdata = ''.join(f'<li itemprop="classifications"><span itemprop="Code">{code}</span><meta itemprop="IsCPC" content="true"></li>' for code in codes)
+    microdata = f'''
+<article>
+  <span itemprop="title">{title}</span>
+  <dd itemprop="publicationNumber">{patent_ID}</dd>
+  <section itemprop="abstract"><div class="abstract">{abstract}</div></section>
+  <section itemprop="claims"><div class="claim">{claim}</div></section>
+  {f'<ul><li itemprop="images"><meta itemprop="full" content="{img_url}"></li></ul>' if has['images'] else ''}
+  {f'<ul>{CPC_microdata}</ul>' if has['classifications'] else ''}
+  {f'<table>{citation_microdata}</table>' if has['citations'] else ''}
+</article>'''
+
+    return f'<!DOCTYPE html><html><head><meta name="DC.title" content="{title}"><title>{title}</title></head><body>{rendered}{microdata}</body></html>'
+
+
+
+class PatentRequestHandler(BaseHTTPRequestHandler):
+    ''' Serves /patent/<ID>/en (fixture pages) and /images/<ID>.png (fixture PNG) with the latency and errors of the server. '''
+
+    def do_GET(self):
+        config = self.server.config
+        time.sleep(max(0, random.gauss(config['latency'], config['jitter'])))
+        if random.random() < config['throttle_rate']:
+            return self._send(429, b'Too Many Requests', 'text/plain')
+        if random.random() < config['error_rate']:
+            return self._send(500, b'Internal Server Error', 'text/plain')
+
+        page = re.match(r'^/patent/([^/?]+)', self.path)
+        image = re.match(r'^/images/([^/?]+)\.png', self.path)
+        if page:
+            base_url = f'http://{self.headers.get("Host")}'
+            self._send(200, fixture_page(page.group(1), base_url, config['missing_rates']).encode(), 'text/html; charset=utf-8')
+        elif image:
+            self._send(200, config['png'], 'image/png')
+        else:
+            self._send(404, b'Not Found', 'text/plain')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # One line per request would flood the benchmark output
+
+
+
+def start_server(port=0, latency=0.2, jitter=0.05, error_rate=0.0, throttle_rate=0.0, missing_rates=DEFAULT_MISSING_RATES):
+    '''
+    Starts the stand-in patent server in a background thread and returns it; its base URL is
+    f'http://127.0.0.1:{server.server_address[1]}'. Every response is delayed by a normally distributed latency
+    (seconds) and a fraction of them fail with HTTP 500 (error_rate) or 429 (throttle_rate).
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), PatentRequestHandler)
+    server.daemon_threads = True
+    server.config = {'latency': latency, 'jitter': jitter, 'error_rate': error_rate, 'throttle_rate': throttle_rate,
+                     'missing_rates': missing_rates, 'png': fixture_png()}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve fixture patent pages and images locally, to benchmark the scrapers without Google (--base_url).')
+
+    parser.add_argument('--port', type=int, default=8765, help='Port of the server.')
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean latency of every response in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Standard deviation of the latency in seconds.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of the requests answered with HTTP 500.')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='Fraction of the requests answered with HTTP 429.')
+
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency, args.jitter, args.error_rate, args.throttle_rate)
+    print(f'Serving fixture patents on http://127.0.0.1:{args.port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
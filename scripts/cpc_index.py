@@ -0,0 +1,368 @@
+import os
+import re
+import json
+import shutil
+import argparse
+from itertools import chain
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dataset_io import MANIFEST_DIR, iter_records, read_manifest, read_location, get_record_ID
+
+
+# CPC code as extracted by get_CPC_classes_from_HTML_node(): section, class, subclass, main group / subgroup (e.g. F16H1/28).
+CPC_CODE_PATTERN = re.compile(r'^([A-Z])(\d{2})([A-Z])(\d*)/(\d*)$')
+# Number of segments (the base one and the incremental ones) above which an update merges them into one.
+MAX_SEGMENTS = 8
+STATE_FILE = 'state.json'
+RECORD_ARRAYS = ('record_IDs', 'patent_IDs', 'query_IDs', 'classes')
+
+
+
+def CPC_levels(code):
+    '''
+    Returns the keys under which a CPC code is indexed: each ancestor level and the code itself.
+    Example: "F16H1/28" -> ["F", "F16", "F16H", "F16H1/", "F16H1/28"] (section, class, subclass, main group, subgroup).
+    A code that does not parse is indexed as is.
+    '''
+    match = CPC_CODE_PATTERN.match(code)
+    if not match:
+        return [code]
+    section, CPC_class, subclass, group, _ = match.groups()
+    levels = [section, f'{section}{CPC_class}', f'{section}{CPC_class}{subclass}']
+    if group:
+        levels.append(f'{levels[-1]}{group}/')
+    if levels[-1] != code:
+        levels.append(code)
+    return levels
+
+
+
+def parent_key(key):
+    ''' Returns the key of the level above a key of CPC_levels() (None for a section): "F16H1/28" -> "F16H1/" -> "F16H" -> "F16" -> "F". '''
+    if key.endswith('/'):
+        return key[:4]
+    if '/' in key:
+        return key[:key.index('/') + 1]
+    return {4: key[:3], 3: key[:1]}.get(len(key))
+
+
+
+def record_entry(record):
+    '''
+    Returns the index entry of a record: (record_ID, patent_ID, query_ID, CPC class of the dataset, CPC codes).
+    The record ID is the one of the sinks; a query record is its own query.
+    '''
+    query_ID = record.get('query_ID') or f"{record['cls']}_{record['patent_ID']}"
+    return get_record_ID(record), record['patent_ID'], query_ID, record['cls'], sorted(set(record.get('CPC_class') or []))
+
+
+
+def event_record_ID(event):
+    ''' Returns the record ID of the record a manifest event refers to, as record_entry() computes it. '''
+    query_ID = event.get('query_ID') or f"{event['cls']}_{event['patent_ID']}"
+    return f"{query_ID}_{event['patent_ID']}" if event.get('type') == 'document' else query_ID
+
+
+
+def _class_entries(root, CPC_class):
+    ''' Reads the index entries of the records of one CPC class. Runs in a worker process, one class per task. '''
+    return [record_entry(record) for record in iter_records(root, CPC_class)]
+
+
+
+def _bytes_array(strings):
+    ''' Fixed-width bytes array of strings: sorted arrays of it can be binary searched when memory-mapped. '''
+    return np.array([string.encode() for string in strings], dtype=bytes) if strings else np.array([], dtype='S1')
+
+
+
+def write_segment(segment_dir, entries, removed=()):
+    '''
+    Writes an index segment of records as .npy arrays that are memory-mapped when the index is opened:
+    - keys (sorted), offsets and postings: the inverted index from every code and ancestor level to record numbers;
+    - record_IDs, patent_IDs, query_IDs and classes: the records, by record number;
+    - code_offsets and codes: the forward index from each record to the keys of its own codes (used to merge segments);
+    - removed.json: the record IDs removed from the dataset since the previous segments.
+    '''
+    os.makedirs(segment_dir, exist_ok=True)
+    postings = {}
+    for number, entry in enumerate(entries):
+        for key in set(chain.from_iterable(CPC_levels(code) for code in entry[4])):
+            postings.setdefault(key, []).append(number)
+    keys = sorted(postings)
+    key_numbers = {key: i for i, key in enumerate(keys)}
+
+    arrays = {
+        'keys': _bytes_array(keys),
+        'offsets': np.concatenate([[0], np.cumsum([len(postings[key]) for key in keys], dtype=np.int64)]).astype(np.int64),
+        'postings': np.fromiter(chain.from_iterable(postings[key] for key in keys), dtype=np.int32),
+        'code_offsets': np.concatenate([[0], np.cumsum([len(entry[4]) for entry in entries], dtype=np.int64)]).astype(np.int64),
+        'codes': np.fromiter((key_numbers[code] for entry in entries for code in entry[4]), dtype=np.int32),
+    }
+    for i, name in enumerate(RECORD_ARRAYS):
+        arrays[name] = _bytes_array([entry[i] for entry in entries])
+    for name, array in arrays.items():
+        np.save(os.path.join(segment_dir, f'{name}.npy'), array)
+    with open(os.path.join(segment_dir, 'removed.json'), 'w') as f:
+        json.dump(sorted(removed), f)
+
+
+
+class Segment:
+    ''' An index segment written by write_segment(), memory-mapped. '''
+    def __init__(self, segment_dir):
+        for name in ('keys', 'offsets', 'postings', 'code_offsets', 'codes') + RECORD_ARRAYS:
+            setattr(self, name, np.load(os.path.join(segment_dir, f'{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(segment_dir, 'removed.json'), 'r') as f:
+            self.removed = set(json.load(f))
+
+    def lookup(self, key):
+        ''' Returns the record numbers indexed under a key (binary search in the sorted keys). '''
+        key = key.encode()
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.postings[self.offsets[i]:self.offsets[i + 1]]
+        return self.postings[:0]
+
+    def key_range(self, prefix):
+        ''' Returns the positions [start, end) of the keys starting with prefix. '''
+        prefix = prefix.encode()
+        return np.searchsorted(self.keys, prefix), np.searchsorted(self.keys, prefix + b'\xff')
+
+    def prefix(self, prefix):
+        ''' Returns the record numbers indexed under any key starting with prefix (the postings of a key range are contiguous). '''
+        start, end = self.key_range(prefix)
+        return np.unique(self.postings[self.offsets[start]:self.offsets[end]])
+
+    def entries(self, numbers):
+        ''' Returns the index entries of record_entry() of the given record numbers. '''
+        return [(*(getattr(self, name)[number].decode() for name in RECORD_ARRAYS),
+                 [self.keys[code].decode() for code in self.codes[self.code_offsets[number]:self.code_offsets[number + 1]]])
+                for number in numbers]
+
+
+
+class CPCIndex:
+    '''
+    Inverted index of the CPC codes of a dataset, from every code and each of its ancestor levels
+    (section, class, subclass, main group) to the records having it, stored in index_dir as memory-mapped segments.
+    build_CPC_index() writes a base segment from a full scan; update_CPC_index() adds a small segment with the records
+    written since (read from the manifest of the sinks), where a record superseded or removed later is no longer returned.
+
+    Queries return record IDs and take a key, a glob (e.g. "F16H1/*" for every subgroup of a main group) or a prefix:
+    lookup('F16H'), lookup('F16H1/*'), prefix('F16H1'), count(), children(), shared_with_query().
+    The query and document datasets are indexed separately: shared_with_query() takes the index of the query dataset.
+    '''
+    def __init__(self, index_dir):
+        self.state = _read_state(index_dir)
+        self.segments = [Segment(os.path.join(index_dir, name)) for name in self.state['segments']]
+        # A record number of a segment is dead if its record is written again or removed in a later segment
+        self.superseded = [set() for _ in self.segments]
+        later = set()
+        for i in reversed(range(1, len(self.segments))):
+            later |= self.segments[i].removed | {record_ID.decode() for record_ID in self.segments[i].record_IDs}
+            self.superseded[i - 1] = set(later)
+
+    def _records(self, key):
+        ''' Returns {record_ID: (segment, record number)} of the live records indexed under a key (or a prefix ending with *). '''
+        records = {}
+        for segment, superseded in zip(self.segments, self.superseded):
+            for number in segment.prefix(key[:-1]) if key.endswith('*') else segment.lookup(key):
+                record_ID = segment.record_IDs[number].decode()
+                if record_ID not in superseded:
+                    records[record_ID] = (segment, number)
+        return records
+
+    def lookup(self, key):
+        ''' Returns the IDs of the records indexed under a key; a key ending with * is a prefix query. '''
+        return sorted(self._records(key))
+
+    def prefix(self, prefix):
+        ''' Returns the IDs of the records with a code or level starting with prefix (e.g. "F16H1/2" or "F16H1"). '''
+        return self.lookup(f'{prefix}*')
+
+    def count(self, key):
+        ''' Returns the number of records indexed under a key. '''
+        if len(self.segments) == 1:
+            # Nothing superseded: the size of the postings, without decoding the record IDs
+            segment = self.segments[0]
+            return len(segment.prefix(key[:-1]) if key.endswith('*') else segment.lookup(key))
+        return len(self._records(key))
+
+    def patent_IDs(self, key):
+        ''' Returns the distinct patent IDs of the records indexed under a key. '''
+        return sorted({segment.patent_IDs[number].decode() for segment, number in self._records(key).values()})
+
+    def children(self, key):
+        ''' Returns {child key: number of records} for the keys one level below key (e.g. the subclasses of "F16"). '''
+        child_keys = set()
+        for segment in self.segments:
+            start, end = segment.key_range(key)
+            child_keys.update(child.decode() for child in segment.keys[start:end] if parent_key(child.decode()) == key)
+        return {child: self.count(child) for child in sorted(child_keys)}
+
+    def has_queries(self):
+        ''' Returns whether query records (their own query) are indexed, i.e. whether the query dataset is indexed. '''
+        return any(np.any(segment.record_IDs == segment.query_IDs) for segment in self.segments)
+
+    def shared_with_query(self, key, query_index=None):
+        '''
+        Returns the IDs of the document records indexed under a key whose query record is indexed under it too,
+        in query_index (the index of the query dataset, this index if None). Raises ValueError if it has no query records.
+        '''
+        query_index = self if query_index is None else query_index
+        if not query_index.has_queries():
+            raise ValueError('The query dataset is not indexed: build the index of the query dataset first.')
+        query_IDs = {record_ID for record_ID, (segment, number) in query_index._records(key).items()
+                     if segment.query_IDs[number].decode() == record_ID}
+        return sorted(record_ID for record_ID, (segment, number) in self._records(key).items()
+                      if segment.query_IDs[number].decode() != record_ID and segment.query_IDs[number].decode() in query_IDs)
+
+    def class_code_counts(self, record_type=None):
+        '''
+        Returns {CPC class of the dataset: Counter of CPC codes} over the live records ('query' or 'document' ones only
+        when record_type is given), from the forward index: the counts of dataset_analytics.count_CPC_codes(), each code
+        once per record, without reading the records.
+        '''
+        counts = {}
+        for record_ID, _, query_ID, CPC_class, codes in self.live_entries():
+            if record_type is None or (record_type == 'query') == (record_ID == query_ID):
+                counts.setdefault(CPC_class, Counter()).update(codes)
+        return counts
+
+    def live_entries(self):
+        ''' Yields the index entries of every live record, without reading the dataset. '''
+        for segment, superseded in zip(self.segments, self.superseded):
+            yield from segment.entries([number for number, record_ID in enumerate(segment.record_IDs) if record_ID.decode() not in superseded])
+
+
+
+def _read_state(index_dir):
+    ''' Returns the state of an index (its segments and the manifest offsets it covers), or None if it was never built. '''
+    try:
+        with open(os.path.join(index_dir, STATE_FILE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+
+def _write_state(index_dir, state):
+    tmp_path = os.path.join(index_dir, f'{STATE_FILE}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(index_dir, STATE_FILE))
+
+
+
+def build_CPC_index(root, index_dir, workers=None):
+    '''
+    Builds the index of a dataset from a full scan of its records (one process per CPC class) as a single segment.
+    The manifest offsets read before the scan are saved, so that update_CPC_index() only reads the records written after.
+    '''
+    _, offsets = read_manifest(root)
+    classes = sorted(CPC for CPC in os.listdir(root) if CPC != MANIFEST_DIR and os.path.isdir(os.path.join(root, CPC)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        entries = list(chain.from_iterable(executor.map(_class_entries, [root] * len(classes), classes)))
+
+    os.makedirs(index_dir, exist_ok=True)
+    state = _read_state(index_dir) or {'next_segment': 0}
+    name = f"segment-{state['next_segment']:05d}"
+    write_segment(os.path.join(index_dir, name), entries)
+    # The new state is written last: until then the index still opens on the previous segments
+    old_segments = state.get('segments', [])
+    _write_state(index_dir, {'segments': [name], 'offsets': offsets, 'next_segment': state['next_segment'] + 1})
+    for old in old_segments:
+        shutil.rmtree(os.path.join(index_dir, old), ignore_errors=True)
+    print(f'Indexed {len(entries)} records in {name}.')
+
+
+
+def update_CPC_index(root, index_dir, max_segments=MAX_SEGMENTS):
+    '''
+    Adds to the index the records added or removed since the last build or update, as listed by the manifest
+    of the sinks (only the locations they name are read). Merges the segments once there are more than max_segments.
+    Datasets without a manifest (or without an index yet) are indexed with a full build.
+    '''
+    state = _read_state(index_dir)
+    if state is None or not os.path.isdir(os.path.join(root, MANIFEST_DIR)):
+        return build_CPC_index(root, index_dir)
+    events, offsets = read_manifest(root, state['offsets'])
+    if not events:
+        print('CPC index up to date.')
+        return
+
+    # Last event of each record, and the records added at each location
+    last_event = {}
+    for event in sorted(events, key=lambda event: event['time']):
+        last_event[event_record_ID(event)] = event
+    added = {}
+    for record_ID, event in last_event.items():
+        if event['op'] == 'add':
+            added.setdefault(event['location'], set()).add(record_ID)
+    entries = {}
+    for location, record_IDs in added.items():
+        for record in read_location(location):
+            entry = record_entry(record)
+            if entry[0] in record_IDs:
+                entries[entry[0]] = entry
+    removed = [record_ID for record_ID, event in last_event.items() if event['op'] == 'remove']
+
+    name = f"segment-{state['next_segment']:05d}"
+    write_segment(os.path.join(index_dir, name), list(entries.values()), removed)
+    segments = state['segments'] + [name]
+    _write_state(index_dir, dict(state, segments=segments, offsets=offsets, next_segment=state['next_segment'] + 1))
+    print(f'Indexed {len(entries)} new records and {len(removed)} removals in {name}.')
+    if len(segments) > max_segments:
+        merge_segments(index_dir)
+
+
+
+def merge_segments(index_dir):
+    ''' Merges the segments of the index into one, from the live records of their forward indexes. '''
+    index = CPCIndex(index_dir)
+    entries = list(index.live_entries())
+    name = f"segment-{index.state['next_segment']:05d}"
+    write_segment(os.path.join(index_dir, name), entries)
+    _write_state(index_dir, dict(index.state, segments=[name], next_segment=index.state['next_segment'] + 1))
+    for old in index.state['segments']:
+        shutil.rmtree(os.path.join(index_dir, old), ignore_errors=True)
+    print(f'Merged {len(index.state["segments"])} segments into {name} ({len(entries)} records).')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Build or update the CPC code inverted index of a scraped dataset and query it.')
+
+    parser.add_argument('--json_dir_input', type=str, default='/vast/marco/Data_Google_Patent/json/document',
+                        help='Root directory of the dataset written by the scrapers.')
+    parser.add_argument('--index_dir', type=str, default='/vast/marco/Data_Google_Patent/cpc_index/document',
+                        help='Directory of the index segments.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the index from a full scan of the dataset instead of adding the records written since the last update.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes reading CPC classes in parallel for a full build.')
+    parser.add_argument('--query_index_dir', type=str, default='/vast/marco/Data_Google_Patent/cpc_index/query',
+                        help='Directory of the index of the query dataset, needed to count the documents sharing a key with their query.')
+    parser.add_argument('--query', type=str, nargs='*', default=[],
+                        help='Keys to look up after the update, e.g. F16H F16H1/* F16H1/28: prints the number of records and of shared-with-query documents.')
+
+    args = parser.parse_args()
+
+    if args.rebuild:
+        build_CPC_index(args.json_dir_input, args.index_dir, args.workers)
+    else:
+        update_CPC_index(args.json_dir_input, args.index_dir)
+
+    index = CPCIndex(args.index_dir)
+    query_index = None
+    if args.query and index.has_queries():
+        query_index = index
+    elif args.query and _read_state(args.query_index_dir) is not None:
+        query_index = CPCIndex(args.query_index_dir)
+    elif args.query:
+        print(f'No index of the query dataset in {args.query_index_dir}: documents sharing a key with their query are not counted.')
+    for key in args.query:
+        shared = f', {len(index.shared_with_query(key, query_index))} documents sharing it with their query' if query_index else ''
+        print(f'{key}: {index.count(key)} records, {len(index.patent_IDs(key))} patents{shared}')
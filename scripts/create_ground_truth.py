@@ -1,45 +1,90 @@
 import os
 import argparse
 import json
+from dataset_io import read_manifest, bootstrap_manifest
+
+# Checkpoint (inside the output directory) with the manifest offsets already folded into the ground truth.
+CHECKPOINT_FILE = '.ground_truth_checkpoint.json'
+
+
+def load_json(path, default):
+    """ Loads a JSON file, or returns default if it does not exist. """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_json_atomic(path, data, indent=4):
+    """ Writes a JSON file through a temporary file renamed over the destination, so readers never see a partial file. """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+def apply_manifest_events(events, output_dir, ground_truth=None):
+    """
+    Folds document events of the scrapers' manifest into the ground truth of the affected CPC classes.
+    Each 'add' event links the document to its query and each 'remove' event unlinks it; both are idempotent,
+    so events can safely be applied again after a crash. The query ID comes from the record, not from the filename.
+    If ground_truth is None, the current ground truth files of the affected classes are loaded from output_dir.
+    Returns the ground truth of the affected CPC classes {CPC_class: {query_ID: [doc_ID, ...]}}.
+    """
+    ground_truth = {} if ground_truth is None else ground_truth
+    for event in sorted(events, key=lambda event: event['time']):
+        if event.get('type') != 'document':
+            continue
+        CPC_class, query_ID = event['cls'], event['query_ID']
+        doc_ID = f"{query_ID}_{event['patent_ID']}"
+        if CPC_class not in ground_truth:
+            ground_truth[CPC_class] = load_json(os.path.join(output_dir, f"{CPC_class}.json"), {})
+        query_doc_truth = ground_truth[CPC_class]
+
+        if event['op'] == 'add' and doc_ID not in query_doc_truth.get(query_ID, []):
+            query_doc_truth.setdefault(query_ID, []).append(doc_ID)
+        elif event['op'] == 'remove' and doc_ID in query_doc_truth.get(query_ID, []):
+            query_doc_truth[query_ID].remove(doc_ID)
+            if not query_doc_truth[query_ID]:
+                del query_doc_truth[query_ID]
+    return ground_truth
 
 
 if __name__ == "__main__":
 
-    parser = argparse.ArgumentParser(description='Parsing filenames of document patents get succesfully scraped patents for each query and save JSON for each CPC class.') 
+    parser = argparse.ArgumentParser(description='Collect the successfully scraped document patents of each query from the manifest of the document records and save JSON for each CPC class.')
 
     parser.add_argument('--json_dir_input', type=str, default='/vast/marco/Data_Google_Patent/json/document/',
                         help='Directory to read JSON files for document patents.')
     parser.add_argument('--output_dir', type=str, default='/vast/marco/Data_Google_Patent/ground_truth',
                         help='Directory to save JSON files witth gorund truth.')
-    
+    parser.add_argument('--incremental', action='store_true',
+                        help="Fold only the manifest events written since the last run into the ground truth, rewriting only the affected CPC files.")
+
     args = parser.parse_args()  # Parse command-line arguments.
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(args.output_dir, CHECKPOINT_FILE)
 
-    # Iterate through each CPC directory within the input JSON directory
-    for CPC_class in os.listdir(args.json_dir_input):
-        CPC_class_path = os.path.join(args.json_dir_input, CPC_class)
-        
-        # Initialize and empty dictionary to store the ground truth
-        query_doc_truth = {}
-
-        # Iterate over the doument patents in a CPC class
-        for doc in os.listdir(CPC_class_path):
-            doc_id = doc.replace('.json', '')
-            query_id = f"{doc_id.split('_')[0]}_{doc_id.split('_')[1]}"
-            # Check if the query ID is already a key in the dictionary
-            if query_id in query_doc_truth:
-                query_doc_truth[query_id].append(doc_id)
-            else:
-                query_doc_truth[query_id] = [doc_id]
-
-        # Define the output path for this CPC class's JSON file
-        output_file = os.path.join(args.output_dir, f"{CPC_class}.json")
-        
-        # Write the query_doc_truth to a JSON file for this CPC class
-        with open(output_file, 'w') as f:
-            json.dump(query_doc_truth, f, indent=4)
+    # The documents written before the dataset had a manifest (every document, for a dataset written without one) are
+    # listed in it once, so the query of each document always comes from its record, never from its filename
+    bootstrap_manifest(args.json_dir_input)
+    if args.incremental:
+        # Read only the manifest events written since the last checkpoint
+        checkpoint = load_json(checkpoint_path, {})
+        events, offsets = read_manifest(args.json_dir_input, checkpoint.get('offsets'))
+        ground_truth = apply_manifest_events(events, args.output_dir)
+        print(f'Folded {len(events)} new manifest events.')
+    else:
+        # Rebuild the ground truth of every CPC class from the whole manifest
+        events, offsets = read_manifest(args.json_dir_input)
+        ground_truth = apply_manifest_events(events, args.output_dir, ground_truth={})
 
+    for CPC_class, query_doc_truth in ground_truth.items():
+        # Define the output path for this CPC class's JSON file and write the query_doc_truth to it
+        output_file = os.path.join(args.output_dir, f"{CPC_class}.json")
+        write_json_atomic(output_file, query_doc_truth)
         print(f"Saved {CPC_class}.json")
 
-
-
-            
\ No newline at end of file
+    # The checkpoint is saved after the ground truth files, so a crash in between only re-applies (idempotent) events
+    write_json_atomic(checkpoint_path, {'offsets': offsets})
@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from dataset_io import MANIFEST_DIR, iter_records
+from cpc_index import CPCIndex, update_CPC_index
+
+# Version of the counts in the cached matrices, changed with the way codes are counted so older cache entries are not reused.
+COUNTS_VERSION = 2
+
+
+def dataset_version(root):
+    '''
+    Returns a short hash identifying the current content of a dataset. When the sinks kept a manifest, its file sizes
+    change with every record written; otherwise the names and sizes of the record files are hashed.
+    '''
+    digest = hashlib.sha1()
+    manifest_dir = os.path.join(root, MANIFEST_DIR)
+    if os.path.isdir(manifest_dir):
+        dirs = [manifest_dir]
+    else:
+        dirs = [os.path.join(root, CPC) for CPC in sorted(os.listdir(root)) if os.path.isdir(os.path.join(root, CPC))]
+    for directory in dirs:
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            digest.update(f'{os.path.basename(directory)}/{entry.name}:{entry.stat().st_size}\n'.encode())
+    return digest.hexdigest()[:16]
+
+
+def count_CPC_codes(root, CPC_class, record_type='document'):
+    '''
+    Counts the CPC codes of the records of one CPC class, each code once per record (a page may list a code twice),
+    as the CPC index does. Runs in a worker process, one class per task.
+    '''
+    counts = Counter()
+    for record in iter_records(root, CPC_class, record_type):
+        counts.update(set(record.get('CPC_class') or []))
+    return CPC_class, counts
+
+
+def build_incidence_matrix(root, record_type='document', workers=None):
+    '''
+    Loads the records of every CPC class in parallel (one process per class) and builds the sparse
+    class x CPC code matrix whose entries count how many records of a class have a code.
+    Returns (matrix, classes, codes), where classes and codes label the rows and the columns.
+    '''
+    classes = sorted(CPC for CPC in os.listdir(root) if CPC != MANIFEST_DIR and os.path.isdir(os.path.join(root, CPC)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        class_counts = dict(executor.map(count_CPC_codes, [root] * len(classes), classes, [record_type] * len(classes)))
+    return incidence_matrix(class_counts)
+
+
+def incidence_matrix(class_counts):
+    ''' Builds the sparse class x CPC code count matrix from {CPC class: Counter of codes}. Returns (matrix, classes, codes). '''
+    classes = sorted(class_counts)
+    codes = sorted(set().union(*class_counts.values()))
+    code_index = {code: i for i, code in enumerate(codes)}
+    rows, cols, data = [], [], []
+    for row, CPC_class in enumerate(classes):
+        for code, count in class_counts[CPC_class].items():
+            rows.append(row)
+            cols.append(code_index[code])
+            data.append(count)
+    matrix = sp.csr_matrix((data, (rows, cols)), shape=(len(classes), len(codes)), dtype=np.int64)
+    return matrix, classes, codes
+
+
+def load_incidence_matrix(root, cache_dir, record_type='document', workers=None):
+    '''
+    Returns the incidence matrix of build_incidence_matrix(), cached in cache_dir under the dataset version:
+    the records are only read again once the dataset changes.
+    '''
+    version = dataset_version(root)
+    cache_path = os.path.join(cache_dir, f'{record_type}-v{COUNTS_VERSION}-{version}')
+    if os.path.exists(f'{cache_path}.json'):
+        with open(f'{cache_path}.json', 'r') as f:
+            labels = json.load(f)
+        return sp.load_npz(f'{cache_path}.npz'), labels['classes'], labels['codes']
+
+    matrix, classes, codes = build_incidence_matrix(root, record_type, workers)
+    os.makedirs(cache_dir, exist_ok=True)
+    sp.save_npz(f'{cache_path}.npz', matrix)
+    # The labels are written last, so their presence marks a complete cache entry
+    with open(f'{cache_path}.json', 'w') as f:
+        json.dump({'classes': classes, 'codes': codes}, f)
+    return matrix, classes, codes
+
+
+def co_occurrence(matrix):
+    ''' Returns the class x class matrix of the number of distinct CPC codes two classes have in common. '''
+    binary = (matrix > 0).astype(np.int64)
+    return (binary @ binary.T).toarray()
+
+
+def jaccard_index(matrix):
+    '''
+    Returns the class x class matrix of the Jaccard index between the sets of CPC codes of every pair of classes,
+    computed for all pairs at once as |A & B| / (|A| + |B| - |A & B|).
+    '''
+    intersection = co_occurrence(matrix)
+    sizes = np.diag(intersection)
+    union = sizes[:, None] + sizes[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros(intersection.shape), where=union > 0)
+
+
+def CPC_frequencies(matrix, classes, codes, threshold=1):
+    '''
+    Returns the frequency distribution of the CPC codes of each class as a long DataFrame
+    (class, code, count, share of the class total), keeping the codes counted at least threshold times.
+    '''
+    coo = matrix.tocoo()
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    keep = coo.data >= threshold
+    df = pd.DataFrame({
+        'class': np.asarray(classes)[coo.row[keep]],
+        'code': np.asarray(codes)[coo.col[keep]],
+        'count': coo.data[keep],
+        'share': coo.data[keep] / totals[coo.row[keep]],
+    })
+    return df.sort_values(['class', 'count'], ascending=[True, False], ignore_index=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compute the CPC code statistics of a scraped dataset: Jaccard index and co-occurrence between CPC classes and frequency of CPC codes per class.')
+
+    parser.add_argument('--json_dir_input', type=str, default='/vast/marco/Data_Google_Patent/json/document',
+                        help='Root directory of the dataset written by the scrapers.')
+    parser.add_argument('--output_dir', type=str, default='/vast/marco/Data_Google_Patent/analytics',
+                        help='Directory where the statistics are saved as CSV files.')
+    parser.add_argument('--cache_dir', type=str, default='/vast/marco/Data_Google_Patent/analytics/cache',
+                        help='Directory of the incidence matrices cached by dataset version.')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='Directory of the CPC index of the dataset (cpc_index.py): when given, it is updated and the statistics are computed from it.')
+    parser.add_argument('--type', type=str, default='document', choices=['query', 'document'],
+                        help='Type of the records whose CPC codes are counted.')
+    parser.add_argument('--threshold', type=int, default=5,
+                        help='Minimum count of a CPC code to be listed in the frequency distribution of a class.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes loading CPC classes in parallel.')
+
+    args = parser.parse_args()
+
+    if args.index_dir:
+        # Counts from the forward index of the CPC index (cpc_index.py) instead of reading the records
+        update_CPC_index(args.json_dir_input, args.index_dir)
+        matrix, classes, codes = incidence_matrix(CPCIndex(args.index_dir).class_code_counts(args.type))
+    else:
+        matrix, classes, codes = load_incidence_matrix(args.json_dir_input, args.cache_dir, args.type, args.workers)
+    print(f'Loaded {matrix.nnz} (class, CPC code) pairs: {len(classes)} classes, {len(codes)} CPC codes')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    pd.DataFrame(jaccard_index(matrix).round(3), index=classes, columns=classes).to_csv(os.path.join(args.output_dir, 'jaccard.csv'))
+    pd.DataFrame(co_occurrence(matrix), index=classes, columns=classes).to_csv(os.path.join(args.output_dir, 'co_occurrence.csv'))
+    CPC_frequencies(matrix, classes, codes, args.threshold).to_csv(os.path.join(args.output_dir, 'CPC_frequencies.csv'), index=False)
+    print(f'Saved statistics to {args.output_dir}')
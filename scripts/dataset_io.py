@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import socket
+import argparse
+
+
+# Shards are rotated once they reach this size.
+DEFAULT_SHARD_SIZE = 64 * 1024 * 1024
+# Directory (inside the dataset root) with the manifest files listing every record written by the sinks.
+MANIFEST_DIR = '_manifest'
+# Manifest file listing the records written before the dataset had a manifest (see bootstrap_manifest()).
+BOOTSTRAP_MANIFEST = 'bootstrap.jsonl'
+
+
+
+def writer_ID():
+    ''' Returns a name unique to the current process, used for the shard and manifest files it owns. '''
+    return f'{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+
+
+
+def manifest_event(op, record, location, event_time=None):
+    ''' Returns the manifest event of an operation ('add' or 'remove') on a record stored at location. '''
+    return {
+        'op': op,
+        'type': record.get('type'),
+        'cls': record.get('cls'),
+        'patent_ID': record.get('patent_ID'),
+        'query_ID': record.get('query_ID'),
+        'location': location,
+        'time': time.time() if event_time is None else event_time,
+    }
+
+
+
+def bootstrap_manifest(root):
+    '''
+    Lists in the manifest, as 'add' events dated with the modification time of their file, the records written as
+    JSON files before the dataset had a manifest, so that the consumers of the manifest see the whole dataset.
+    Done once: the bootstrap file is created with an exclusive link, and nothing is done if it already exists.
+    '''
+    manifest_dir = os.path.join(root, MANIFEST_DIR)
+    bootstrap_path = os.path.join(manifest_dir, BOOTSTRAP_MANIFEST)
+    if os.path.exists(bootstrap_path):
+        return
+    os.makedirs(manifest_dir, exist_ok=True)
+    tmp_path = f'{bootstrap_path}.{writer_ID()}.tmp'
+    n_records = 0
+    with open(tmp_path, 'w') as f:
+        for CPC_class in sorted(os.listdir(root)):
+            CPC_dir = os.path.join(root, CPC_class)
+            if CPC_class == MANIFEST_DIR or not os.path.isdir(CPC_dir):
+                continue
+            for filename in sorted(os.listdir(CPC_dir)):
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(CPC_dir, filename)
+                try:
+                    with open(path, 'r') as record_file:
+                        record = json.load(record_file)
+                    event = manifest_event('add', record, path, os.path.getmtime(path))
+                except (OSError, ValueError):
+                    continue # Removed meanwhile, or truncated (see validate_dataset.py)
+                f.write(json.dumps(event) + '\n')
+                n_records += 1
+    try:
+        os.link(tmp_path, bootstrap_path)
+        print(f'Listed {n_records} records written before the manifest in {bootstrap_path}.')
+    except FileExistsError:
+        pass # Bootstrapped concurrently by another writer
+    finally:
+        os.remove(tmp_path)
+
+
+
+class Manifest:
+    '''
+    Append-only log of the records written to a dataset (one JSON line per event), owned by a single writer.
+    Consumers such as create_ground_truth.py read the manifest instead of listing the dataset directories.
+    The records written before the manifest are listed once, when the first writer creates it.
+    '''
+    def __init__(self, root, name):
+        manifest_dir = os.path.join(root, MANIFEST_DIR)
+        bootstrap_manifest(root)
+        self.file = open(os.path.join(manifest_dir, f'{name}.jsonl'), 'a')
+
+    def log(self, op, record, location):
+        self.file.write(json.dumps(manifest_event(op, record, location)) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+
+class JsonDirSink:
+    '''
+    Writes each record as an indented JSON file <root>/<cls>/<record_ID>.json (the original dataset layout).
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.manifest = Manifest(root, writer_ID())
+
+    def write(self, record, record_ID):
+        CPC_dir = os.path.join(self.root, record['cls'])
+        os.makedirs(CPC_dir, exist_ok=True)
+        json_filepath = os.path.join(CPC_dir, f'{record_ID}.json')
+        tmp_path = f'{json_filepath}.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(record, json_file, indent=2)
+        os.replace(tmp_path, json_filepath)
+        self.manifest.log('add', record, json_filepath)
+        return json_filepath
+
+    def close(self):
+        self.manifest.close()
+
+
+
+class JsonlShardSink:
+    '''
+    Appends records as JSON lines to size-bounded shards <root>/<cls>/part-<writer>-<n>.jsonl, one open shard per CPC class.
+    The shard being written has a .tmp suffix and is renamed once it is full (or the sink is closed),
+    so a finished shard never changes. Each line is flushed when written, so a crash loses at most a partial last line.
+    '''
+    def __init__(self, root, shard_size=DEFAULT_SHARD_SIZE):
+        self.root = root
+        self.shard_size = shard_size
+        self.name = writer_ID()
+        self.manifest = Manifest(root, self.name)
+        self.shards = {} # CPC class -> (open file, path)
+        self.n_shards = 0
+
+    def _rotate(self, CPC_class):
+        ''' Finalizes the open shard of a CPC class by renaming it without the .tmp suffix. '''
+        shard, tmp_path = self.shards.pop(CPC_class)
+        shard.close()
+        os.replace(tmp_path, tmp_path[:-len('.tmp')])
+
+    def write(self, record, record_ID):
+        CPC_class = record['cls']
+        if CPC_class in self.shards and self.shards[CPC_class][0].tell() >= self.shard_size:
+            self._rotate(CPC_class)
+        if CPC_class not in self.shards:
+            CPC_dir = os.path.join(self.root, CPC_class)
+            os.makedirs(CPC_dir, exist_ok=True)
+            tmp_path = os.path.join(CPC_dir, f'part-{self.name}-{self.n_shards:05d}.jsonl.tmp')
+            self.shards[CPC_class] = (open(tmp_path, 'a'), tmp_path)
+            self.n_shards += 1
+
+        shard, tmp_path = self.shards[CPC_class]
+        shard.write(json.dumps(dict(record, record_ID=record_ID)) + '\n')
+        shard.flush()
+        location = tmp_path[:-len('.tmp')]
+        self.manifest.log('add', record, location)
+        return location
+
+    def close(self):
+        for CPC_class in list(self.shards):
+            self._rotate(CPC_class)
+        self.manifest.close()
+
+
+
+def read_manifest(root, offsets=None):
+    '''
+    Reads the manifest events written after the given byte offsets {manifest file name: offset}
+    (from the start of every manifest file if offsets is None). Only complete lines are consumed.
+    Returns the list of events, in file order, and the updated offsets.
+    '''
+    offsets = dict(offsets or {})
+    events = []
+    manifest_dir = os.path.join(root, MANIFEST_DIR)
+    if not os.path.isdir(manifest_dir):
+        return events, offsets
+    for filename in sorted(os.listdir(manifest_dir)):
+        if not filename.endswith('.jsonl'):
+            continue # Bootstrap file being written
+        offset = offsets.get(filename, 0)
+        with open(os.path.join(manifest_dir, filename), 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break # Line still being written
+                offset += len(line)
+                events.append(json.loads(line))
+        offsets[filename] = offset
+    return events, offsets
+
+
+
+def setup_sink(root, output_format='json'):
+    ''' Returns the output sink for the format 'json' (one file per record) or 'jsonl' (sharded JSON lines). '''
+    if output_format == 'jsonl':
+        return JsonlShardSink(root)
+    return JsonDirSink(root)
+
+
+
+def _iter_jsonl(path):
+    ''' Yields the records of a JSON lines shard, skipping a partial last line left by a crash. '''
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            yield json.loads(line)
+
+
+
+def read_location(location):
+    '''
+    Returns the records stored at the location of a manifest event: a JSON file, or a JSON lines shard
+    (still open with its .tmp suffix, or finalized). Returns an empty list if the location no longer exists.
+    '''
+    if location.endswith('.jsonl'):
+        for path in (location, f'{location}.tmp'):
+            if os.path.exists(path):
+                return list(_iter_jsonl(path))
+        return []
+    try:
+        with open(location, 'r') as f:
+            return [json.load(f)]
+    except (OSError, ValueError):
+        return []
+
+
+
+def get_record_ID(record):
+    ''' Returns the ID of a record given to the sinks: <query_ID>_<patent_ID> for a document, <CPC>_<patent_ID> for a query. '''
+    query_ID = record.get('query_ID') or f"{record['cls']}_{record['patent_ID']}"
+    return f"{query_ID}_{record['patent_ID']}" if record.get('type') == 'document' else query_ID
+
+
+
+def class_record_files(CPC_dir):
+    '''
+    Returns the paths of the record files of a CPC class (JSON files and JSON lines shards, open ones included),
+    oldest modification first: a record written again later (e.g. repaired) is in a file read after the stale one.
+    '''
+    paths = [os.path.join(CPC_dir, filename) for filename in os.listdir(CPC_dir)
+             if filename.endswith('.json') or filename.endswith('.jsonl') or filename.endswith('.jsonl.tmp')]
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+
+def iter_records(root, CPC_class=None, record_type=None):
+    '''
+    Streams the records of a dataset written by any sink, optionally only those of a CPC class and/or a type
+    ('query' or 'document'). JSON lines shards are read sequentially; open (.tmp) shards are included.
+    A record written several times (a shard record superseded by a repaired one) is yielded once: the last one written.
+    '''
+    CPC_classes = [CPC_class] if CPC_class is not None else sorted(os.listdir(root))
+    for CPC in CPC_classes:
+        CPC_dir = os.path.join(root, CPC)
+        if CPC == MANIFEST_DIR or not os.path.isdir(CPC_dir):
+            continue
+        latest = {}
+        for path in class_record_files(CPC_dir):
+            if path.endswith('.json'):
+                with open(path, 'r') as f:
+                    records = [json.load(f)]
+            else:
+                records = _iter_jsonl(path)
+            for record in records:
+                if record_type is None or record.get('type') == record_type:
+                    latest[get_record_ID(record)] = record
+        yield from latest.values()
+
+
+
+def export_parquet(root, output_path, CPC_class=None, record_type=None):
+    '''
+    Writes the records of a dataset (optionally filtered as in iter_records()) to a single columnar Parquet file.
+    Requires pyarrow, imported here because only the export needs it.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pylist(list(iter_records(root, CPC_class, record_type)))
+    pq.write_table(table, output_path, compression='zstd')
+    return table.num_rows
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Export a scraped dataset (JSON files or JSON lines shards) to a Parquet file.')
+
+    parser.add_argument('--json_dir_input', type=str, default='/vast/marco/Data_Google_Patent/json/document',
+                        help='Root directory of the dataset written by the scrapers.')
+    parser.add_argument('--output', type=str, default='/vast/marco/Data_Google_Patent/document.parquet',
+                        help='Path of the Parquet file to write.')
+    parser.add_argument('--CPC_class', type=str, default=None, help='Export only the records of this CPC class.')
+    parser.add_argument('--type', type=str, default=None, choices=['query', 'document'], help='Export only the records of this type.')
+
+    args = parser.parse_args()
+    n_rows = export_parquet(args.json_dir_input, args.output, args.CPC_class, args.type)
+    print(f'Exported {n_rows} records to {args.output}')
@@ -0,0 +1,366 @@
+import os
+import time
+import requests
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
+from scraping_functions import PATENT_FIELDS, setup_driver, extract_all, get_patent_PN_from_citation_node, get_CPC_classes_from_HTML_node
+from rate_limiter import ThrottledError, THROTTLE_STATUS_CODES, is_throttled_page
+from metrics import timed_stage
+
+
+# Browser-like headers: Google Patents serves the full patent markup to plain HTTP clients.
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0',
+    'Accept-Language': 'en-US,en;q=0.8',
+}
+
+
+
+def setup_session(pool_size=10):
+    '''
+    Set up and return a requests Session with a pool of keep-alive connections,
+    shared by every page fetched through the HTML backend.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(HTTP_HEADERS)
+    return session
+
+
+
+def fetch_patent_html(session, url, timeout=30):
+    '''
+    This function fetches the served HTML of a patent page with a plain HTTP request (no browser).
+    Returns the HTML text, or None if the request fails.
+    Raises ThrottledError if Google answers with a throttling status code or a captcha page.
+    '''
+    try:
+        response = session.get(url, timeout=timeout)
+    except Exception as e:
+        #print(f"Error fetching HTML from: {url} Message: {e}")
+        return None
+    if response.status_code in THROTTLE_STATUS_CODES or is_throttled_page(response.text, response.url):
+        raise ThrottledError(f'HTTP {response.status_code} from: {url}')
+    if not response.ok:
+        return None
+    return response.text
+
+
+
+def _normalized_text(node):
+    ''' Returns the text content of an lxml node with whitespace collapsed, or None if it is empty. '''
+    text = ' '.join(node.text_content().split())
+    return text if text else None
+
+
+
+def parse_title(tree, url):
+    ''' Extracts the title text from the parsed patent page. '''
+    nodes = tree.xpath('//span[@itemprop="title"]')
+    return _normalized_text(nodes[0]) if nodes else None
+
+
+
+def parse_abstract(tree, url):
+    ''' Extracts the abstract text from the parsed patent page. '''
+    nodes = tree.xpath('//section[@itemprop="abstract"]//div[contains(concat(" ", normalize-space(@class), " "), " abstract ")]')
+    if not nodes:
+        nodes = tree.xpath('//section[@itemprop="abstract"]//abstract')
+    return _normalized_text(nodes[0]) if nodes else None
+
+
+
+def parse_first_claim(tree, url):
+    ''' Extracts the text of the first claim from the parsed patent page. '''
+    nodes = tree.xpath('//section[@itemprop="claims"]//*[contains(concat(" ", normalize-space(@class), " "), " claim ")]')
+    if not nodes:
+        nodes = tree.xpath('//section[@itemprop="claims"]//claim')
+    return _normalized_text(nodes[0]) if nodes else None
+
+
+
+def parse_citations(tree, url):
+    '''
+    Extracts the patent citations listed in the "Patent Citations" table of the parsed patent page.
+    The rows are rebuilt in the same "<PN> *" text format as the rendered table, so that the result
+    is produced by get_patent_PN_from_citation_node() exactly as in get_citations().
+    '''
+    rows = tree.xpath('//tr[@itemprop="backwardReferencesOrig"]') or tree.xpath('//tr[@itemprop="backwardReferences"]')
+    if not rows:
+        return None
+    node_text = []
+    for row in rows:
+        PN = row.xpath('.//span[@itemprop="publicationNumber"]/text()')
+        if PN:
+            examiner_cited = bool(row.xpath('.//span[@itemprop="examinerCited"]'))
+            node_text.append(f"{PN[0].strip()} {'*' if examiner_cited else ''}")
+    return get_patent_PN_from_citation_node('\n'.join(node_text), url)
+
+
+
+def parse_CPC_classes(tree, url):
+    '''
+    Extracts the CPC classes listed in the classification section of the parsed patent page.
+    The codes are passed through get_CPC_classes_from_HTML_node(), one per row, as in get_CPC_classes().
+    '''
+    node_text = []
+    for item in tree.xpath('//li[@itemprop="classifications"]'):
+        is_CPC = item.xpath('./meta[@itemprop="IsCPC"]/@content')
+        code = item.xpath('./span[@itemprop="Code"]/text()')
+        if code and (not is_CPC or is_CPC[0] == 'true'):
+            node_text.append(code[0].strip())
+    return get_CPC_classes_from_HTML_node('\n'.join(node_text), url)
+
+
+
+def parse_front_img_url(tree, url):
+    ''' Extracts the URL of the full-size front image (first drawing) from the parsed patent page. '''
+    urls = tree.xpath('//li[@itemprop="images"]//meta[@itemprop="full"]/@content')
+    return urls[0] if urls else None
+
+
+
+# Parser used for each field returned by extract_all() (same keys as PATENT_FIELDS).
+HTML_PARSERS = {
+    'abstract': parse_abstract,
+    'citations': parse_citations,
+    'title': parse_title,
+    'first_claim': parse_first_claim,
+    'CPC_classes': parse_CPC_classes,
+    'front_img_url': parse_front_img_url,
+}
+
+
+
+def is_patent_page(tree):
+    ''' Checks whether the parsed HTML has the patent metadata markup the parsers rely on. '''
+    return bool(tree.xpath('//meta[@name="DC.title"] | //*[@itemprop="publicationNumber"]'))
+
+
+
+def parse_patent_html(page_html, url, fields=None):
+    '''
+    This function parses the served HTML of a patent page and extracts every requested field.
+    Returns the same dictionary as extract_all(), or None if the HTML is not a recognizable patent page.
+    '''
+    fields = list(PATENT_FIELDS) if fields is None else [field for field in PATENT_FIELDS if field in fields]
+    try:
+        tree = lxml_html.fromstring(page_html)
+    except Exception as e:
+        #print(f"Error parsing HTML from: {url} Message: {e}")
+        return None
+    if not is_patent_page(tree):
+        return None
+
+    result = {'url': url}
+    missing = []
+    for field in fields:
+        try:
+            value = HTML_PARSERS[field](tree, url)
+        except Exception as e:
+            #print(f"Error parsing {field} from: {url} Message: {e}")
+            value = None
+        result[field] = value if value else None
+        if not value:
+            missing.append(field)
+
+    result['missing'] = missing
+    return result
+
+
+
+def extract_all_html(session, url, fields=None, keep_html=False, stages=None):
+    '''
+    This function fetches a patent page without a browser and extracts every requested field from its HTML.
+    Returns the same dictionary as extract_all(), or None if the page could not be fetched or parsed.
+    The duration and outcome of the fetch and of the parsing are recorded in stages (a dictionary) when given.
+    '''
+    stages = {} if stages is None else stages
+    start_time = time.time()
+    try:
+        page_html = fetch_patent_html(session, url)
+    except ThrottledError:
+        timed_stage(stages, 'fetch_html', start_time, 'throttled')
+        raise
+    timed_stage(stages, 'fetch_html', start_time, 'ok' if page_html is not None else 'failed')
+    if page_html is None:
+        return None
+    start_time = time.time()
+    result = parse_patent_html(page_html, url, fields)
+    timed_stage(stages, 'parse_html', start_time, 'failed' if result is None else 'missing' if result['missing'] else 'ok')
+    if result is not None and keep_html:
+        result['html'] = page_html
+        result['html_source'] = 'served'
+    return result
+
+
+
+def process_tree_rss(pid):
+    '''
+    Returns the resident memory in MB of a process and all its descendants (e.g. geckodriver, Firefox and its
+    content processes), read from /proc. Returns None where /proc is not available.
+    '''
+    children = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', 'r') as f:
+                    # The parent PID is the second field after the parenthesized command name
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue # Process exited while listing
+            children.setdefault(ppid, []).append(int(entry))
+    except OSError:
+        return None
+
+    rss_kb = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        pids.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return rss_kb / 1024
+
+
+
+class ManagedDriver:
+    '''
+    Owns the WebDriver of a scraping process for its whole lifetime:
+    - the browser is only started the first time it is needed, so the HTML backend does not pay for a browser
+      process unless a page has to fall back to Selenium;
+    - the browser is recycled (quit and started again) after max_pages pages, or once the resident memory of the
+      browser processes exceeds max_rss_mb (checked every rss_check_every pages), so memory cannot grow without bound;
+    - it is a context manager that always quits the browser on exit.
+    get() must be called once per page to load.
+    '''
+    def __init__(self, setup=None, max_pages=500, max_rss_mb=2048, rss_check_every=20):
+        self.setup = setup or setup_driver
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.rss_check_every = rss_check_every
+        self.driver = None
+        self.n_pages = 0
+
+    def _needs_recycling(self):
+        if self.max_pages and self.n_pages >= self.max_pages:
+            return True
+        if self.max_rss_mb and self.n_pages % self.rss_check_every == 0:
+            rss = process_tree_rss(self.driver.service.process.pid)
+            return rss is not None and rss > self.max_rss_mb
+        return False
+
+    def get(self):
+        if self.driver is not None and self._needs_recycling():
+            self.quit()
+        if self.driver is None:
+            self.driver = self.setup()
+        self.n_pages += 1
+        return self.driver
+
+    def quit(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                print(f"Error quitting WebDriver: {e}")
+            self.driver = None
+            self.n_pages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.quit()
+
+
+
+def extract_patent(url, driver, session=None, fields=None, keep_html=False, limiter=None, archive_session=None):
+    '''
+    Extracts the requested fields of a patent with the selected backend.
+    - Selenium backend (session is None): a single page load through extract_all().
+    - HTML backend: the page is fetched and parsed without a browser; only pages that cannot be
+      fetched or parsed fall back to extract_all() on the (lazily started) WebDriver.
+    driver is a ManagedDriver.
+    With keep_html=True the page HTML is returned under the key "html", and under "html_source" whether it is the HTML
+    served by Google ('served') or the DOM rendered by the browser ('rendered'). With archive_session, a page extracted
+    by the browser is also fetched once with a plain request, so that the served HTML is returned (see fetch_served_html()).
+    With a RateLimiter, every request to Google waits for a token and its outcome adapts the shared rate.
+    The key "throttled" of the returned dictionary is True if Google throttled the request (captcha page or HTTP 429/503),
+    in which case every field is reported missing.
+    The key "stages" holds the duration and outcome of every stage (rate limiting, fetch, parsing or navigation and extractors).
+    '''
+    all_fields = list(PATENT_FIELDS) if fields is None else [field for field in PATENT_FIELDS if field in fields]
+    page = None
+    stages = {}
+    try:
+        if session is not None:
+            if limiter is not None:
+                timed_stage(stages, 'rate_limit', time.time() - limiter.acquire(), 'ok')
+            page = extract_all_html(session, url, fields, keep_html, stages)
+            #if page is None: print(f"Falling back to Selenium for: {url}")
+            if page is None and limiter is not None:
+                limiter.report('error')
+        if page is None:
+            if limiter is not None:
+                timed_stage(stages, 'rate_limit', time.time() - limiter.acquire(), 'ok')
+            browser = driver.get()
+            page = extract_all(browser, url, fields, keep_html)
+            page['stages'] = stages = dict(stages, **page['stages'])
+            # Throttling only shows up as missing elements in the browser: look for the interstitial when something is missing
+            if page['missing'] and is_throttled_page(browser.page_source, browser.current_url):
+                raise ThrottledError(f'Captcha page for: {url}')
+    except ThrottledError as e:
+        #print(f"Throttled: {e}")
+        if limiter is not None:
+            limiter.report('throttled')
+        return dict({field: None for field in all_fields}, url=url, missing=all_fields, throttled=True, stages=stages)
+
+    if limiter is not None:
+        limiter.report('error' if len(page['missing']) == len(all_fields) else 'ok')
+    page['throttled'] = False
+    page.setdefault('stages', stages)
+    if keep_html and archive_session is not None and page.get('html_source') == 'rendered':
+        served_html = fetch_served_html(archive_session, url, limiter, page['stages'])
+        if served_html is not None:
+            page['html'], page['html_source'] = served_html, 'served'
+    return page
+
+
+
+def fetch_served_html(session, url, limiter=None, stages=None):
+    '''
+    Fetches the served HTML of a patent page extracted by the browser, for the page archive: the parsers of reextract.py
+    read the served HTML, not the rendered DOM. Returns the HTML, or None if it could not be fetched or is not a patent page
+    (the extracted fields are kept either way). The duration and outcome are recorded in stages under 'fetch_archive_html'.
+    '''
+    stages = {} if stages is None else stages
+    start_time = time.time()
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        page_html = fetch_patent_html(session, url)
+    except ThrottledError:
+        if limiter is not None:
+            limiter.report('throttled')
+        timed_stage(stages, 'fetch_archive_html', start_time, 'throttled')
+        return None
+    try:
+        if page_html is not None and not is_patent_page(lxml_html.fromstring(page_html)):
+            page_html = None
+    except Exception:
+        page_html = None
+    if limiter is not None:
+        limiter.report('ok' if page_html is not None else 'error')
+    timed_stage(stages, 'fetch_archive_html', start_time, 'ok' if page_html is not None else 'failed')
+    return page_html
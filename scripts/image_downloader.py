@@ -0,0 +1,85 @@
+import os
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from scraping_functions import save_img
+from metrics import timed_stage
+
+
+def setup_image_session(pool_size=8, retries=3):
+    '''
+    Set up and return a requests Session for the image host with a pool of keep-alive connections
+    and retries (with exponential backoff) of failed connections and transient HTTP errors.
+    '''
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+
+class ImageDownloader:
+    '''
+    Downloads front images on a pool of threads sharing one pooled session, so the browser can extract the next patent
+    while the images of the previous ones are downloaded.
+    submit() returns immediately; the on_done callback of each download is run by poll() (called by every submit())
+    or close(), always in the scraping thread, so callbacks can write to the sinks and the ledger without locking.
+    At most max_pending downloads are in flight: submit() waits for the oldest ones beyond that.
+    '''
+    def __init__(self, workers=4, timeout=30, retries=3, max_pending=16):
+        self.session = setup_image_session(workers, retries)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = {} # future -> (on_done, on_error) callbacks
+
+    def download(self, front_img_url, filename, save_dir, stages=None):
+        '''
+        Downloads an image synchronously, as save_img() but with the pooled session. Returns its path or None.
+        The duration, outcome and size of the download are recorded in stages (a dictionary) when given.
+        '''
+        start_time = time.time()
+        filepath = save_img(front_img_url, filename, save_dir, self.session, self.timeout)
+        if stages is not None:
+            timed_stage(stages, 'download_img', start_time, 'ok' if filepath else 'failed', bytes=os.path.getsize(filepath) if filepath else 0)
+        return filepath
+
+    def submit(self, front_img_url, filename, save_dir, on_done, stages=None, on_error=None):
+        '''
+        Downloads an image in the background; on_done(filepath) is called with its path, or None if the download failed.
+        If on_done raises, on_error(exception) is called instead, so that the item is still accounted for.
+        '''
+        future = self.executor.submit(self.download, front_img_url, filename, save_dir, stages)
+        self.pending[future] = (on_done, on_error)
+        self.poll()
+        while len(self.pending) > self.max_pending:
+            self.poll(wait_any=True)
+
+    def poll(self, wait_any=False, wait_all=False):
+        ''' Runs the callbacks of the finished downloads (after waiting for at least one, or for all of them). '''
+        if wait_all:
+            finished = list(self.pending)
+            wait(finished)
+        elif wait_any and self.pending:
+            finished, _ = wait(list(self.pending), return_when=FIRST_COMPLETED)
+        else:
+            finished = [future for future in self.pending if future.done()]
+        for future in finished:
+            on_done, on_error = self.pending.pop(future)
+            try:
+                on_done(future.result())
+            except Exception as e:
+                # A failing callback must not be reported as a failure of the item being submitted
+                print(f"Error completing image download: {e}")
+                if on_error is not None:
+                    on_error(e)
+
+    def close(self):
+        ''' Waits for the pending downloads and runs their callbacks. '''
+        self.poll(wait_all=True)
+        self.executor.shutdown()
+        self.session.close()
@@ -0,0 +1,289 @@
+import io
+import os
+import json
+import mmap
+import time
+import socket
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps
+from tqdm import tqdm
+
+
+# Shards are rotated once they reach this size.
+DEFAULT_SHARD_SIZE = 1024 * 1024 * 1024
+# Extensions of the image files packed from the front image directories.
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+
+def load_image_index(store_dir):
+    '''
+    Loads the index files of the image store.
+    Returns a dictionary {image_ID: {'shard', 'offset', 'length', 'width', 'height', 'sha1', 'packed_at'}}; when an image
+    was packed more than once, the most recent entry is kept.
+    '''
+    index = {}
+    if not os.path.isdir(store_dir):
+        return index
+    for filename in sorted(os.listdir(store_dir)):
+        if not filename.endswith('.idx'):
+            continue
+        with open(os.path.join(store_dir, filename), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # Line truncated by a crash while it was written
+                previous = index.get(entry['image_ID'])
+                if previous is None or previous['packed_at'] <= entry['packed_at']:
+                    index[entry['image_ID']] = entry
+    return index
+
+
+
+def inspect_image(path):
+    '''
+    Reads an image file and returns (data, sha1, width, height), or the error message if it is not a readable image.
+    Runs in a worker process: hashing and reading the image header are done in parallel, the single writer only appends.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        width, height = Image.open(io.BytesIO(data)).size
+    except Exception as e:
+        return str(e)
+    return data, hashlib.sha1(data).hexdigest(), width, height
+
+
+
+class ImageStoreWriter:
+    '''
+    Packs image files into large shard files and records the location, size and content hash of each image
+    in the index file of the writer (one JSON line per image). Identical images are stored once: an image whose
+    hash is already in the store is only indexed, pointing to the existing copy.
+    Every writer owns its shards and index file, so several writers can pack into the same store.
+    '''
+    def __init__(self, store_dir, shard_size=DEFAULT_SHARD_SIZE):
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        index = load_image_index(store_dir)
+        self.packed = set(index)
+        self.by_hash = {entry['sha1']: entry for entry in index.values()}
+        self.prefix = f'images-{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+        self.n_shard = 0
+        self.shard = None
+        self.shard_name = None
+        self.index = None # Opened with the first image, so that a run adding nothing leaves no file
+
+    def add(self, image_ID, data, sha1, width, height):
+        '''
+        Packs an image (its encoded bytes as read from the file) unless an image with this ID is already in the store.
+        Returns True if the image was added (as a new copy or as a duplicate of a stored one).
+        '''
+        if image_ID in self.packed:
+            return False
+        location = self.by_hash.get(sha1)
+        if location is None:
+            if self.shard is None or self.shard.tell() >= self.shard_size:
+                self._open_shard()
+            location = {'shard': self.shard_name, 'offset': self.shard.tell(), 'length': len(data)}
+            self.shard.write(data)
+            self.shard.flush()
+        if self.index is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            self.index = open(os.path.join(self.store_dir, f'{self.prefix}.idx'), 'a')
+        # The index entry is written after the data, so an indexed image is always complete
+        entry = {'image_ID': image_ID, 'shard': location['shard'], 'offset': location['offset'], 'length': location['length'],
+                 'width': width, 'height': height, 'sha1': sha1, 'packed_at': time.time()}
+        self.index.write(json.dumps(entry) + '\n')
+        self.index.flush()
+        self.by_hash.setdefault(sha1, entry)
+        self.packed.add(image_ID)
+        return True
+
+    def _open_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_name = f'{self.prefix}-{self.n_shard:05d}.bin'
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.shard = open(os.path.join(self.store_dir, self.shard_name), 'ab')
+        self.n_shard += 1
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+        if self.index is not None:
+            self.index.close()
+
+
+
+class ImageStore:
+    '''
+    Read access to the packed images. The shards are memory-mapped: get() returns a zero-copy memoryview
+    of the encoded image, open_image() decodes it with Pillow.
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = load_image_index(store_dir)
+        self.maps = {} # shard -> mmap
+
+    def __contains__(self, image_ID):
+        return image_ID in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def image_IDs(self):
+        return sorted(self.index)
+
+    def _map(self, shard, end):
+        shard_map = self.maps.get(shard)
+        if shard_map is None or len(shard_map) < end:
+            # Mapped again when a shard still being written has grown past the mapped size
+            with open(os.path.join(self.store_dir, shard), 'rb') as f:
+                shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = shard_map
+        return shard_map
+
+    def get(self, image_ID):
+        ''' Returns the encoded bytes of an image as a memoryview of the mapped shard, or None if it is not in the store. '''
+        entry = self.index.get(image_ID)
+        if entry is None:
+            return None
+        end = entry['offset'] + entry['length']
+        return memoryview(self._map(entry['shard'], end))[entry['offset']:end]
+
+    def open_image(self, image_ID):
+        ''' Returns the decoded image (a PIL Image), or None if it is not in the store. '''
+        data = self.get(image_ID)
+        return Image.open(io.BytesIO(data)) if data is not None else None
+
+    def stats(self):
+        ''' Returns the number of images, of distinct images and the bytes they take in the shards. '''
+        distinct = {entry['sha1']: entry['length'] for entry in self.index.values()}
+        return {'images': len(self.index), 'distinct': len(distinct), 'bytes': sum(distinct.values())}
+
+    def close(self):
+        for shard_map in self.maps.values():
+            shard_map.close()
+        self.maps = {}
+
+
+
+def pack_image_dirs(img_dirs, store_dir, workers=None):
+    '''
+    Packs the image files found (recursively) in img_dirs into the store, skipping the images already packed.
+    The image ID is the file name without extension (the doc_ID, query_ID or normalized patent ID the scrapers use).
+    The files are read, hashed and inspected by a pool of processes; the original files are left in place.
+    Returns the number of images added.
+    '''
+    writer = ImageStoreWriter(store_dir)
+    paths = {}
+    for img_dir in img_dirs:
+        for dirpath, _, filenames in os.walk(img_dir):
+            for filename in filenames:
+                image_ID, extension = os.path.splitext(filename)
+                if extension.lower() in IMAGE_EXTENSIONS and image_ID not in writer.packed:
+                    paths.setdefault(image_ID, os.path.join(dirpath, filename))
+
+    n_added = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(inspect_image, paths.values(), chunksize=64)
+            for image_ID, result in tqdm(zip(paths, results), total=len(paths)):
+                if isinstance(result, str):
+                    print(f"Error packing image: {paths[image_ID]} Message: {result}")
+                else:
+                    n_added += writer.add(image_ID, *result)
+    finally:
+        writer.close()
+    return n_added
+
+
+
+def decoded_array_path(store_dir, size, mode):
+    ''' Returns the paths of the pre-decoded array of the store at a resolution (width, height) and mode ('L' or 'RGB'), and of its IDs. '''
+    name = os.path.join(store_dir, f'decoded-{size[0]}x{size[1]}-{mode}')
+    return f'{name}.npy', f'{name}.json'
+
+
+
+def _decode_chunk(store_dir, array_path, image_IDs, start, size, mode):
+    '''
+    Decodes the images of a chunk, pads them to the fixed resolution keeping their aspect ratio (white background)
+    and writes them into their rows of the memory-mapped array. Runs in a worker process.
+    '''
+    store = ImageStore(store_dir)
+    array = np.load(array_path, mmap_mode='r+')
+    for row, image_ID in enumerate(image_IDs, start):
+        image = store.open_image(image_ID).convert(mode)
+        array[row] = np.asarray(ImageOps.pad(image, size, color=255 if mode == 'L' else (255, 255, 255)))
+    array.flush()
+    store.close()
+    return len(image_IDs)
+
+
+
+def build_decoded_array(store_dir, size, mode='L', workers=None, chunk_size=1024):
+    '''
+    Pre-decodes every image of the store at a fixed resolution into a single uint8 array file
+    (N x height x width, with a channel axis for RGB) in a pool of processes, each filling its rows in place.
+    The row order is given by the JSON list of image IDs written next to it; load_decoded_array() maps both.
+    '''
+    store = ImageStore(store_dir)
+    image_IDs = store.image_IDs()
+    array_path, IDs_path = decoded_array_path(store_dir, size, mode)
+    shape = (len(image_IDs), size[1], size[0]) + ((3,) if mode == 'RGB' else ())
+    tmp_path = f'{array_path[:-len(".npy")]}.tmp.npy'
+    np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape).flush()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_decode_chunk, store_dir, tmp_path, image_IDs[start:start + chunk_size], start, size, mode)
+                   for start in range(0, len(image_IDs), chunk_size)]
+        for future in tqdm(futures):
+            future.result()
+    # The IDs are written last, so their presence marks a complete array
+    os.replace(tmp_path, array_path)
+    with open(IDs_path, 'w') as f:
+        json.dump(image_IDs, f)
+    return array_path
+
+
+
+def load_decoded_array(store_dir, size, mode='L'):
+    ''' Returns the pre-decoded array of build_decoded_array() memory-mapped read-only, and the image ID of each row. '''
+    array_path, IDs_path = decoded_array_path(store_dir, size, mode)
+    with open(IDs_path, 'r') as f:
+        image_IDs = json.load(f)
+    return np.load(array_path, mmap_mode='r'), image_IDs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Pack the front images into the image store (large shards with an index, deduplicated by content) '
+                                                 'and optionally pre-decode them at a fixed resolution.')
+
+    parser.add_argument('--img_dirs', type=str, nargs='*', default=['/vast/marco/Data_Google_Patent/front_imgs/query', '/vast/marco/Data_Google_Patent/store/front_imgs'],
+                        help='Directories of the front images saved by the scrapers (searched recursively).')
+    parser.add_argument('--store_dir', type=str, default='/vast/marco/Data_Google_Patent/image_store',
+                        help='Directory of the image store.')
+    parser.add_argument('--resize', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'),
+                        help='Also pre-decode every image of the store at this resolution into a memory-mappable array.')
+    parser.add_argument('--mode', type=str, default='L', choices=['L', 'RGB'],
+                        help="Pixel format of the pre-decoded array: 'L' (grayscale, as the patent drawings) or 'RGB'.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes reading and decoding images in parallel.')
+
+    args = parser.parse_args()
+
+    n_added = pack_image_dirs(args.img_dirs, args.store_dir, args.workers)
+    stats = ImageStore(args.store_dir).stats()
+    print(f"Packed {n_added} new images. The store has {stats['images']} images, {stats['distinct']} distinct ({stats['bytes'] / 1024 ** 2:.1f} MB).")
+
+    if args.resize:
+        array_path = build_decoded_array(args.store_dir, tuple(args.resize), args.mode, args.workers)
+        print(f'Saved the pre-decoded images to {array_path}')
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import bisect
+
+
+# Upper bounds (seconds) of the latency histogram buckets, as in Prometheus histograms.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, float('inf')]
+
+
+
+def timed_stage(stages, stage, start_time, outcome, **extra):
+    '''
+    Records in stages (the "stages" dictionary of a page or result) the duration of a stage started at start_time
+    and its outcome ('ok', 'missing', 'timeout', 'failed', ...). Returns the duration.
+    '''
+    duration = time.time() - start_time
+    stages[stage] = dict(extra, duration=duration, outcome=outcome)
+    return duration
+
+
+
+class Metrics:
+    '''
+    Aggregates the per-stage timings attached to the scraping results (result['stages'], filled by the extractors,
+    the HTML backend and the image download) in the main process: latency histograms and outcome counts per stage,
+    outcome counts per stage and CPC class, patents per minute and bytes downloaded.
+    With a path, the metrics are exported every interval seconds as JSON lines (one snapshot per line) or,
+    if the path ends with .prom, as a Prometheus textfile (for the node exporter textfile collector).
+    '''
+    def __init__(self, role, path=None, interval=60):
+        self.role = role
+        self.path = path
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_export = self.start_time
+        self.histograms = {} # stage -> bucket counts
+        self.latency_sums = {} # stage -> total seconds
+        self.outcomes = {} # (stage, outcome) -> count
+        self.CPC_outcomes = {} # (stage, CPC class, outcome) -> count
+        self.statuses = {} # status of the results -> count
+        self.bytes_downloaded = 0
+
+    def record(self, result):
+        ''' Adds the stages of a scraping result, and exports the metrics if the export interval has elapsed. '''
+        self.statuses[result['status']] = self.statuses.get(result['status'], 0) + 1
+        for stage, timing in result.get('stages', {}).items():
+            buckets = self.histograms.setdefault(stage, [0] * len(LATENCY_BUCKETS))
+            buckets[bisect.bisect_left(LATENCY_BUCKETS, timing['duration'])] += 1
+            self.latency_sums[stage] = self.latency_sums.get(stage, 0) + timing['duration']
+            key = (stage, timing['outcome'])
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+            key = (stage, result.get('CPC_class'), timing['outcome'])
+            self.CPC_outcomes[key] = self.CPC_outcomes.get(key, 0) + 1
+            self.bytes_downloaded += timing.get('bytes', 0)
+        if self.path is not None and time.time() - self.last_export >= self.interval:
+            self.export()
+
+    def patents_per_minute(self):
+        return sum(self.statuses.values()) / max(time.time() - self.start_time, 1e-9) * 60
+
+    def quantile(self, stage, q):
+        ''' Estimates a latency quantile of a stage from its histogram (upper bound of the bucket containing it). '''
+        buckets = self.histograms[stage]
+        target = q * sum(buckets)
+        count = 0
+        for bound, n in zip(LATENCY_BUCKETS, buckets):
+            count += n
+            if count >= target:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def snapshot(self):
+        ''' Returns the current metrics as a JSON-serializable dictionary. '''
+        return {
+            'time': time.time(),
+            'role': self.role,
+            'elapsed': time.time() - self.start_time,
+            'statuses': self.statuses,
+            'patents_per_minute': self.patents_per_minute(),
+            'bytes_downloaded': self.bytes_downloaded,
+            'stages': {stage: {
+                'count': sum(buckets),
+                'latency_sum': self.latency_sums[stage],
+                'p50': self.quantile(stage, 0.5),
+                'p95': self.quantile(stage, 0.95),
+                'buckets': dict(zip(map(str, LATENCY_BUCKETS), buckets)),
+                'outcomes': {outcome: n for (s, outcome), n in self.outcomes.items() if s == stage},
+            } for stage, buckets in self.histograms.items()},
+            'CPC_outcomes': [{'stage': stage, 'CPC_class': CPC, 'outcome': outcome, 'count': n}
+                             for (stage, CPC, outcome), n in self.CPC_outcomes.items()],
+        }
+
+    def prometheus_text(self):
+        ''' Returns the metrics in the Prometheus text exposition format. '''
+        role = self.role
+        lines = ['# TYPE patent_scraper_stage_seconds histogram']
+        for stage, buckets in self.histograms.items():
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, buckets):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'patent_scraper_stage_seconds_bucket{{role="{role}",stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'patent_scraper_stage_seconds_sum{{role="{role}",stage="{stage}"}} {self.latency_sums[stage]}')
+            lines.append(f'patent_scraper_stage_seconds_count{{role="{role}",stage="{stage}"}} {cumulative}')
+        lines.append('# TYPE patent_scraper_stage_total counter')
+        for (stage, CPC, outcome), n in self.CPC_outcomes.items():
+            lines.append(f'patent_scraper_stage_total{{role="{role}",stage="{stage}",CPC_class="{CPC}",outcome="{outcome}"}} {n}')
+        lines.append('# TYPE patent_scraper_results_total counter')
+        for status, n in self.statuses.items():
+            lines.append(f'patent_scraper_results_total{{role="{role}",status="{status}"}} {n}')
+        lines.append('# TYPE patent_scraper_downloaded_bytes_total counter')
+        lines.append(f'patent_scraper_downloaded_bytes_total{{role="{role}"}} {self.bytes_downloaded}')
+        lines.append('# TYPE patent_scraper_patents_per_minute gauge')
+        lines.append(f'patent_scraper_patents_per_minute{{role="{role}"}} {self.patents_per_minute()}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        ''' Appends a JSON snapshot to the metrics file, or rewrites the Prometheus textfile atomically. '''
+        self.last_export = time.time()
+        metrics_dir = os.path.dirname(self.path)
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+        if self.path.endswith('.prom'):
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+    def summary(self):
+        ''' Returns a printable table of the results and of the latency and outcomes of each stage. '''
+        total = sum(self.statuses.values())
+        lines = [f'{total} {self.role} patents in {(time.time() - self.start_time) / 60:.1f} min '
+                 f'({self.patents_per_minute():.1f}/min), {self.bytes_downloaded / 1024 ** 2:.1f} MB downloaded. '
+                 + ', '.join(f'{status}: {n}' for status, n in sorted(self.statuses.items())),
+                 f"{'Stage':<20}{'Count':>8}{'Mean (s)':>10}{'p50 (s)':>9}{'p95 (s)':>9}  Outcomes"]
+        for stage, buckets in sorted(self.histograms.items(), key=lambda item: -self.latency_sums[item[0]]):
+            count = sum(buckets)
+            outcomes = ', '.join(f'{outcome}: {n}' for (s, outcome), n in sorted(self.outcomes.items()) if s == stage)
+            lines.append(f'{stage:<20}{count:>8}{self.latency_sums[stage] / count:>10.2f}'
+                         f'{self.quantile(stage, 0.5):>9}{self.quantile(stage, 0.95):>9}  {outcomes}')
+        return '\n'.join(lines)
+
+    def close(self):
+        ''' Exports the final metrics and prints the summary of the run. '''
+        if self.path is not None:
+            self.export()
+        print(self.summary())
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import socket
+import zstandard as zstd
+
+
+# Shards are rotated once they reach this size.
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+
+
+
+def shard_index_path(shard_path):
+    ''' Returns the path of the offset index of a shard (one JSON line per page). '''
+    return f'{os.path.splitext(shard_path)[0]}.idx'
+
+
+
+def _copy_rank(entry):
+    ''' Rank of an archived copy of a page: the served HTML before the rendered DOM, then the most recent. '''
+    return entry['source'] != 'rendered', entry['fetched_at']
+
+
+
+def load_archive_index(archive_dir):
+    '''
+    Loads the offset indexes of every shard of the archive.
+    Returns a dictionary {patent_ID: {'shard', 'offset', 'length', 'url', 'fetched_at', 'source'}}; when a page was archived
+    more than once, the most recent copy of the served HTML is kept over the rendered ones (see PageArchiveWriter.add()).
+    '''
+    index = {}
+    if not os.path.isdir(archive_dir):
+        return index
+    for filename in sorted(os.listdir(archive_dir)):
+        if not filename.endswith('.idx'):
+            continue
+        shard = f'{os.path.splitext(filename)[0]}.zst'
+        with open(os.path.join(archive_dir, filename), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # Line truncated by a crash while it was written
+                entry['shard'] = shard
+                # Entries written before the source was recorded are of unknown source
+                entry.setdefault('source', 'unknown')
+                previous = index.get(entry['patent_ID'])
+                if previous is None or _copy_rank(previous) <= _copy_rank(entry):
+                    index[entry['patent_ID']] = entry
+    return index
+
+
+
+class PageArchiveWriter:
+    '''
+    Appends the HTML of fetched patent pages to packed shard files, each page compressed as an independent
+    zstd frame, and records its (offset, length) in the index file of the shard.
+    Every writer (one per worker process) owns its shards, so no locking is needed between processes.
+    The source of each page is recorded: the HTML served by Google ('served'), which the parsers of reextract.py read,
+    or the DOM rendered by the browser ('rendered'), kept only until the served HTML of the patent is archived.
+    '''
+    def __init__(self, archive_dir, shard_size=DEFAULT_SHARD_SIZE, level=10):
+        self.archive_dir = archive_dir
+        self.shard_size = shard_size
+        self.compressor = zstd.ZstdCompressor(level=level)
+        self.archived = {patent_ID: entry['source'] for patent_ID, entry in load_archive_index(archive_dir).items()}
+        self.shard_prefix = f'pages-{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+        self.n_shard = 0
+        self.shard = None
+        self.index = None
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def _open_shard(self):
+        shard_path = os.path.join(self.archive_dir, f'{self.shard_prefix}-{self.n_shard:05d}.zst')
+        self.shard = open(shard_path, 'ab')
+        self.index = open(shard_index_path(shard_path), 'a')
+        self.n_shard += 1
+
+    def add(self, patent_ID, url, page_html, source='served'):
+        '''
+        Archives the HTML of a patent page and its source ('served' or 'rendered'), unless the page of this patent
+        is already in the archive (a rendered page is replaced by the served one). Returns True if the page was written.
+        '''
+        if not page_html or patent_ID in self.archived and (self.archived[patent_ID] != 'rendered' or source == 'rendered'):
+            return False
+        if self.shard is None or self.shard.tell() >= self.shard_size:
+            self.close()
+            self._open_shard()
+
+        data = self.compressor.compress(page_html.encode('utf-8'))
+        offset = self.shard.tell()
+        self.shard.write(data)
+        self.shard.flush()
+        # The index entry is written after the data, so an indexed page is always complete
+        entry = {'patent_ID': patent_ID, 'url': url, 'offset': offset, 'length': len(data), 'fetched_at': time.time(), 'source': source}
+        self.index.write(json.dumps(entry) + '\n')
+        self.index.flush()
+        self.archived[patent_ID] = source
+        return True
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.index.close()
+            self.shard = None
+            self.index = None
+
+
+
+class PageArchive:
+    ''' Read access to the archived HTML pages, by patent ID or shard by shard. '''
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.index = load_archive_index(archive_dir)
+        self.decompressor = zstd.ZstdDecompressor()
+
+    def __contains__(self, patent_ID):
+        return patent_ID in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, patent_ID):
+        ''' Returns the archived HTML of a patent, or None if it is not in the archive. '''
+        entry = self.index.get(patent_ID)
+        if entry is None:
+            return None
+        with open(os.path.join(self.archive_dir, entry['shard']), 'rb') as f:
+            f.seek(entry['offset'])
+            return self.decompressor.decompress(f.read(entry['length'])).decode('utf-8')
+
+    def entries_by_shard(self):
+        ''' Groups the index entries by shard, sorted by offset, for sequential reads of each shard. '''
+        shards = {}
+        for entry in self.index.values():
+            shards.setdefault(entry['shard'], []).append(entry)
+        return {shard: sorted(entries, key=lambda entry: entry['offset']) for shard, entries in shards.items()}
+
+
+
+def read_shard_pages(archive_dir, shard, entries):
+    '''
+    Reads the pages listed in entries from a single shard with one sequential pass.
+    Yields (entry, page_html) for every page.
+    '''
+    decompressor = zstd.ZstdDecompressor()
+    with open(os.path.join(archive_dir, shard), 'rb') as f:
+        for entry in entries:
+            f.seek(entry['offset'])
+            yield entry, decompressor.decompress(f.read(entry['length'])).decode('utf-8')
@@ -0,0 +1,119 @@
+import os
+import re
+import json
+
+
+# Fields of a patent that do not depend on the query citing it or on its CPC class.
+STORE_FIELDS = ['title', 'abstract', 'CPC_class', 'first_claim', 'front_img', 'citations_by_examiner', 'citations']
+# Fields of the store filled by each field extracted from the page (see PATENT_FIELDS). The URL of the front image is
+# also stored, so that a patent missing only its image is completed with a download, without loading the page again.
+PAGE_TO_STORE_FIELDS = {
+    'abstract': ['abstract'],
+    'citations': ['citations_by_examiner', 'citations'],
+    'title': ['title'],
+    'first_claim': ['first_claim'],
+    'CPC_classes': ['CPC_class'],
+    'front_img_url': ['front_img_url'],
+}
+
+
+
+def normalize_patent_ID(patent_ID):
+    '''
+    Returns the normalized form of a patent ID used as key of the store: no spaces, dashes or slashes, upper case.
+    Example: "US 20240318662 A1" -> "US20240318662A1".
+    '''
+    return re.sub(r'[\s\-/]', '', patent_ID).upper()
+
+
+
+def store_json_path(store_dir, patent_ID):
+    ''' Returns the path of the JSON file of a patent in the store. '''
+    return os.path.join(store_dir, 'json', f'{normalize_patent_ID(patent_ID)}.json')
+
+
+
+def store_img_dir(store_dir):
+    ''' Returns the directory where the front images of the store are saved as <patent_ID>.png. '''
+    return os.path.join(store_dir, 'front_imgs')
+
+
+
+def load_cached_patent(store_dir, patent_ID, required_fields=STORE_FIELDS):
+    '''
+    Returns the stored data of a patent if it exists and has every required field (and its front image,
+    if required), otherwise None. A cache hit means the patent does not have to be fetched again.
+    '''
+    try:
+        with open(store_json_path(store_dir, patent_ID), 'r') as f:
+            patent_data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(patent_data.get(field) is None for field in required_fields):
+        return None
+    if 'front_img' in required_fields and not os.path.exists(patent_data['front_img']):
+        return None
+    return patent_data
+
+
+
+def save_cached_patent(store_dir, patent_ID, patent_data, field_status=None):
+    '''
+    Saves the query-independent fields of a patent in the store, merged with what is already stored.
+    Partial data is kept too: field_status {field: 'ok', 'missing' or 'failed'} records the outcome of the last attempt
+    at each field, and the fields already stored are not fetched again (see missing_fields()).
+    The file is written to a temporary file and renamed, so concurrent workers never read a partial file.
+    '''
+    json_path = store_json_path(store_dir, patent_ID)
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    stored = load_cached_patent(store_dir, patent_ID, required_fields=[]) or {}
+    stored.update({field: patent_data[field] for field in STORE_FIELDS + ['front_img_url'] if patent_data.get(field) is not None})
+    stored['patent_ID'] = normalize_patent_ID(patent_ID)
+    if field_status:
+        stored['field_status'] = dict(stored.get('field_status', {}), **field_status)
+
+    tmp_path = f'{json_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stored, f, indent=2)
+    os.replace(tmp_path, json_path)
+    return stored
+
+
+
+def missing_fields(stored, fields):
+    '''
+    Returns the fields (among fields) that a stored patent (or None) does not have yet:
+    null fields, and the front image if its file does not exist.
+    '''
+    stored = stored or {}
+    return [field for field in fields if stored.get(field) is None or (field == 'front_img' and not os.path.exists(stored['front_img']))]
+
+
+
+def page_fields_to_extract(stored, missing):
+    '''
+    Returns the fields to extract from the page of a patent (keys of PATENT_FIELDS) to fill its missing store fields.
+    A missing front image only needs the page if the URL of the image is not stored.
+    '''
+    stored = stored or {}
+    page_fields = []
+    for page_field, store_fields in PAGE_TO_STORE_FIELDS.items():
+        if any(field in missing for field in store_fields) or (page_field == 'front_img_url' and 'front_img' in missing and not stored.get('front_img_url')):
+            page_fields.append(page_field)
+    return page_fields
+
+
+
+def page_to_store(page, page_fields):
+    '''
+    Converts the fields extracted from a page (as returned by extract_patent()) into store fields,
+    with the status of each: 'ok' if it was extracted, 'missing' otherwise. Returns (patent_data, field_status).
+    '''
+    patent_data, field_status = {}, {}
+    for page_field in page_fields:
+        value = page.get(page_field)
+        values = (list(value) if value else [None, None]) if page_field == 'citations' else [value]
+        for field, field_value in zip(PAGE_TO_STORE_FIELDS[page_field], values):
+            patent_data[field] = field_value
+            field_status[field] = 'ok' if value else 'missing'
+    return patent_data, field_status
@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from html_scraping import setup_session
+from patent_store import normalize_patent_ID
+from rate_limiter import THROTTLE_STATUS_CODES
+from scraping_functions import patent_url, GOOGLE_PATENTS_URL
+
+
+# Shape of a normalized patent ID: country code, optional series (RE, D, PP, ...), number and optional kind code.
+PATENT_ID_PATTERN = re.compile(r'^[A-Z]{2}[A-Z]{0,2}\d{3,}[A-Z]?\d?$')
+# Verdicts that do not change over time and are kept in the cache ('unknown' verdicts are checked again on the next run).
+FINAL_VERDICTS = ('valid', 'malformed', 'not_found', 'not_english')
+# Bytes of the page read to check it: the status code and the final URL are known from the response headers.
+CHECK_READ_BYTES = 1024
+
+
+
+class PatentValidator:
+    '''
+    Pre-flight check of patent IDs before they reach the browser: each ID is normalized, rejected if malformed,
+    then checked with a lightweight HTTP request (only the first bytes of the page are read) on a pool of threads
+    sharing a pooled session. The verdicts are:
+    - 'valid': the English page exists;
+    - 'malformed': not a patent ID, no request is made;
+    - 'not_found': Google Patents answers 404;
+    - 'not_english': the English page redirects to another language;
+    - 'unknown': the check failed (network error, throttling): the patent is scraped as usual.
+    Final verdicts are appended to a JSON lines cache file, so an ID is checked over the network only once per base URL
+    (the verdicts of another server, e.g. the stand-in of benchmark_server.py, are ignored).
+    When a rate limiter is given, every request waits for its token and reports its outcome.
+    '''
+    def __init__(self, cache_path=None, base_url=GOOGLE_PATENTS_URL, workers=16, limiter=None, timeout=10):
+        self.cache_path = cache_path
+        self.base_url = base_url
+        self.limiter = limiter
+        self.timeout = timeout
+        self.session = setup_session(pool_size=workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.verdicts = {} # normalized patent ID -> verdict, for base_url
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Partial last line of an interrupted run
+                    # Entries written before the base URL was recorded are verdicts of Google Patents
+                    if entry.get('base_url', GOOGLE_PATENTS_URL).rstrip('/') == base_url.rstrip('/'):
+                        self.verdicts[entry['patent_ID']] = entry['verdict']
+
+    def check(self, patent_ID):
+        ''' Checks a normalized patent ID over the network and returns its verdict. '''
+        if self.limiter is not None:
+            self.limiter.acquire()
+        url = patent_url(patent_ID, self.base_url)
+        try:
+            with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                next(response.iter_content(CHECK_READ_BYTES), None)
+        except Exception:
+            if self.limiter is not None:
+                self.limiter.report('error')
+            return 'unknown'
+        if response.status_code in THROTTLE_STATUS_CODES:
+            if self.limiter is not None:
+                self.limiter.report('throttled')
+            return 'unknown'
+        if self.limiter is not None:
+            self.limiter.report('ok')
+        if response.status_code in (404, 410):
+            return 'not_found'
+        if not response.ok:
+            return 'unknown'
+        # /patent/<ID>/en redirects to the original language when there is no English version
+        path = urlparse(response.url).path.rstrip('/').split('/')
+        if len(path) >= 4 and path[-1] != 'en':
+            return 'not_english'
+        return 'valid'
+
+    def validate(self, patent_IDs):
+        '''
+        Returns the verdict of each patent ID {patent_ID: verdict}: from the cache, from the shape of the ID,
+        or from concurrent checks of the IDs not seen before.
+        '''
+        normalized = {patent_ID: normalize_patent_ID(patent_ID) for patent_ID in patent_IDs}
+        to_check = []
+        for patent_ID in dict.fromkeys(normalized.values()):
+            if patent_ID in self.verdicts:
+                continue
+            if not PATENT_ID_PATTERN.match(patent_ID):
+                self._remember(patent_ID, 'malformed')
+            else:
+                to_check.append(patent_ID)
+
+        if to_check:
+            start_time = time.time()
+            for patent_ID, verdict in zip(to_check, self.executor.map(self.check, to_check)):
+                self._remember(patent_ID, verdict)
+            print(f'Validated {len(to_check)} patent IDs in {time.time() - start_time:.1f} s.')
+        return {patent_ID: self.verdicts.get(normalized_ID, 'unknown') for patent_ID, normalized_ID in normalized.items()}
+
+    def _remember(self, patent_ID, verdict):
+        if verdict not in FINAL_VERDICTS:
+            return
+        self.verdicts[patent_ID] = verdict
+        if self.cache_path:
+            with open(self.cache_path, 'a') as f:
+                f.write(json.dumps({'patent_ID': patent_ID, 'base_url': self.base_url, 'verdict': verdict, 'time': time.time()}) + '\n')
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import fcntl
+
+
+# Text of the pages Google serves instead of a patent when it throttles a client (captcha / unusual traffic interstitials).
+THROTTLE_MARKERS = ['Our systems have detected unusual traffic', 'www.google.com/sorry/', 'g-recaptcha', 'id="captcha-form"']
+# HTTP status codes returned to throttled clients.
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+
+def is_throttled_page(page_html, url=None):
+    ''' Returns True if a page (or the URL it was redirected to) is a throttling interstitial instead of a patent page. '''
+    if url and '/sorry/' in url:
+        return True
+    return bool(page_html) and any(marker in page_html for marker in THROTTLE_MARKERS)
+
+
+
+class ThrottledError(Exception):
+    ''' Raised when Google answers a request with a throttling status code or interstitial page. '''
+
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by every process of the node through a small state file, locked with flock() on every update.
+    The refill rate (requests per second) adapts with AIMD: every healthy response increases it additively,
+    while a throttled response (or an error rate above error_threshold) cuts it multiplicatively, at most once
+    per cooldown seconds since many workers see the same throttling. A throttled response also blocks
+    every process for a backoff that doubles with each consecutive throttle (up to max_backoff).
+    '''
+    def __init__(self, state_path, initial_rate=1.0, min_rate=0.05, max_rate=10.0, burst=2.0, increase=0.02, decrease=0.5,
+                 cooldown=30, backoff=60, max_backoff=3600, error_threshold=0.2, error_smoothing=0.05):
+        self.state_path = state_path
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.error_threshold = error_threshold
+        self.error_smoothing = error_smoothing
+        state_dir = os.path.dirname(state_path)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _update(self, update):
+        '''
+        Applies update(state, now) to the shared state while holding the file lock, and returns its result.
+        The tokens are refilled at the current rate before every update.
+        '''
+        with open(self.state_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {'rate': self.initial_rate, 'tokens': self.burst, 'updated': time.time(),
+                             'blocked_until': 0, 'throttle_streak': 0, 'last_decrease': 0, 'error_rate': 0}
+                now = time.time()
+                state['tokens'] = min(self.burst, state['tokens'] + state['rate'] * max(0, now - state['updated']))
+                state['updated'] = now
+                value = update(state, now)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return value
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self):
+        ''' Blocks until a request may be sent to Google. Returns the time waited in seconds. '''
+        def take_token(state, now):
+            if now < state['blocked_until']:
+                return state['blocked_until'] - now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0
+            return (1 - state['tokens']) / state['rate']
+
+        waited = 0
+        while True:
+            wait = self._update(take_token)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def report(self, outcome):
+        ''' Adapts the shared rate to the outcome of a request: 'ok', 'error' or 'throttled'. '''
+        def adapt(state, now):
+            state['error_rate'] += self.error_smoothing * ((outcome != 'ok') - state['error_rate'])
+            can_decrease = now - state['last_decrease'] >= self.cooldown
+            if outcome == 'throttled':
+                if can_decrease:
+                    state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                    state['last_decrease'] = now
+                    state['throttle_streak'] += 1
+                    backoff = min(self.max_backoff, self.backoff * 2 ** (state['throttle_streak'] - 1))
+                    state['blocked_until'] = max(state['blocked_until'], now + backoff)
+                    print(f"Throttled by Google: rate lowered to {state['rate']:.2f} requests/s, pausing for {backoff:.0f} s.")
+            elif state['error_rate'] > self.error_threshold:
+                if can_decrease:
+                    state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                    state['last_decrease'] = now
+            elif outcome == 'ok':
+                state['throttle_streak'] = 0
+                state['rate'] = min(self.max_rate, state['rate'] + self.increase)
+            return state['rate']
+
+        return self._update(adapt)
@@ -0,0 +1,58 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from page_archive import PageArchive, read_shard_pages
+from html_scraping import parse_patent_html
+from scraping_functions import PATENT_FIELDS
+
+
+def reextract_shard(archive_dir, shard, entries, fields):
+    """
+    Runs the HTML field extractors over every page of one archive shard, without any network access.
+    Returns the list of extracted records, one per page.
+    """
+    records = []
+    for entry, page_html in read_shard_pages(archive_dir, shard, entries):
+        page = parse_patent_html(page_html, entry['url'], fields)
+        if page is None:
+            page = {'url': entry['url'], 'missing': list(fields)}
+        page['patent_ID'] = entry['patent_ID']
+        records.append(page)
+    return records
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Re-extract patent fields from the raw page archive, offline and in parallel.')
+
+    parser.add_argument('--archive_dir', type=str, default='/vast/marco/Data_Google_Patent/page_archive',
+                        help='Directory of the raw page archive written by the scrapers with --archive_dir.')
+    parser.add_argument('--output', type=str, default='/vast/marco/Data_Google_Patent/reextracted.jsonl',
+                        help='JSON Lines file where the re-extracted records are written (one patent per line).')
+    parser.add_argument('--fields', type=str, nargs='*', default=list(PATENT_FIELDS), choices=list(PATENT_FIELDS),
+                        help='Fields to extract from each page.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes parsing shards in parallel.')
+
+    args = parser.parse_args()
+
+    archive = PageArchive(args.archive_dir)
+    # The parsers read the HTML served by Google: the DOM rendered by the browser (Selenium backend) has another structure
+    shards = {shard: [entry for entry in entries if entry['source'] != 'rendered'] for shard, entries in archive.entries_by_shard().items()}
+    shards = {shard: entries for shard, entries in shards.items() if entries}
+    n_pages = sum(map(len, shards.values()))
+    if n_pages < len(archive):
+        print(f'Skipping {len(archive) - n_pages} pages archived as rendered by the browser.')
+    print(f'Re-extracting {n_pages} pages from {len(shards)} shards with {args.workers} workers')
+
+    n_complete = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor, open(args.output, 'w') as output:
+        futures = [executor.submit(reextract_shard, args.archive_dir, shard, entries, args.fields) for shard, entries in shards.items()]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for record in future.result():
+                output.write(json.dumps(record) + '\n')
+                n_complete += not record['missing']
+
+    print(f'Completed re-extraction: {n_complete}/{n_pages} pages with every field. Records saved to {args.output}')
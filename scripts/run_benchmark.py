@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import subprocess
+from benchmark_server import start_server
+from html_scraping import process_tree_rss
+
+# Directory of the scraper scripts, run as subprocesses exactly as in production.
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+
+def git_commit():
+    ''' Returns the abbreviated hash of the checked-out commit (with a + suffix if the tree has local changes), or None. '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=SCRIPTS_DIR, capture_output=True, text=True).stdout.strip()
+        return f'{commit}+' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def run_scraper(script, arguments, metrics_file):
+    '''
+    Runs a scraper script as a subprocess while sampling the resident memory of its process tree (browsers included).
+    Returns the exit code, the wall time, the peak memory in MB and the last metrics snapshot written by the scraper.
+    '''
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, script), *arguments, '--metrics_file', metrics_file, '--metrics_interval', '3600']
+    start_time = time.time()
+    process = subprocess.Popen(command, cwd=SCRIPTS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    peak_rss = [0]
+
+    def sample_memory():
+        while process.poll() is None:
+            peak_rss[0] = max(peak_rss[0], process_tree_rss(process.pid) or 0)
+            time.sleep(0.2)
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    _, stderr = process.communicate()
+    sampler.join()
+    wall_time = time.time() - start_time
+    if process.returncode != 0:
+        print(stderr[-2000:])
+
+    snapshot = None
+    if os.path.exists(metrics_file):
+        with open(metrics_file, 'r') as f:
+            lines = f.read().splitlines()
+        snapshot = json.loads(lines[-1]) if lines else None
+    return process.returncode, wall_time, peak_rss[0], snapshot
+
+
+
+def benchmark(base_url, work_dir, backend, workers, n_queries, sample_size):
+    '''
+    Scrapes n_queries fixture query patents, then the documents they cite, from the stand-in server with a backend
+    and a number of worker processes, starting from empty outputs. Returns one result per phase (query, document).
+    '''
+    run_dir = os.path.join(work_dir, f'{backend}-{workers}')
+    CPC_dir = os.path.join(run_dir, 'CPC_class')
+    os.makedirs(CPC_dir)
+    with open(os.path.join(CPC_dir, 'B00X1.txt'), 'w') as f:
+        f.write('\n'.join(f'US{1000000 + i}B2' for i in range(n_queries)) + '\n')
+
+    common = ['--backend', backend, '--workers', str(workers), '--base_url', base_url, '--rate_limit_file', '',
+              '--ledger', os.path.join(run_dir, 'ledger.sqlite'), '--store_dir', os.path.join(run_dir, 'store')]
+    phases = [
+        ('query', 'scrape_query_patents.py', ['--CPC_class_dir', CPC_dir, '--json_dir_output', os.path.join(run_dir, 'json', 'query'),
+                                              '--front_imgs_dir_output', os.path.join(run_dir, 'front_imgs', 'query'),
+                                              '--validation_cache', os.path.join(run_dir, 'validation_cache.jsonl')]),
+        ('document', 'scrape_document_patents.py', ['--json_dir_input', os.path.join(run_dir, 'json', 'query'),
+                                                    '--json_dir_output', os.path.join(run_dir, 'json', 'document'), '--sample_size', str(sample_size)]),
+    ]
+    results = []
+    for role, script, arguments in phases:
+        returncode, wall_time, peak_rss, snapshot = run_scraper(script, arguments + common, os.path.join(run_dir, f'metrics-{role}.jsonl'))
+        n_done = (snapshot or {}).get('statuses', {}).get('done', 0)
+        results.append({
+            'role': role,
+            'backend': backend,
+            'workers': workers,
+            'returncode': returncode,
+            'wall_time': wall_time,
+            'patents_done': n_done,
+            'patents_per_second': n_done / wall_time,
+            'peak_rss_mb': peak_rss,
+            'statuses': (snapshot or {}).get('statuses', {}),
+            'stages': {stage: {'p50': timing['p50'], 'p95': timing['p95'], 'count': timing['count']}
+                       for stage, timing in (snapshot or {}).get('stages', {}).items()},
+        })
+        if returncode != 0:
+            break # The document phase needs the query records
+    return results
+
+
+
+def previous_results(results_file, commit):
+    ''' Returns the results of the latest other commit in the results file, keyed by (role, backend, workers). '''
+    previous = {}
+    if not os.path.exists(results_file):
+        return previous
+    with open(results_file, 'r') as f:
+        for line in f:
+            result = json.loads(line)
+            if result.get('commit') != commit:
+                previous[(result['role'], result['backend'], result['workers'])] = result
+    return previous
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the scrapers offline against the stand-in patent server of benchmark_server.py.')
+
+    parser.add_argument('--backends', type=str, nargs='*', default=['html', 'selenium'], choices=['html', 'selenium'],
+                        help='Backends to benchmark.')
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 4],
+                        help='Numbers of worker processes to benchmark.')
+    parser.add_argument('--n_queries', type=int, default=50, help='Number of query patents scraped by each run.')
+    parser.add_argument('--sample_size', type=int, default=5, help='Number of documents scraped for each query.')
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean latency of the server responses in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Standard deviation of the latency in seconds.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of the requests answered with HTTP 500.')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='Fraction of the requests answered with HTTP 429.')
+    parser.add_argument('--results_file', type=str, default='benchmark_results.jsonl',
+                        help='JSON lines file where the results of every run are appended, to compare them across commits.')
+
+    args = parser.parse_args()
+
+    server = start_server(0, args.latency, args.jitter, args.error_rate, args.throttle_rate)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    commit = git_commit()
+    previous = previous_results(args.results_file, commit)
+    work_dir = tempfile.mkdtemp(prefix='patent_benchmark_')
+    config = {'n_queries': args.n_queries, 'sample_size': args.sample_size, 'latency': args.latency, 'jitter': args.jitter,
+              'error_rate': args.error_rate, 'throttle_rate': args.throttle_rate}
+
+    try:
+        with open(args.results_file, 'a') as results_file:
+            for backend in args.backends:
+                for workers in args.workers:
+                    print(f'\nBenchmarking backend: {backend}, workers: {workers} ...')
+                    for result in benchmark(base_url, work_dir, backend, workers, args.n_queries, args.sample_size):
+                        result.update(config, commit=commit, time=time.time())
+                        results_file.write(json.dumps(result) + '\n')
+                        results_file.flush()
+
+                        before = previous.get((result['role'], backend, workers))
+                        change = f" ({(result['patents_per_second'] / before['patents_per_second'] - 1) * 100:+.0f}% vs {before['commit']})" \
+                            if before and before['patents_per_second'] else ''
+                        print(f"{result['role']:<9} {result['patents_per_second']:.2f} patents/s{change}, "
+                              f"peak memory {result['peak_rss_mb']:.0f} MB, exit code {result['returncode']}")
+                        for stage, timing in sorted(result['stages'].items()):
+                            print(f"    {stage:<20} p50 {timing['p50']:>6} s   p95 {timing['p95']:>6} s")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
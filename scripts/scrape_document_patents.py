@@ -1,117 +1,329 @@
 import os
-import json
+import time
 import argparse
-from scraping_functions import setup_driver, get_title, get_abstract, get_CPC_classes, get_first_claim, download_img
+from functools import partial
+from contextlib import contextmanager, nullcontext
+from tqdm import tqdm
+from scraping_functions import failed_stage, patent_url, GOOGLE_PATENTS_URL
+from html_scraping import extract_patent
+from worker_pool import WorkerPool, scraping_context
+from dataset_io import iter_records, setup_sink
+from scrape_ledger import node_ledger_path, open_and_load_ledger, load_ledger, apply_repair_list, index_documents_by_query, skip_reason, record_result, remember_result
+from patent_store import normalize_patent_ID, load_cached_patent, save_cached_patent, store_img_dir, missing_fields, page_fields_to_extract, page_to_store
+from metrics import Metrics
+from work_leases import WorkQueue, DEFAULT_LEASE_TTL
 import random
 
-def scrape_documents_from_query(json_file_path, front_imgs_dir_output, json_dir_output, sample_size=5): 
+# Fields a stored patent must have to be reused as a document patent (citations are only needed for query patents),
+# unless the acceptance policy makes them optional
+DOCUMENT_STORE_FIELDS = ['title', 'abstract', 'CPC_class', 'first_claim', 'front_img']
+
+def fetch_document_patent(patent_ID, query_ID, CPC_class, store_dir, context):
+    """
+    Fetch the data and front image of a document patent into the global patent store (or find it there),
+    without linking it to the query: the caller decides whether the document belongs to the sample of the query.
+    The fields extracted by a failed attempt stay in the store, so a retry only fetches the missing fields
+    (e.g. only the image download, when the front image URL is known).
+
+    Parameters: see scrape_document_patent().
+
+    Returns the result of scrape_document_patent(), with the stored data of the patent under 'stored' (None if it failed).
+    """
+    url = patent_url(patent_ID, context['base_url']) # Construct the Google Patents URL for the specific patent
+    doc_ID = f'{query_ID}_{patent_ID}'
+    result = {'patent_ID': patent_ID, 'query_ID': query_ID, 'CPC_class': CPC_class, 'status': 'failed', 'stage': None, 'cached': False, 'stored': None}
+    start_time = time.time()
+
+    # Fields the document cannot be accepted without (the others are fetched, but optional)
+    required_fields = [field for field in DOCUMENT_STORE_FIELDS if field not in context['optional_fields']]
+
+    # Look for the patent in the store first: a cache hit skips the network completely.
+    # The store also keeps the fields of failed attempts, so only the missing ones are fetched again.
+    stored = load_cached_patent(store_dir, patent_ID, required_fields=[])
+    if not missing_fields(stored, required_fields):
+        result['cached'] = True
+    else:
+        missing = missing_fields(stored, DOCUMENT_STORE_FIELDS)
+        page_fields = page_fields_to_extract(stored, missing)
+        result['stages'] = {}
+        if page_fields:
+            # Navigate once and extract the missing fields from the same rendered page
+            page = extract_patent(url, context['driver'], context['session'], fields=page_fields, keep_html=context['archive'] is not None,
+                                  limiter=context['limiter'], archive_session=context['archive_session'])
+            result['stages'] = page['stages']
+            if context['archive'] is not None:
+                context['archive'].add(normalize_patent_ID(patent_ID), url, page.get('html'), page.get('html_source'))
+            if page['throttled']:
+                # Not a failure of the patent: it is retried when resuming, without counting towards max_attempts
+                print(f"{doc_ID} from: {url} not scraped: throttled by Google.")
+                result['status'] = result['stage'] = 'throttled'
+                result['duration'] = time.time() - start_time
+                return result
+            # Keep what was extracted even if some fields are missing
+            stored = save_cached_patent(store_dir, patent_ID, *page_to_store(page, page_fields))
+        if 'front_img' in missing and stored.get('front_img_url'):
+            # Downloaded synchronously: whether the document counts towards the sample of the query depends on it
+            front_img_path = context['images'].download(stored['front_img_url'], normalize_patent_ID(patent_ID), store_img_dir(store_dir), result['stages'])
+            stored = save_cached_patent(store_dir, patent_ID, {'front_img': front_img_path}, {'front_img': 'ok' if front_img_path else 'failed'})
+        missing = missing_fields(stored, required_fields)
+        if missing:
+            result['stage'] = failed_stage(page_fields_to_extract(stored, missing)) or 'download_img'
+            stored = None
+
+    if stored is not None:
+        result['status'] = 'done'
+        result['stored'] = stored
+    else:
+        print(f"Stopping execution due to failure in {result['stage']}().")
+        print(f"{doc_ID} from: {url} not succesfully scraped due to an earlier failure.")
+
+    result['duration'] = time.time() - start_time
+    return result
+
+
+def link_document_patent(sink, result):
+    """
+    Write the record of a document patent fetched by fetch_document_patent() for its query to the output sink
+    (a JSON file or a JSON lines shard).
+    """
+    stored = result['stored']
+    document_patent_data = {
+        "type": "document",
+        "patent_ID": result['patent_ID'],
+        "query_ID": result['query_ID'],
+        "cls": result['CPC_class'],
+        "title": stored.get('title'),
+        "abstract": stored.get('abstract'),
+        "CPC_class": stored.get('CPC_class'),
+        "first_claim": stored.get('first_claim'),
+        "front_img": stored.get('front_img') # Fields made optional by the acceptance policy may be null
+    }
+    doc_ID = f"{result['query_ID']}_{result['patent_ID']}"
+    sink.write(document_patent_data, doc_ID)
+    print(f"{doc_ID} successfully scraped{' (from store)' if result['cached'] else ''}.")
+
+
+def scrape_document_patent(patent_ID, query_ID, CPC_class, store_dir, context):
+    """
+    Scrape the patent data of a single document patent cited by a query patent and write it to the output sink of the scraping context.
+    Document patents are cited by many queries: their data and front image are kept in a global store keyed by patent_ID,
+    and a patent already in the store is linked to the query without fetching it again.
+
+    Parameters:
+    - patent_ID (str): The patent ID of the document patent.
+    - query_ID (str): The ID of the query patent citing the document.
+    - CPC_class (str): The CPC class of the query patent.
+    - store_dir (str): Directory of the global patent store (JSON data and front images keyed by patent_ID).
+    - context (dict): Scraping resources created by setup_scraping_context(): the WebDriver, the HTTP session
+      of the HTML backend (or None), the writer of the raw page archive (or None), the output sink
+      and the acceptance policy (the optional fields a document can be linked without).
+
+    Returns a dictionary with the patent_ID, the query_ID, the CPC_class, the status of the document ('done', 'failed' or 'throttled'),
+    the failing stage, whether it was served from the store (cached), the duration of the attempt in seconds
+    and the timings of its stages (see metrics.py).
     """
-    Scrape patent documents based on citations from the specified JSON file.
-    
+    result = fetch_document_patent(patent_ID, query_ID, CPC_class, store_dir, context)
+    if result['status'] == 'done':
+        link_document_patent(context['sink'], result)
+    return result
+
+
+def shuffled_citations(query_data):
+    """ Returns the citations by examiner of a query in the fixed random order in which they are sampled (seed 1999). """
+    citations_list = list(query_data.get('citations_by_examiner')) # Retrieve the list of patent IDs cited by the examiner.
+    random.Random(1999).shuffle(citations_list) # shuflle the citations lists to iterate randomly over the citation list
+    return citations_list
+
+
+def scrape_documents_from_query(query_data, store_dir, context, sample_size=5, ledger_entries=None, max_attempts=1, on_result=None):
+    """
+    Scrape patent documents based on the citations of a query patent.
+
     Parameters:
-    - json_file_path (str): The path to the input JSON file containing patent data of a query patent.
-    - front_imgs_dir_output (str): Directory where front images of document patents will be saved.
-    - json_dir_output (str): Directory where patent data of the document patents  will be saved as a JSON file.
+    - query_data (dict): The record of the query patent, as written by scrape_query_patents.py.
+    - store_dir (str): Directory of the global patent store, where the data and front images of the document patents are kept.
+    - context (dict): Scraping resources created by setup_scraping_context().
     - sample_size (int): number of documents to be scraped from the citation list of the query
+    - ledger_entries (dict): Ledger entries of the documents of this query {patent_ID: entry}, used to skip
+      documents already scraped or that failed max_attempts times.
+    - max_attempts (int): Number of failed attempts after which a document is no longer retried.
+    - on_result (callable): Called with the result of every document scraping attempt (e.g. to record it in the ledger).
 
-    This function reads patent query data from a JSON file, extracts citation information.
+    This function extracts citation information from the query record.
     Then, for each cited patent (document patentens), it scrapes patent data and downloads the corresponding front image.
+    Returns the number of successfully scraped documents.
     """
 
-    # Determine the CPC class of the corresponding query from the directory structure of the JSON file path
-    CPC_class = os.path.dirname(json_file_path).split(os.path.sep)[-1]
-    
-    # Create the output directory for JSON files based on the CPC class
-    json_dir_CPC = os.path.join(json_dir_output, CPC_class)
-    os.makedirs(json_dir_CPC, exist_ok=True)
-    front_imgs_dir_CPC = os.path.join(front_imgs_dir_output, CPC_class)
-    os.makedirs(front_imgs_dir_CPC, exist_ok=True)
-
-    # Initialize WebDriver
-    driver = setup_driver()  
-    
-    # Open the json file for the patent query
-    with open(json_file_path, 'r') as file:
-        query_ID = os.path.splitext(os.path.basename(json_file_path))[0]
-        query_data = json.load(file)
-        citations_list = query_data.get('citations_by_examiner') # Retrieve the list of patent IDs cited by the examiner.
-        print(f'\nScraping query: {query_ID} ...')
-
-        # Check if citations list is not empty
-        if len(citations_list) >= sample_size: # either 0 or sample_size
-            random.seed(1999) 
-            random.shuffle(citations_list) # shuflle the citations lists to iterate randomly over the citation list
-            scraped_count = 0 # initialize counter for successfully scraped patents
-
-            # Iterate over each patent ID in the citations list
-            for patent_ID in citations_list:
-                url = f"https://patents.google.com/patent/{patent_ID}/en?oq={patent_ID}" # Construct the Google Patents URL for the specific patent
-                doc_ID = f'{query_ID}_{patent_ID}'
-                json_filepath = os.path.join(json_dir_CPC, f'{doc_ID}.json') # Define the filename path for the output JSON file based on the patent ID
-
-                # Ensure patent ID has not been scraped yet
-                if os.path.exists(json_filepath):
-                    print(f"{doc_ID} already scraped.")
-                    scraped_count += 1
-                    continue
+    # The CPC class and the query ID of the query patent
+    CPC_class = query_data['cls']
+    query_ID = f"{CPC_class}_{query_data['patent_ID']}"
+    citations_list = shuffled_citations(query_data)
+    print(f'\nScraping query: {query_ID} ...')
+
+    scraped_count = 0 # initialize counter for successfully scraped patents
+
+    # Check if citations list is not empty
+    if len(citations_list) >= sample_size: # either 0 or sample_size
+        # Iterate over each patent ID in the citations list
+        for patent_ID in citations_list:
+            # Ensure patent ID has not been scraped yet (or failed too many times)
+            reason = skip_reason((ledger_entries or {}).get(patent_ID), max_attempts)
+            if reason == 'done':
+                print(f"{query_ID}_{patent_ID} already scraped.")
+                scraped_count += 1
+                continue
+            if reason == 'failed':
+                print(f"{query_ID}_{patent_ID} skipped: failed in all the previous {max_attempts} attempts.")
+                continue
+
+            # Necessary when resuming scraping
+            if scraped_count >= sample_size:
+                print(f"Successfully scraped {scraped_count} patents, stopping further scraping for this query.")
+                break
 
-                # Necessary when resuming scraping
-                if scraped_count >= sample_size:
+            result = scrape_document_patent(patent_ID, query_ID, CPC_class, store_dir, context)
+            if on_result is not None:
+                on_result(result)
+
+            # Stop the query when throttled: it is resumed later from the same candidate, so the sample does not change
+            if result['status'] == 'throttled':
+                print("Throttled by Google, stopping further scraping for this query.")
+                break
+
+            # Increment the scraped count and check if target is reached
+            if result['status'] == 'done':
+                scraped_count += 1
+                if scraped_count == sample_size:
                     print(f"Successfully scraped {scraped_count} patents, stopping further scraping for this query.")
                     break
-                
-                # List of scraping functions with their arguments 
-                scraping_functions = [
-                    (get_abstract, driver, url),
-                    (get_title, driver, url),
-                    (get_CPC_classes, driver, url),
-                    (get_first_claim, driver, url),
-                    (download_img, driver, url, doc_ID, front_imgs_dir_CPC)
-                ]
-
-                results = []
-                for func, *args in scraping_functions:
-                    try:
-                        result = func(*args)
-                        assert result, f"Function: {func.__name__}() failed."
-                        results.append(result)
-                    except Exception as e:
-                        # If any function fails, log the error and break the loop
-                        print(f"Stopping execution due to failure in {func.__name__}().")
-                        break 
-
-                # If all functions succeed, assign results and proceed
-                if len(results) == len(scraping_functions):
-                    abstract, title, CPC_classes, fst_claim, front_img_path = results
-                    document_patent_data = {
-                        "type": "document",
-                        "patent_ID": patent_ID,
-                        "query_ID": query_ID,
-                        "cls": CPC_class,
-                        "title": title,
-                        "abstract": abstract,
-                        "CPC_class": CPC_classes,
-                        "first_claim": fst_claim,
-                        "front_img": front_img_path 
-                    }
-                    # Write the document patent data dictionary to a JSON file
-                    with open(json_filepath, 'w') as json_file:
-                        json.dump(document_patent_data, json_file, indent=2)
-                        print(f"{doc_ID} successfully scraped.")
-                    
-                    # Increment the scraped count and check if target is reached
-                    scraped_count += 1
-                    if scraped_count == sample_size:
-                        print(f"Successfully scraped {scraped_count} patents, stopping further scraping for this query.")
-                        break
+
+        print(f"Scraping completed. Successfully scraped {scraped_count} patents.")
+
+    else:
+        print(f'Scraping completed. Citations by examiner are less than {sample_size} for: {query_ID}')
+        #print(f'Scraping completed. No citations found for: {query_ID}')
+
+    return scraped_count
+
+
+def scrape_document_candidate_item(context, item, store_dir):
+    """
+    Work item handler used by the worker pool: fetches the candidate document item = (query_ID, CPC_class, patent_ID)
+    into the store with the scraping context owned by the worker process. The DocumentSampler of the main process
+    decides whether it joins the sample of the query.
+    """
+    query_ID, CPC_class, patent_ID = item
+    return fetch_document_patent(patent_ID, query_ID, CPC_class, store_dir, context)
+
+
+class DocumentSampler:
+    """
+    Speculative sampling of the documents of the queries with a worker pool. Instead of trying the candidates of a query
+    one at a time, up to sample_size + speculation candidates that may still succeed are fetched concurrently, in the shuffled
+    order of shuffled_citations(). The sample is decided in that order as the outcomes arrive: the first sample_size successes
+    are accepted (exactly those the sequential scrape_documents_from_query() would accept) and linked to the query in the sink.
+    The remaining candidates are cancelled: no new ones are submitted and the outcome of those in flight is ignored
+    (their data stays in the store, so they are cache hits for the other queries citing them).
+
+    - submit (callable): Called with the work items (query_ID, CPC_class, patent_ID) of the candidates to fetch.
+    - sink: Output sink of the document records, written by the main process.
+    """
+    def __init__(self, submit, sink, sample_size=5, speculation=2, max_attempts=1):
+        self.submit = submit
+        self.sink = sink
+        self.sample_size = sample_size
+        self.speculation = speculation
+        self.max_attempts = max_attempts
+        self.queries = {} # query_ID -> sampling state of the queries in progress
+
+    def add_query(self, query_data, ledger_entries=None):
+        """
+        Starts sampling the documents of a query. Returns the finished group if the query needs no fetching
+        (too few citations, or a sample already complete in the ledger), otherwise None.
+        """
+        CPC_class = query_data['cls']
+        query_ID = f"{CPC_class}_{query_data['patent_ID']}"
+        # A patent cited twice is a single candidate (sampling it twice would link the same record twice)
+        order = list(dict.fromkeys(shuffled_citations(query_data)))
+        self.queries[query_ID] = {'CPC_class': CPC_class, 'order': order, 'ledger_entries': ledger_entries or {}, 'outcomes': {},
+                                  'launched': 0, 'decided': 0, 'scraped_count': 0, 'results': []}
+        if len(query_data.get('citations_by_examiner')) < self.sample_size:
+            print(f'Scraping completed. Citations by examiner are less than {self.sample_size} for: {query_ID}')
+            return self._finish(query_ID)
+        return self._advance(query_ID)
+
+    def on_result(self, result):
+        """ Records the outcome of a candidate fetched by a worker. Returns the group of its query if it is now finished, otherwise None. """
+        state = self.queries.get(result['query_ID'])
+        if state is None:
+            return None # Cancelled candidate of a finished query
+        state['outcomes'][result['patent_ID']] = result
+        return self._advance(result['query_ID'])
+
+    def _advance(self, query_ID):
+        state = self.queries[query_ID]
+        order, outcomes = state['order'], state['outcomes']
+        while True:
+            # Decide the candidates in shuffled order, up to the first one still in flight
+            while state['decided'] < state['launched'] and order[state['decided']] in outcomes:
+                outcome = outcomes[order[state['decided']]]
+                state['decided'] += 1
+                if outcome['status'] == 'skipped':
+                    continue
+                if outcome['status'] == 'previous':
+                    state['scraped_count'] += 1
                 else:
-                    print(f"{doc_ID} from: {url} not succesfully scraped due to an earlier failure.")
-            
-            print(f"Scraping completed. Successfully scraped {scraped_count} patents.")  
+                    state['results'].append(outcome)
+                    if outcome['status'] == 'throttled':
+                        # Resumed later from the same candidate, so the sample does not change
+                        print(f"Throttled by Google, stopping further scraping for query {query_ID}.")
+                        return self._finish(query_ID)
+                    if outcome['status'] == 'done':
+                        link_document_patent(self.sink, outcome)
+                        state['scraped_count'] += 1
+                if state['scraped_count'] == self.sample_size:
+                    return self._finish(query_ID)
+            if state['decided'] == len(order):
+                return self._finish(query_ID)
+
+            # Keep sample_size + speculation undecided candidates that may still succeed in flight
+            potential = state['scraped_count'] + sum(outcomes.get(patent_ID, {'status': 'done'})['status'] in ('done', 'previous')
+                                                     for patent_ID in order[state['decided']:state['launched']])
+            if potential >= self.sample_size + self.speculation or state['launched'] == len(order):
+                return None
+            patent_ID = order[state['launched']]
+            state['launched'] += 1
+            reason = skip_reason(state['ledger_entries'].get(patent_ID), self.max_attempts)
+            if reason == 'done':
+                outcomes[patent_ID] = {'status': 'previous'} # Already linked to the query by a previous run
+            elif reason == 'failed':
+                print(f"{query_ID}_{patent_ID} skipped: failed in all the previous {self.max_attempts} attempts.")
+                outcomes[patent_ID] = {'status': 'skipped'}
+            else:
+                self.submit((query_ID, state['CPC_class'], patent_ID))
+
+    def _finish(self, query_ID):
+        state = self.queries.pop(query_ID)
+        print(f"Scraping completed for query {query_ID}. Successfully scraped {state['scraped_count']} patents.")
+        return {'query_ID': query_ID, 'CPC_class': state['CPC_class'], 'scraped_count': state['scraped_count'], 'results': state['results']}
 
-        else:
-            print(f'Scraping completed. Citations by examiner are less than {sample_size} for: {query_ID}')
-            #print(f'Scraping completed. No citations found for: {query_ID}')
+
+
+@contextmanager
+def document_worker_pool(n_workers, store_dir, **context_options):
+    """
+    Starts the worker pool fetching candidate documents (see scrape_document_candidate_item()) and opens the sink
+    where the main process links the sampled documents. Both are kept for the whole run, so the browsers of the workers
+    are started once. Yields (pool, sink) and closes them on exit.
+    """
+    handle_item = partial(scrape_document_candidate_item, store_dir=store_dir)
+    pool = WorkerPool(handle_item, n_workers, **dict(context_options, json_dir_output=None))
+    sink = setup_sink(context_options['json_dir_output'], context_options['output_format'])
+    try:
+        yield pool, sink
+    finally:
+        pool.close()
+        sink.close()
 
 
 if __name__ == "__main__":
@@ -119,28 +331,191 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Scrape document patents associated to query patents and save JSON files.')
 
     parser.add_argument('--json_dir_input', type=str, default='/vast/marco/Data_Google_Patent/json/query',
-                        help='Directory to read JSON files of the query patents.')
-    parser.add_argument('--front_imgs_dir_output', type=str, default='/vast/marco/Data_Google_Patent/front_imgs/document',
-                        help='Directory to save front images of the document patents.')
+                        help='Directory to read the records of the query patents (JSON files or JSON lines shards).')
     parser.add_argument('--json_dir_output', type=str, default='/vast/marco/Data_Google_Patent/json/document',
                         help='Directory to save JSON files of the document patents.')
-    parser.add_argument('--CPC_to_exclude', type=list, default=['A42B3', 'A62B18', 'F04D17', 'F16H1', 'F16L1', 'G02C5','H02K19'],
-                        help="CPC file to exclude when resuming scraping. Example: ['A42B3', 'A62B18', 'F04D17', 'F16H1', 'F16L1', 'G02C5','H02K19']")
-    args = parser.parse_args()  
-
-# Iterate through each CPC directory within the input JSON directory
-for CPC_dir in os.listdir(args.json_dir_input):
-    CPC_dir_path = os.path.join(args.json_dir_input, CPC_dir)
-
-    if CPC_dir in args.CPC_to_exclude:
-        print(f'CPC: {CPC_dir} already scraped.')
-        continue
-    
-    # Iterate through each JSON file in the current CPC directory.
-    print(f'\nStarting scraping for CPC: {CPC_dir} ...')
-    for json_file in os.listdir(CPC_dir_path):
-        json_file_path = os.path.join(CPC_dir_path, json_file)
-        scrape_documents_from_query(json_file_path, args.front_imgs_dir_output, args.json_dir_output)
-    print(f'Completed scraping for CPC: {CPC_dir}')
-
-    
\ No newline at end of file
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'jsonl'],
+                        help="'json' writes one indented JSON file per document; 'jsonl' appends records to size-bounded JSON lines shards per CPC class.")
+    parser.add_argument('--store_dir', type=str, default='/vast/marco/Data_Google_Patent/store',
+                        help='Directory of the global patent store: data and front images of each patent, scraped once and shared by all the queries citing it.')
+    parser.add_argument('--archive_dir', type=str, default=None,
+                        help='Directory of the raw page archive: when given, the served HTML of every fetched page is saved compressed for offline re-extraction '
+                             '(with the selenium backend, it costs one plain HTTP request per page besides the browser).')
+    parser.add_argument('--CPC_to_exclude', type=str, nargs='*', default=[],
+                        help="CPC classes to exclude from scraping. Example: --CPC_to_exclude A42B3 A62B18")
+    parser.add_argument('--backend', type=str, default='selenium', choices=['selenium', 'html'],
+                        help="'selenium' renders every page in headless Firefox; 'html' parses the served HTML and falls back to Selenium only for pages it cannot parse.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes, each with its own WebDriver, scraping queries from a shared queue.')
+    parser.add_argument('--sample_size', type=int, default=5,
+                        help='Number of documents to be scraped from the citations by examiner of each query.')
+    parser.add_argument('--speculation', type=int, default=2,
+                        help='With workers, number of candidate documents fetched concurrently beyond sample_size for each query, '
+                             'so that failing candidates do not delay the sample (the accepted documents do not depend on it).')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='SQLite ledger recording the outcome of every scraped patent, used to resume scraping (default: /vast/marco/Data_Google_Patent/scrape_ledger.sqlite, or with --work_dir a ledger of the node under /tmp).')
+    parser.add_argument('--max_attempts', type=int, default=1,
+                        help='Number of failed attempts after which a document is no longer retried when resuming.')
+    parser.add_argument('--base_url', type=str, default=GOOGLE_PATENTS_URL,
+                        help='Base URL of the patent pages, e.g. the local stand-in server of benchmark_server.py.')
+    parser.add_argument('--rate_limit_file', type=str, default='/tmp/google_patents_rate_limit.json',
+                        help='Local state file of the rate limiter shared by every scraping process of the node (empty string to disable rate limiting).')
+    parser.add_argument('--max_rate', type=float, default=10.0,
+                        help='Maximum number of requests per second to Google Patents; the actual rate adapts to throttling below it.')
+    parser.add_argument('--optional_fields', type=str, nargs='*', default=[], choices=DOCUMENT_STORE_FIELDS,
+                        help="Fields a document is accepted without when they cannot be scraped, e.g. --optional_fields front_img (they are null in its record).")
+    parser.add_argument('--driver_max_pages', type=int, default=500,
+                        help='Number of pages after which the WebDriver of a process is restarted (0 to never restart).')
+    parser.add_argument('--driver_max_rss_mb', type=int, default=2048,
+                        help='Resident memory (MB) of the browser processes above which the WebDriver is restarted (0 to disable).')
+
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Shared directory (e.g. on /vast) distributing the queries between several nodes as leased work units; each node runs the script with the same work directory.')
+    parser.add_argument('--unit_size', type=int, default=50,
+                        help='Number of queries per work unit.')
+    parser.add_argument('--lease_ttl', type=int, default=DEFAULT_LEASE_TTL,
+                        help='Seconds after which the unit of a node that stopped renewing its lease is taken over by another node.')
+
+    parser.add_argument('--repair_list', type=str, default=None,
+                        help='Repair list written by validate_dataset.py: only the broken document patents it lists are scraped again.')
+
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help='File where the per-stage timing metrics are exported periodically: JSON lines, or a Prometheus textfile if it ends with .prom.')
+    parser.add_argument('--metrics_interval', type=int, default=60,
+                        help='Seconds between two exports of the metrics.')
+
+    args = parser.parse_args()
+    if args.repair_list and args.work_dir:
+        parser.error('--repair_list cannot be used with --work_dir: the work units of a finished scrape are already done.')
+    try:
+        args.ledger = node_ledger_path(args.ledger, args.work_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    context_options = {'backend': args.backend, 'archive_dir': args.archive_dir, 'json_dir_output': args.json_dir_output, 'output_format': args.output_format,
+                       'driver_max_pages': args.driver_max_pages, 'driver_max_rss_mb': args.driver_max_rss_mb,
+                       'base_url': args.base_url, 'rate_limit_file': args.rate_limit_file, 'max_rate': args.max_rate, 'optional_fields': args.optional_fields}
+
+    # Load the ledger in bulk once: skip decisions are then dictionary lookups.
+    ledger_conn, ledger = open_and_load_ledger(args.ledger, 'document', args.json_dir_output)
+    repair_queries = None
+    if args.repair_list:
+        # Discard the broken files and forget the ledger entries of the listed documents: their queries are sampled again
+        # from the same shuffled candidates, so the same documents are fetched again
+        repair_queries = {(item['CPC_class'], item['query_ID']) for item in apply_repair_list(args.repair_list, 'document', ledger_conn, args.json_dir_output)}
+        ledger = load_ledger(ledger_conn, 'document')
+    documents_by_query = index_documents_by_query(ledger)
+    metrics = Metrics('document', args.metrics_file, args.metrics_interval)
+
+    def on_result(result):
+        record_result(ledger_conn, 'document', result)
+        # Keep the in-memory entries current: with work units, a query may be scheduled again by this process
+        remember_result(documents_by_query.setdefault((result['CPC_class'], result['query_ID']), {}), result['patent_ID'], result)
+        metrics.record(result)
+
+    def ledger_entries(query_data):
+        return documents_by_query.get((query_data['cls'], f"{query_data['cls']}_{query_data['patent_ID']}"), {})
+
+    def is_query_complete(query_data):
+        # Queries with sample_size documents already scraped are not scheduled again.
+        return sum(entry['status'] == 'done' for entry in ledger_entries(query_data).values()) >= args.sample_size
+
+    def scrape_queries(CPC_queries, context, pool=None, sink=None):
+        # Scrape the documents of a list of queries, with the worker pool (and the sink of this process) or with the scraping context of this process
+        if pool is not None:
+            # Sample the documents speculatively: the candidates are fetched by the workers, the samples decided and linked here
+            sampler = DocumentSampler(pool.submit, sink, args.sample_size, args.speculation, args.max_attempts)
+            queries_iter = iter(CPC_queries)
+            progress = tqdm(total=len(CPC_queries))
+
+            def on_group(group):
+                if group is not None:
+                    for result in group['results']:
+                        on_result(result)
+                    progress.update()
+
+            def refill():
+                # Backpressure: new queries are only started while fewer than twice the number of workers candidates are in the pool
+                while pool.pending < 2 * args.workers:
+                    query_data = next(queries_iter, None)
+                    if query_data is None:
+                        return
+                    on_group(sampler.add_query(query_data, ledger_entries(query_data)))
+
+            try:
+                refill()
+                for result in pool.results():
+                    if 'error' in result:
+                        print(f"Worker failed on {result['item']}: {result['error']}")
+                        query_ID, CPC_class, patent_ID = result['item']
+                        result = {'patent_ID': patent_ID, 'query_ID': query_ID, 'CPC_class': CPC_class, 'status': 'failed', 'stage': 'worker', 'stored': None}
+                    on_group(sampler.on_result(result))
+                    refill()
+                if pool.pending:
+                    raise RuntimeError(f'Every worker exited with {pool.pending} candidate documents not scraped.')
+            finally:
+                progress.close()
+        else:
+            for query_data in CPC_queries:
+                scrape_documents_from_query(query_data, args.store_dir, context, args.sample_size, ledger_entries(query_data), args.max_attempts, on_result)
+
+    # Collect the query patents of each CPC class within the input directory
+    queries = {}
+    for CPC_class in sorted(os.listdir(args.json_dir_input)):
+        if CPC_class in args.CPC_to_exclude:
+            print(f'CPC: {CPC_class} already scraped.')
+            continue
+        queries[CPC_class] = list(iter_records(args.json_dir_input, CPC_class, 'query'))
+        if repair_queries is not None:
+            queries[CPC_class] = [query_data for query_data in queries[CPC_class] if (CPC_class, f"{CPC_class}_{query_data['patent_ID']}") in repair_queries]
+
+    if args.work_dir:
+        # Plan the queries of every CPC class that are in no work unit yet (identical on every node, the first node to write
+        # a unit wins), then scrape the units claimed by this node until every unit is done.
+        # A unit holds query IDs: each node reads the query records from the input directory.
+        work_queue = WorkQueue(args.work_dir, 'document', args.lease_ttl)
+        planned = work_queue.planned_items()
+        for CPC_class, CPC_queries in queries.items():
+            work_queue.plan_new_items([[CPC_class, query_data['patent_ID']] for query_data in CPC_queries], args.unit_size, CPC_class, planned)
+        query_records = {(query_data['cls'], query_data['patent_ID']): query_data for CPC_queries in queries.values() for query_data in CPC_queries}
+
+        # With workers, the pool (and its browsers) is started once for every unit
+        with (scraping_context(**context_options) if args.workers == 1 else nullcontext()) as context, \
+             (document_worker_pool(args.workers, args.store_dir, **context_options) if args.workers > 1 else nullcontext((None, None))) as (pool, sink):
+            while True:
+                with work_queue.next_unit() as unit:
+                    if unit is None:
+                        break
+                    unit_ID, unit_items = unit
+                    if any(tuple(query_key) not in query_records for query_key in unit_items):
+                        # Unit planned by a node that started later, with queries scraped since this node read them
+                        for CPC_class in {CPC_class for CPC_class, _ in unit_items}:
+                            query_records.update({(query_data['cls'], query_data['patent_ID']): query_data
+                                                  for query_data in iter_records(args.json_dir_input, CPC_class, 'query')})
+                    unit_queries = [query_records[tuple(query_key)] for query_key in unit_items if tuple(query_key) in query_records]
+                    unit_queries = [query_data for query_data in unit_queries if not is_query_complete(query_data)]
+                    print(f'\nStarting scraping of unit {unit_ID}: {len(unit_queries)} queries')
+                    scrape_queries(unit_queries, context, pool, sink)
+                    # Queries stopped by throttling are resumed when the unit is claimed again
+                    if any(entry['status'] == 'throttled' for query_data in unit_queries for entry in ledger_entries(query_data).values()):
+                        work_queue.mark_incomplete(unit_ID)
+                done, total = work_queue.progress()
+                print(f'Finished unit {unit_ID} ({done}/{total} units done)')
+
+    elif args.workers > 1:
+        pending_queries = [query_data for CPC_queries in queries.values() for query_data in CPC_queries if not is_query_complete(query_data)]
+        print(f'\nStarting scraping of the documents of {len(pending_queries)} queries with {args.workers} workers')
+        with document_worker_pool(args.workers, args.store_dir, **context_options) as (pool, sink):
+            scrape_queries(pending_queries, None, pool, sink)
+        print('Completed scraping')
+
+    else:
+        # Initialize WebDriver (started on first use), the HTTP session of the HTML backend, the page archive and the output sink
+        with scraping_context(**context_options) as context:
+            # Iterate through the query patents of each CPC class.
+            for CPC_class, CPC_queries in queries.items():
+                print(f'\nStarting scraping for CPC: {CPC_class} ...')
+                scrape_queries([query_data for query_data in CPC_queries if not is_query_complete(query_data)], context)
+                print(f'Completed scraping for CPC: {CPC_class}')
+
+    # Export the final metrics and print where the time went
+    metrics.close()
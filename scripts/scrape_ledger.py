@@ -0,0 +1,211 @@
+import os
+import json
+import socket
+import time
+import sqlite3
+from dataset_io import Manifest, writer_ID
+
+
+# Ledger shared by the runs of a single node.
+DEFAULT_LEDGER = '/vast/marco/Data_Google_Patent/scrape_ledger.sqlite'
+
+# One row per scraped item: a query patent of a CPC class (query_ID = ''), or a document patent cited by a query.
+# attempts counts the failed attempts: throttled ones are not failures of the item.
+LEDGER_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scrapes (
+    patent_ID TEXT NOT NULL,
+    role TEXT NOT NULL,
+    CPC_class TEXT NOT NULL,
+    query_ID TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    first_attempt REAL,
+    last_attempt REAL,
+    duration REAL,
+    PRIMARY KEY (patent_ID, role, CPC_class, query_ID)
+);
+CREATE INDEX IF NOT EXISTS scrapes_role_status ON scrapes (role, status);
+CREATE INDEX IF NOT EXISTS scrapes_stage ON scrapes (role, stage);
+'''
+
+
+
+def open_ledger(ledger_path):
+    '''
+    Opens (and creates if needed) the SQLite scrape ledger at ledger_path.
+    The ledger should live on a local disk: SQLite locking is unreliable on network filesystems.
+    '''
+    ledger_dir = os.path.dirname(ledger_path)
+    if ledger_dir:
+        os.makedirs(ledger_dir, exist_ok=True)
+    conn = sqlite3.connect(ledger_path, timeout=60)
+    conn.executescript(LEDGER_SCHEMA)
+    return conn
+
+
+
+def node_ledger_path(ledger_path=None, work_dir=None):
+    '''
+    Returns the path of the ledger of a scraper: ledger_path if given, otherwise DEFAULT_LEDGER or, when the nodes share
+    a work directory, a ledger of this node under /tmp. Nodes sharing a work directory each keep their own ledger
+    (SQLite on a network filesystem is unreliable), so a given path must be under /tmp or contain the hostname:
+    raises ValueError otherwise. Each node ledger is bootstrapped from the shared outputs (see open_and_load_ledger()).
+    '''
+    hostname = socket.gethostname()
+    if ledger_path is None:
+        return f'/tmp/scrape_ledger-{hostname}.sqlite' if work_dir else DEFAULT_LEDGER
+    if work_dir and hostname not in ledger_path and not os.path.abspath(ledger_path).startswith('/tmp/'):
+        raise ValueError(f'The ledger {ledger_path} may be shared by the nodes of --work_dir: use a node-local path (under /tmp or containing the hostname {hostname}).')
+    return ledger_path
+
+
+
+def load_ledger(conn, role):
+    '''
+    Loads in bulk every ledger row of a role ('query' or 'document').
+    Returns a dictionary {(patent_ID, CPC_class, query_ID): {'status', 'stage', 'attempts'}} used for O(1) skip decisions.
+    '''
+    rows = conn.execute('SELECT patent_ID, CPC_class, query_ID, status, stage, attempts FROM scrapes WHERE role = ?', (role,))
+    return {(patent_ID, CPC_class, query_ID): {'status': status, 'stage': stage, 'attempts': attempts}
+            for patent_ID, CPC_class, query_ID, status, stage, attempts in rows}
+
+
+
+def skip_reason(entry, max_attempts):
+    '''
+    Returns why a ledger entry must not be scraped again: 'done' if it was already scraped,
+    'failed' if it failed max_attempts times, or None if it has to be (re)scraped.
+    Throttled attempts are not failures of the item: they are always retried.
+    '''
+    if entry is None:
+        return None
+    if entry['status'] == 'done':
+        return 'done'
+    if entry['status'] == 'failed' and entry['attempts'] >= max_attempts:
+        return 'failed'
+    return None
+
+
+
+def record_result(conn, role, result):
+    '''
+    Records the outcome of one scraping attempt returned by scrape_query_patent() or scrape_document_patent():
+    status, failing stage and duration, incrementing the number of attempts of the item if it failed.
+    '''
+    now = time.time()
+    conn.execute('''
+        INSERT INTO scrapes (patent_ID, role, CPC_class, query_ID, status, stage, attempts, first_attempt, last_attempt, duration)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (patent_ID, role, CPC_class, query_ID) DO UPDATE SET
+            status = excluded.status,
+            stage = excluded.stage,
+            attempts = attempts + excluded.attempts,
+            last_attempt = excluded.last_attempt,
+            duration = excluded.duration
+        ''', (result['patent_ID'], role, result['CPC_class'], result.get('query_ID', ''), result['status'],
+              result.get('stage'), int(result['status'] == 'failed'), now, now, result.get('duration')))
+    conn.commit()
+
+
+
+def remember_result(entries, key, result):
+    '''
+    Mirrors record_result() in a dictionary of ledger entries loaded with load_ledger() (or grouped by query),
+    so that skip decisions made after loading see the attempts of the running process.
+    '''
+    entry = entries.get(key)
+    entries[key] = {'status': result['status'], 'stage': result.get('stage'),
+                    'attempts': (entry['attempts'] if entry else 0) + (result['status'] == 'failed')}
+
+
+
+def forget_entries(conn, role, keys):
+    '''
+    Deletes the ledger rows of the items of a role given as (patent_ID, CPC_class, query_ID) keys,
+    so that they are scraped again as never attempted (e.g. the broken items of a repair list).
+    '''
+    conn.executemany('DELETE FROM scrapes WHERE patent_ID = ? AND role = ? AND CPC_class = ? AND query_ID = ?',
+                     [(patent_ID, role, CPC_class, query_ID) for patent_ID, CPC_class, query_ID in keys])
+    conn.commit()
+
+
+
+def apply_repair_list(repair_list_path, role, ledger_conn, json_dir):
+    '''
+    Prepares the re-fetching of the items of a role ('query' or 'document') listed in a repair list written by validate_dataset.py:
+    their broken files are discarded and their ledger entries forgotten, so the scrapers fetch them again when resuming.
+    Their records are logged as removed in the manifest of the dataset json_dir, so that the ground truth and the CPC index
+    drop them until they are written again. Returns the repair items of the role.
+    '''
+    with open(repair_list_path, 'r') as f:
+        items = [item for item in map(json.loads, f) if item['role'] == role]
+    manifest = Manifest(json_dir, f'repair-{writer_ID()}')
+    for item in items:
+        for path in item['discard']:
+            if os.path.exists(path):
+                os.remove(path)
+        record = {'type': role, 'cls': item['CPC_class'], 'patent_ID': item['patent_ID'], 'query_ID': item['query_ID']}
+        manifest.log('remove', record, None)
+    manifest.close()
+    forget_entries(ledger_conn, role, [(item['patent_ID'], item['CPC_class'], item['query_ID']) for item in items])
+    print(f'{len(items)} {role} patents to repair from {repair_list_path}.')
+    return items
+
+
+
+def import_existing_outputs(conn, role, json_dir):
+    '''
+    Bootstraps an empty ledger from the JSON files already written in json_dir/<CPC>/ by previous runs,
+    so that resuming does not scrape them again. Uses one directory listing per CPC class.
+    Query files are named <CPC>_<patent_ID>.json and document files <CPC>_<query patent_ID>_<patent_ID>.json.
+    '''
+    if not os.path.isdir(json_dir):
+        return 0
+    rows = []
+    for CPC_class in os.listdir(json_dir):
+        CPC_dir = os.path.join(json_dir, CPC_class)
+        if not os.path.isdir(CPC_dir):
+            continue
+        for json_file in os.listdir(CPC_dir):
+            name = os.path.splitext(json_file)[0]
+            if not json_file.endswith('.json') or not name.startswith(f'{CPC_class}_'):
+                continue
+            if role == 'query':
+                patent_ID, query_ID = name[len(CPC_class) + 1:], ''
+            elif '_' in name[len(CPC_class) + 1:]:
+                query_patent_ID, patent_ID = name[len(CPC_class) + 1:].split('_', 1)
+                query_ID = f'{CPC_class}_{query_patent_ID}'
+            else:
+                continue
+            rows.append((patent_ID, role, CPC_class, query_ID, 'done'))
+    conn.executemany('''
+        INSERT OR IGNORE INTO scrapes (patent_ID, role, CPC_class, query_ID, status, attempts)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ''', rows)
+    conn.commit()
+    return len(rows)
+
+
+
+def index_documents_by_query(ledger):
+    '''
+    Groups the ledger entries of document patents by query: {(CPC_class, query_ID): {patent_ID: entry}}.
+    '''
+    documents_by_query = {}
+    for (patent_ID, CPC_class, query_ID), entry in ledger.items():
+        documents_by_query.setdefault((CPC_class, query_ID), {})[patent_ID] = entry
+    return documents_by_query
+
+
+
+def open_and_load_ledger(ledger_path, role, json_dir):
+    '''
+    Opens the ledger and loads the entries of a role, importing the existing JSON outputs the first time
+    the ledger is used for that role.
+    '''
+    conn = open_ledger(ledger_path)
+    if conn.execute('SELECT 1 FROM scrapes WHERE role = ? LIMIT 1', (role,)).fetchone() is None:
+        n_imported = import_existing_outputs(conn, role, json_dir)
+        print(f'Imported {n_imported} already scraped {role} patents into the ledger.')
+    return conn, load_ledger(conn, role)
@@ -0,0 +1,197 @@
+import os
+import argparse
+from functools import partial
+from scraping_functions import GOOGLE_PATENTS_URL
+from worker_pool import WorkerPool
+from dataset_io import iter_records, setup_sink
+from scrape_ledger import open_and_load_ledger, index_documents_by_query, record_result, remember_result
+from scrape_query_patents import read_CPC_patent_IDs, filter_scraped, filter_valid, scrape_query_patent
+from scrape_document_patents import scrape_document_candidate_item, DocumentSampler
+from metrics import Metrics
+from patent_validation import PatentValidator
+from rate_limiter import RateLimiter
+
+
+def scrape_pipeline_item(context, item, front_imgs_dir_output, store_dir=None):
+    """
+    Work item handler of the streaming pipeline, for the two kinds of work items:
+    - ('query', (patent_ID, CPC_class)): scrapes a query patent into the sink of the context; its result is sent
+      to the main process through context['emit'] once the front image is saved.
+    - ('document', (query_ID, CPC_class, patent_ID)): fetches a candidate document of a scraped query into the store;
+      the DocumentSampler of the main process decides whether it joins the sample of the query.
+    """
+    kind, payload = item
+    if kind == 'query':
+        patent_ID, CPC_class = payload
+        scrape_query_patent(patent_ID, CPC_class, front_imgs_dir_output, context, store_dir, on_result=context['emit'])
+        return None
+    return scrape_document_candidate_item(context, payload, store_dir)
+
+
+def pipeline_items(CPC_class_dir, CPC_files, json_dir_query, query_ledger, max_attempts, is_query_complete, validator=None, ledger_conn=None):
+    """
+    Yields the initial work items of the pipeline: first the documents of the queries scraped in previous runs
+    whose sample is not complete (read back from the query records), then the valid query patents still to be scraped.
+    """
+    CPC_query_patents = [read_CPC_patent_IDs(os.path.join(CPC_class_dir, CPC_file)) for CPC_file in CPC_files]
+    for CPC_class, _ in CPC_query_patents:
+        if os.path.isdir(os.path.join(json_dir_query, CPC_class)):
+            for query_data in iter_records(json_dir_query, CPC_class, 'query'):
+                if not is_query_complete(query_data):
+                    yield 'documents', query_data
+    for CPC_class, patent_IDs in CPC_query_patents:
+        for patent_ID in filter_valid(filter_scraped(patent_IDs, CPC_class, query_ledger, max_attempts), CPC_class, validator, ledger_conn):
+            yield 'query', (patent_ID, CPC_class)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Scrape query patents and the documents they cite in a single streaming pipeline: '
+                                                 'the documents of each query are scheduled as soon as the query is scraped.')
+
+    parser.add_argument('--CPC_class_dir', type=str, default='/home/fantoni/marco/google-patent-scraping/CPC_class',
+                        help='Directory containing CPC files, each storing patent IDs of query patents for a specific CPC class.')
+    parser.add_argument('--json_dir_query', type=str, default='/vast/marco/Data_Google_Patent/json/query',
+                        help='Directory to save the records of the query patents.')
+    parser.add_argument('--json_dir_document', type=str, default='/vast/marco/Data_Google_Patent/json/document',
+                        help='Directory to save the records of the document patents.')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'jsonl'],
+                        help="'json' writes one indented JSON file per patent; 'jsonl' appends records to size-bounded JSON lines shards per CPC class.")
+    parser.add_argument('--front_imgs_dir_output', type=str, default='/vast/marco/Data_Google_Patent/front_imgs/query',
+                        help='Directory to save front images of query patents.')
+    parser.add_argument('--store_dir', type=str, default='/vast/marco/Data_Google_Patent/store',
+                        help='Directory of the global patent store: data and front images of each patent, scraped once and shared by all the queries citing it.')
+    parser.add_argument('--archive_dir', type=str, default=None,
+                        help='Directory of the raw page archive: when given, the served HTML of every fetched page is saved compressed for offline re-extraction '
+                             '(with the selenium backend, it costs one plain HTTP request per page besides the browser).')
+    parser.add_argument('--CPC_to_exclude', type=str, nargs='*', default=[],
+                        help="CPC files to exclude from scraping. Example: --CPC_to_exclude A42B3.txt A62B18.txt")
+    parser.add_argument('--backend', type=str, default='selenium', choices=['selenium', 'html'],
+                        help="'selenium' renders every page in headless Firefox; 'html' parses the served HTML and falls back to Selenium only for pages it cannot parse.")
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of worker processes, each with its own WebDriver, scraping queries and documents from a shared queue.')
+    parser.add_argument('--max_pending', type=int, default=None,
+                        help='Maximum number of work items queued or in progress (default: twice the number of workers). '
+                             'New queries are only scheduled below this bound, and the documents of the scraped queries go first.')
+    parser.add_argument('--sample_size', type=int, default=5,
+                        help='Number of documents to be scraped from the citations by examiner of each query.')
+    parser.add_argument('--speculation', type=int, default=2,
+                        help='Number of candidate documents fetched concurrently beyond sample_size for each query, '
+                             'so that failing candidates do not delay the sample (the accepted documents do not depend on it).')
+    parser.add_argument('--ledger', type=str, default='/vast/marco/Data_Google_Patent/scrape_ledger.sqlite',
+                        help='SQLite ledger recording the outcome of every scraped patent, used to resume scraping (preferably on a local disk).')
+    parser.add_argument('--max_attempts', type=int, default=1,
+                        help='Number of failed attempts after which a patent is no longer retried when resuming.')
+    parser.add_argument('--base_url', type=str, default=GOOGLE_PATENTS_URL,
+                        help='Base URL of the patent pages, e.g. the local stand-in server of benchmark_server.py.')
+    parser.add_argument('--rate_limit_file', type=str, default='/tmp/google_patents_rate_limit.json',
+                        help='Local state file of the rate limiter shared by every scraping process of the node (empty string to disable rate limiting).')
+    parser.add_argument('--max_rate', type=float, default=10.0,
+                        help='Maximum number of requests per second to Google Patents; the actual rate adapts to throttling below it.')
+    parser.add_argument('--image_workers', type=int, default=4,
+                        help='Number of threads per process downloading front images while the browser extracts the next patents.')
+    parser.add_argument('--optional_fields', type=str, nargs='*', default=[], choices=['title', 'abstract', 'CPC_class', 'first_claim', 'front_img'],
+                        help="Fields a patent is accepted without when they cannot be scraped, e.g. --optional_fields front_img (they are null in its record). "
+                             "The citations are always required: the documents are sampled from them.")
+    parser.add_argument('--driver_max_pages', type=int, default=500,
+                        help='Number of pages after which the WebDriver of a process is restarted (0 to never restart).')
+    parser.add_argument('--driver_max_rss_mb', type=int, default=2048,
+                        help='Resident memory (MB) of the browser processes above which the WebDriver is restarted (0 to disable).')
+
+    parser.add_argument('--validation_cache', type=str, default='/vast/marco/Data_Google_Patent/validation_cache.jsonl',
+                        help='Cache of the verdicts of the patent ID pre-validation stage (empty string to disable the pre-validation).')
+    parser.add_argument('--validation_workers', type=int, default=16,
+                        help='Number of concurrent lightweight requests checking the patent IDs before scraping.')
+
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help='File where the per-stage timing metrics are exported periodically: JSON lines, or a Prometheus textfile if it ends with .prom.')
+    parser.add_argument('--metrics_interval', type=int, default=60,
+                        help='Seconds between two exports of the metrics.')
+
+    args = parser.parse_args()
+    context_options = {'backend': args.backend, 'archive_dir': args.archive_dir, 'json_dir_output': args.json_dir_query, 'output_format': args.output_format,
+                       'driver_max_pages': args.driver_max_pages, 'driver_max_rss_mb': args.driver_max_rss_mb,
+                       'base_url': args.base_url, 'rate_limit_file': args.rate_limit_file, 'max_rate': args.max_rate, 'image_workers': args.image_workers,
+                       'optional_fields': args.optional_fields}
+    max_pending = args.max_pending or 2 * args.workers
+
+    # Load the ledger of both roles in bulk once: skip decisions are then dictionary lookups.
+    query_ledger_conn, query_ledger = open_and_load_ledger(args.ledger, 'query', args.json_dir_query)
+    document_ledger_conn, document_ledger = open_and_load_ledger(args.ledger, 'document', args.json_dir_document)
+    documents_by_query = index_documents_by_query(document_ledger)
+    metrics = Metrics('pipeline', args.metrics_file, args.metrics_interval)
+    # Invalid patent IDs are ruled out with lightweight requests, paced by the rate limiter of the node
+    validator = PatentValidator(args.validation_cache, args.base_url, args.validation_workers,
+                                RateLimiter(args.rate_limit_file, max_rate=args.max_rate) if args.rate_limit_file else None) if args.validation_cache else None
+
+    def ledger_entries(query_data):
+        return documents_by_query.get((query_data['cls'], f"{query_data['cls']}_{query_data['patent_ID']}"), {})
+
+    def is_query_complete(query_data):
+        # Queries with sample_size documents already scraped are not scheduled again.
+        return sum(entry['status'] == 'done' for entry in ledger_entries(query_data).values()) >= args.sample_size
+
+    CPC_files = sorted(CPC_file for CPC_file in os.listdir(args.CPC_class_dir) if CPC_file not in args.CPC_to_exclude)
+    items = pipeline_items(args.CPC_class_dir, CPC_files, args.json_dir_query, query_ledger, args.max_attempts, is_query_complete, validator, query_ledger_conn)
+    handle_item = partial(scrape_pipeline_item, front_imgs_dir_output=args.front_imgs_dir_output, store_dir=args.store_dir)
+    pool = WorkerPool(handle_item, args.workers, **context_options)
+    # The document samples are decided, and the document records written, by this process
+    document_sink = setup_sink(args.json_dir_document, args.output_format)
+    sampler = DocumentSampler(lambda candidate: pool.submit(('document', candidate)), document_sink, args.sample_size, args.speculation, args.max_attempts)
+    n_groups = 0
+
+    def on_group(group):
+        # A query-plus-documents group is finished once the sample of the query is decided
+        global n_groups
+        if group is None:
+            return
+        for document_result in group['results']:
+            record_result(document_ledger_conn, 'document', document_result)
+            remember_result(documents_by_query.setdefault((group['CPC_class'], group['query_ID']), {}), document_result['patent_ID'], document_result)
+            metrics.record(document_result)
+        n_groups += 1
+        print(f"Completed query {group['query_ID']} with {group['scraped_count']} documents ({n_groups} queries completed).")
+
+    def schedule(kind, payload):
+        if kind == 'documents':
+            on_group(sampler.add_query(payload, ledger_entries(payload)))
+        else:
+            pool.submit(('query', payload))
+
+    def refill():
+        # Backpressure: new items are only pulled from the CPC files while fewer than max_pending are in the pool
+        while pool.pending < max_pending:
+            item = next(items, None)
+            if item is None:
+                return
+            schedule(*item)
+
+    print(f'\nStarting the scraping pipeline with {args.workers} workers')
+    try:
+        refill()
+        for result in pool.results():
+            kind = result['item'][0] if 'error' in result else ('document' if 'query_ID' in result else 'query')
+            if 'error' in result:
+                print(f"Worker failed on {result['item']}: {result['error']}")
+                if kind == 'document':
+                    query_ID, CPC_class, patent_ID = result['item'][1]
+                    on_group(sampler.on_result({'patent_ID': patent_ID, 'query_ID': query_ID, 'CPC_class': CPC_class,
+                                                'status': 'failed', 'stage': 'worker', 'stored': None}))
+            elif kind == 'document':
+                on_group(sampler.on_result(result))
+            else:
+                record_result(query_ledger_conn, 'query', result)
+                metrics.record(result)
+                # Start sampling the documents of the query right away, ahead of the queries not yet pulled from the CPC files
+                if result['status'] == 'done':
+                    schedule('documents', {'patent_ID': result['patent_ID'], 'cls': result['CPC_class'],
+                                           'citations_by_examiner': result['citations_by_examiner']})
+            refill()
+    finally:
+        pool.close()
+        document_sink.close()
+        if validator is not None:
+            validator.close()
+
+    # Export the final metrics and print where the time went
+    metrics.close()
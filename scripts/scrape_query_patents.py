@@ -1,95 +1,281 @@
 import os
-import json
+import time
 import argparse
+from functools import partial
+from contextlib import nullcontext
 from tqdm import tqdm
-from scraping_functions import setup_driver, get_citations, get_title, get_abstract, get_CPC_classes, get_first_claim, download_img
+from scraping_functions import failed_stage, patent_url, GOOGLE_PATENTS_URL
+from html_scraping import extract_patent
+from worker_pool import WorkerPool, run_workers, scraping_context
+from scrape_ledger import node_ledger_path, open_and_load_ledger, load_ledger, apply_repair_list, skip_reason, record_result, remember_result
+from patent_store import STORE_FIELDS, normalize_patent_ID, load_cached_patent, save_cached_patent, missing_fields, page_fields_to_extract, page_to_store
+from metrics import Metrics
+from work_leases import WorkQueue, DEFAULT_LEASE_TTL
+from patent_validation import PatentValidator
+from rate_limiter import RateLimiter
 
-def scrape_queries_from_CPC(CPC_file_path, front_imgs_dir_output, json_dir_output):
+
+def read_CPC_patent_IDs(CPC_file_path, only=None):
+    """
+    Read the patent IDs of the query patents listed in a CPC file (one patent ID per line).
+    Returns the CPC class (the file name without extension) and the list of cleaned patent IDs.
+    When only is given ({CPC_class: patent IDs}, e.g. the items of a repair list), the other patents of the file are left out.
+    """
+    CPC_class = os.path.splitext(os.path.basename(CPC_file_path))[0]
+    with open(CPC_file_path, 'r') as file:
+        patent_IDs = [line.replace(" ", "").strip() for line in file] # Clean the patent ID by removing spaces and line breaks
+    patent_IDs = [patent_ID for patent_ID in patent_IDs if patent_ID]
+    if only is not None:
+        patent_IDs = [patent_ID for patent_ID in patent_IDs if patent_ID in only.get(CPC_class, ())]
+    return CPC_class, patent_IDs
+
+
+def filter_scraped(patent_IDs, CPC_class, ledger, max_attempts):
+    """
+    Returns the patent IDs of a CPC class that still have to be scraped according to the ledger:
+    patents already scraped, or that failed max_attempts times, are skipped.
+    """
+    pending = []
+    for patent_ID in patent_IDs:
+        reason = skip_reason(ledger.get((patent_ID, CPC_class, '')), max_attempts)
+        if reason == 'done':
+            print(f"{patent_ID} already scraped.")
+        elif reason == 'failed':
+            print(f"{patent_ID} skipped: failed in all the previous {max_attempts} attempts.")
+        else:
+            pending.append(patent_ID)
+    return pending
+
+
+def filter_valid(patent_IDs, CPC_class, validator, ledger_conn):
+    """
+    Returns the patent IDs of a CPC class that passed the pre-validation stage (see patent_validation.py), in order.
+    Patents that are malformed, not found or without an English page are recorded in the ledger as failed at the
+    'validate' stage, so they never reach the browser and are skipped when resuming.
+    """
+    if validator is None:
+        return patent_IDs
+    verdicts = validator.validate(patent_IDs)
+    valid = []
+    for patent_ID in patent_IDs:
+        if verdicts[patent_ID] in ('valid', 'unknown'):
+            valid.append(patent_ID)
+        else:
+            print(f"{patent_ID} skipped: {verdicts[patent_ID].replace('_', ' ')}.")
+            record_result(ledger_conn, 'query', {'patent_ID': patent_ID, 'CPC_class': CPC_class, 'status': 'failed', 'stage': 'validate', 'duration': 0})
+    return valid
+
+
+def scrape_query_patent(patent_ID, CPC_class, front_imgs_dir_output, context, store_dir=None, on_result=None):
+    """
+    Scrape the patent data of a single query patent and write it to the output sink of the scraping context.
+
+    Parameters:
+    - patent_ID (str): The cleaned patent ID of the query patent.
+    - CPC_class (str): The CPC class the query patent belongs to.
+    - front_imgs_dir_output (str): Directory where front images of patents will be saved.
+    - context (dict): Scraping resources created by setup_scraping_context(): the WebDriver, the HTTP session
+      of the HTML backend (or None), the writer of the raw page archive (or None), the output sink, the image downloader
+      and the acceptance policy (the optional fields a query can be written without).
+    - store_dir (str): Directory of the global patent store. When given, the scraped patent is also added to the store,
+      so it is not fetched again if another query cites it. The fields extracted by a failed attempt are kept there too,
+      so that a retry only extracts the missing fields (or only downloads the image).
+    - on_result (callable): Called with the result of the patent once it is complete.
+
+    The front image is downloaded in the background by the image downloader of the context, so this function returns
+    as soon as the page is extracted and the next patent can be loaded meanwhile. The record is written, and on_result
+    called, when the image is saved (from a later call, or when the context is closed).
+    The result is a dictionary with the patent_ID, the CPC_class, the status of the patent ('done', 'failed' or 'throttled'),
+    the failing stage, the duration of the attempt in seconds, the timings of its stages (see metrics.py)
+    and, for scraped patents, the citations by examiner.
+    """
+    query_ID = f"{CPC_class}_{patent_ID}"
+    url = patent_url(patent_ID, context['base_url']) # Construct the Google Patents URL for the specific patent
+    on_result = on_result or (lambda result: None)
+
+    # Create the image directory for the CPC class
+    img_dir_CPC = os.path.join(front_imgs_dir_output, CPC_class)
+    os.makedirs(img_dir_CPC, exist_ok=True)
+    result = {'patent_ID': patent_ID, 'CPC_class': CPC_class, 'status': 'failed', 'stage': None, 'stages': {}}
+    start_time = time.time()
+    # Fields the query cannot be accepted without (the others are fetched, but optional)
+    required_fields = [field for field in STORE_FIELDS if field not in context['optional_fields']]
+
+    # Start from the fields kept in the store by previous attempts (the front image of the query is its own file):
+    # only the missing fields are extracted, and the page is not loaded at all if only the image is missing
+    patent_data = dict(load_cached_patent(store_dir, patent_ID, required_fields=[]) or {}) if store_dir is not None else {}
+    front_img_path = os.path.join(img_dir_CPC, f'{query_ID}.png')
+    patent_data['front_img'] = front_img_path if os.path.exists(front_img_path) else None
+    missing = missing_fields(patent_data, STORE_FIELDS)
+    page_fields = page_fields_to_extract(patent_data, missing)
+    if page_fields:
+        # Navigate once and extract the missing fields from the same rendered page
+        page = extract_patent(url, context['driver'], context['session'], fields=page_fields, keep_html=context['archive'] is not None, limiter=context['limiter'],
+                              archive_session=context['archive_session'])
+        result['stages'] = page['stages']
+        if context['archive'] is not None:
+            context['archive'].add(normalize_patent_ID(patent_ID), url, page.get('html'), page.get('html_source'))
+        if page['throttled']:
+            # Not a failure of the patent: it is retried when resuming, without counting towards max_attempts
+            print(f"{patent_ID} from: {url} not scraped: throttled by Google.")
+            result['status'] = result['stage'] = 'throttled'
+            result['duration'] = time.time() - start_time
+            on_result(result)
+            return
+        page_data, field_status = page_to_store(page, page_fields)
+        patent_data.update(page_data)
+        if store_dir is not None:
+            # Keep what was extracted even if some fields are missing
+            save_cached_patent(store_dir, patent_ID, page_data, field_status)
+
+    def save_record(front_img_path):
+        if 'front_img' in missing and store_dir is not None:
+            save_cached_patent(store_dir, patent_ID, {'front_img': front_img_path}, {'front_img': 'ok' if front_img_path else 'failed'})
+        patent_data['front_img'] = front_img_path or patent_data['front_img']
+        still_missing = missing_fields(patent_data, required_fields)
+        # If every required field is available, write the record
+        if not still_missing:
+            citations_by_examiner, citations = patent_data.get('citations_by_examiner'), patent_data.get('citations')
+            record = {
+                "type": "query",
+                "patent_ID": patent_ID,
+                "cls": CPC_class,
+                "title": patent_data.get('title'),
+                "abstract": patent_data.get('abstract'),
+                "CPC_class": patent_data.get('CPC_class'),
+                "first_claim": patent_data.get('first_claim'),
+                "front_img": patent_data['front_img'],
+                "citations_by_examiner": citations_by_examiner,
+                "citations": citations,
+                "all_citations": citations_by_examiner + citations
+            }
+            # Write the patent data dictionary to the output sink (a JSON file or a JSON lines shard)
+            context['sink'].write(record, query_ID)
+            #print(f'{patent_ID} successfully scraped.')
+            result['status'] = 'done'
+            result['citations_by_examiner'] = citations_by_examiner # The documents of the query can be sampled without reading the record back
+        else:
+            result['stage'] = failed_stage(page_fields_to_extract(patent_data, still_missing)) or 'download_img'
+            print(f"Stopping execution due to failure in {result['stage']}().")
+            print(f"{patent_ID} from: {url} not succesfully scraped due to an earlier failure.")
+
+        result['duration'] = time.time() - start_time
+        on_result(result)
+
+    def save_failed(error):
+        # The result is still reported (a worker pool waits for it), as a failure to save the patent
+        result['status'], result['stage'] = 'failed', 'save'
+        result['duration'] = time.time() - start_time
+        on_result(result)
+
+    if 'front_img' in missing and patent_data.get('front_img_url'):
+        # The image is downloaded even if other fields are missing, so that a retry does not download it again
+        context['images'].submit(patent_data['front_img_url'], f"{query_ID}", img_dir_CPC, save_record, result['stages'], save_failed)
+    else:
+        save_record(None)
+
+
+def scrape_query_item(context, item, front_imgs_dir_output, store_dir=None):
+    """
+    Work item handler used by the worker pool: scrapes the query patent item = (patent_ID, CPC_class)
+    with the scraping context owned by the worker process. The result is sent to the main process
+    through context['emit'] once the front image is saved.
+    """
+    patent_ID, CPC_class = item
+    scrape_query_patent(patent_ID, CPC_class, front_imgs_dir_output, context, store_dir, on_result=context['emit'])
+
+
+def scrape_queries_from_CPC(CPC_file_path, front_imgs_dir_output, ledger_conn, ledger, context_options, max_attempts=1, store_dir=None, metrics=None, validator=None, only=None):
     """
-    Scrape patent data for a given CPC class from Google Patents and save a JSON file for each patent of the CPC class.
+    Scrape patent data for a given CPC class from Google Patents and save a record for each patent of the CPC class.
 
     Parameters:
     - CPC_file_path (str): The file path containing the list of patent IDs belonging to a specific CPC class.
     - front_imgs_dir_output (str): Directory where front images of patents will be saved.
-    - json_dir_output (str): Directory where the scraped patent data will be saved as a JSON file.
+    - ledger_conn (sqlite3.Connection): Connection to the scrape ledger, where the outcome of each patent is recorded.
+    - ledger (dict): Ledger entries of the query patents, loaded at startup with open_and_load_ledger().
+    - context_options (dict): Options of setup_scraping_context(): backend, archive_dir, json_dir_output, output_format and the WebDriver recycling limits.
+    - max_attempts (int): Number of failed attempts after which a patent is no longer retried.
+    - store_dir (str): Directory of the global patent store, where the scraped patents are also added (optional).
+    - metrics (Metrics): Aggregator of the stage timings of the results (optional).
+    - validator (PatentValidator): Pre-validation stage ruling out invalid patent IDs before scraping (optional).
+    - only (dict): Patent IDs to scrape by CPC class, the other patents of the CPC file are skipped (optional, see read_CPC_patent_IDs()).
 
     This function reads patent IDs from the specified CPC class file, scrapes patent data such as
     citations, first claims, and front images from Google Patents for each query patent, and stores
-    the results in a dictionary. The dictionary is then saved to a JSON file corresponding to the patent ID of the query patent.
+    the results in a dictionary. The dictionary is then written to the output sink (a JSON file per query patent by default).
     """
 
-    # Initialize WebDriver
-    driver = setup_driver()  
+    # Initialize WebDriver (started on first use), the HTTP session of the HTML backend, the page archive and the output sink.
+    # They are released (and the browser quit) when leaving the with block, even on errors.
+    def on_result(result):
+        record_result(ledger_conn, 'query', result)
+        if metrics is not None:
+            metrics.record(result)
+
+    with scraping_context(**context_options) as context:
+        CPC_class, patent_IDs = read_CPC_patent_IDs(CPC_file_path, only)
+        # Iterate the valid patents of the CPC class that have not been scraped yet
+        for patent_ID in filter_valid(filter_scraped(patent_IDs, CPC_class, ledger, max_attempts), CPC_class, validator, ledger_conn):
+            scrape_query_patent(patent_ID, CPC_class, front_imgs_dir_output, context, store_dir, on_result)
+
+
+def scrape_query_units(work_queue, front_imgs_dir_output, ledger_conn, ledger, context_options, workers=1, max_attempts=1, store_dir=None, metrics=None, validator=None):
+    """
+    Scrape the query patents of the work units claimed by this node until every unit of the shared work directory is done.
+    Each unit holds the patent IDs of a single CPC class; its lease is renewed while it is processed, and it is marked
+    done once all its results (front images included) are recorded, so the units of a node that dies are taken over
+    by the other nodes when their leases expire. Units with throttled patents are released without being marked done.
 
+    Parameters:
+    - work_queue (WorkQueue): Work units of the query patents, planned by every node from the CPC files.
+    - workers (int): Number of worker processes scraping the patents of the units, started once (1 scrapes them in this process).
+    - The other parameters are those of scrape_queries_from_CPC().
+    """
+    def on_result(result):
+        if 'error' in result:
+            print(f"Worker failed on {result['item']}: {result['error']}")
+            return
+        record_result(ledger_conn, 'query', result)
+        remember_result(ledger, (result['patent_ID'], result['CPC_class'], ''), result) # The unit may be claimed again by this node
+        if result['status'] == 'throttled':
+            work_queue.mark_incomplete(unit_ID)
+        if metrics is not None:
+            metrics.record(result)
+
+    unit_ID = None
+    handle_item = partial(scrape_query_item, front_imgs_dir_output=front_imgs_dir_output, store_dir=store_dir)
+    # With workers, the scraping contexts are owned by the worker processes, started once for every unit
+    pool = WorkerPool(handle_item, workers, **context_options) if workers > 1 else None
     try:
-        with open(CPC_file_path, 'r') as file:
-            CPC_class = os.path.splitext(os.path.basename(CPC_file_path))[0]
-            
-            # Create directories for the CPC class
-            json_dir_CPC = os.path.join(json_dir_output, CPC_class)
-            os.makedirs(json_dir_CPC, exist_ok=True)
-            img_dir_CPC = os.path.join(front_imgs_dir_output, CPC_class)
-            os.makedirs(img_dir_CPC, exist_ok=True)
-
-            # Iterate the patents of the CPC class (one patent ID per line)
-            for line in file:
-                patent_ID = line.replace(" ", "").strip()  # Clean the patent ID by removing spaces and line breaks
-                query_ID = f"{CPC_class}_{patent_ID}"
-                url = f"https://patents.google.com/patent/{patent_ID}/en?oq={patent_ID}" # Construct the Google Patents URL for the specific patent
-                json_filepath = os.path.join(json_dir_CPC, f"{query_ID}.json") # Create  json file path where to store patent data
-
-                # Ensure patent ID has not been scraped yet
-                if os.path.exists(json_filepath):
-                    print(f"{patent_ID} already scraped.")
-                    continue
-
-                # List of scraping functions with their arguments 
-                scraping_functions = [
-                    (get_abstract, driver, url),
-                    (get_citations, driver, url),
-                    (get_title, driver, url),
-                    (get_CPC_classes, driver, url),
-                    (get_first_claim, driver, url),
-                    (download_img, driver, url, f"{query_ID}", img_dir_CPC)
-                ]
-                
-                results = []
-                for func, *args in scraping_functions:
-                    try:
-                        result = func(*args)
-                        assert result, f"Function: {func.__name__}() failed."
-                        results.append(result)
-                    except Exception as e:
-                        # If any function fails, log the error and break the loop
-                        print(f"Stopping execution due to failure in {func.__name__}().")
+        with (scraping_context(**context_options) if workers == 1 else nullcontext()) as context:
+            while True:
+                with work_queue.next_unit() as unit:
+                    if unit is None:
                         break
-                
-                # If all functions succeed, assign results and proceed
-                if len(results) == len(scraping_functions):
-                    abstract, citations, title, CPC_classes, fst_claim, front_img_path = results
-                    patent_data = {
-                        "type": "query",
-                        "patent_ID": patent_ID,
-                        "cls": CPC_class,
-                        "title": title,
-                        "abstract": abstract,
-                        "CPC_class": CPC_classes,
-                        "first_claim": fst_claim,
-                        "front_img": front_img_path,
-                        "citations_by_examiner": citations[0],
-                        "citations": citations[1],
-                        "all_citations": citations[0] + citations[1]
-                    }
-                    # Write the patent data dictionary to a JSON file
-                    with open(json_filepath, 'w') as json_file:
-                        json.dump(patent_data, json_file, indent=2)
-                        #print(f'{patent_ID} successfully scraped.')
-                else:
-                    print(f"{patent_ID} from: {url} not succesfully scraped due to an earlier failure.")
-
-    # Ensure driver is closed after processing is complete
+                    unit_ID, unit_items = unit
+                    CPC_class = unit_items[0][1]
+                    patent_IDs = filter_scraped([patent_ID for patent_ID, _ in unit_items], CPC_class, ledger, max_attempts)
+                    patent_IDs = filter_valid(patent_IDs, CPC_class, validator, ledger_conn)
+                    print(f'\nStarting scraping of unit {unit_ID}: {len(patent_IDs)} query patents')
+                    if pool is not None:
+                        for patent_ID in patent_IDs:
+                            pool.submit((patent_ID, CPC_class))
+                        for result in pool.results():
+                            on_result(result)
+                        if pool.pending:
+                            # The unit is released without being marked done
+                            raise RuntimeError(f'Every worker exited with {pool.pending} patents of unit {unit_ID} not scraped.')
+                    else:
+                        for patent_ID in patent_IDs:
+                            scrape_query_patent(patent_ID, CPC_class, front_imgs_dir_output, context, store_dir, on_result)
+                        # Record the patents whose image is still downloading before the unit is marked done
+                        context['images'].poll(wait_all=True)
+                done, total = work_queue.progress()
+                print(f'Finished unit {unit_ID} ({done}/{total} units done)')
     finally:
-        driver.quit()  
+        if pool is not None:
+            pool.close()
 
 
 if __name__ == "__main__":
@@ -100,28 +286,133 @@ if __name__ == "__main__":
                         help='Directory containing CPC files, each storing patent IDs of query patents for a specific CPC class.')
     parser.add_argument('--json_dir_output', type=str, default='/vast/marco/Data_Google_Patent/json/query',
                         help='Directory to save JSON files of query patents.')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'jsonl'],
+                        help="'json' writes one indented JSON file per patent; 'jsonl' appends records to size-bounded JSON lines shards per CPC class.")
     parser.add_argument('--front_imgs_dir_output', type=str, default='/vast/marco/Data_Google_Patent/front_imgs/query',
                         help='Directory to save front images of query patents.')
-    parser.add_argument('--CPC_to_exclude', type=list, default=['A42B3.txt', 'A62B18.txt', 'F04D17.txt', 'F16H1.txt', 'F16L1.txt', 'G02C5.txt','H02K19.txt'], 
-                        help="list of CPC file to exclude when resuming scraping. Example: ['A42B3.txt', 'A62B18.txt', 'F04D17.txt', 'F16H1.txt', 'F16L1.txt', 'G02C5.txt','H02K19.txt']")
+    parser.add_argument('--CPC_to_exclude', type=str, nargs='*', default=[],
+                        help="CPC files to exclude from scraping. Example: --CPC_to_exclude A42B3.txt A62B18.txt")
+    parser.add_argument('--backend', type=str, default='selenium', choices=['selenium', 'html'],
+                        help="'selenium' renders every page in headless Firefox; 'html' parses the served HTML and falls back to Selenium only for pages it cannot parse.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes, each with its own WebDriver, scraping patents from a shared queue.')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='SQLite ledger recording the outcome of every scraped patent, used to resume scraping (default: /vast/marco/Data_Google_Patent/scrape_ledger.sqlite, or with --work_dir a ledger of the node under /tmp).')
+    parser.add_argument('--max_attempts', type=int, default=1,
+                        help='Number of failed attempts after which a patent is no longer retried when resuming.')
+    parser.add_argument('--store_dir', type=str, default='/vast/marco/Data_Google_Patent/store',
+                        help='Directory of the global patent store, where query patents are also added so that documents citing them are not fetched again.')
+    parser.add_argument('--archive_dir', type=str, default=None,
+                        help='Directory of the raw page archive: when given, the served HTML of every fetched page is saved compressed for offline re-extraction '
+                             '(with the selenium backend, it costs one plain HTTP request per page besides the browser).')
 
-    args = parser.parse_args() 
+    parser.add_argument('--base_url', type=str, default=GOOGLE_PATENTS_URL,
+                        help='Base URL of the patent pages, e.g. the local stand-in server of benchmark_server.py.')
+    parser.add_argument('--rate_limit_file', type=str, default='/tmp/google_patents_rate_limit.json',
+                        help='Local state file of the rate limiter shared by every scraping process of the node (empty string to disable rate limiting).')
+    parser.add_argument('--max_rate', type=float, default=10.0,
+                        help='Maximum number of requests per second to Google Patents; the actual rate adapts to throttling below it.')
+    parser.add_argument('--image_workers', type=int, default=4,
+                        help='Number of threads per process downloading front images while the browser extracts the next patents.')
+    parser.add_argument('--optional_fields', type=str, nargs='*', default=[], choices=['title', 'abstract', 'CPC_class', 'first_claim', 'front_img'],
+                        help="Fields a patent is accepted without when they cannot be scraped, e.g. --optional_fields front_img (they are null in its record). "
+                             "The citations are always required: the documents are sampled from them.")
+    parser.add_argument('--driver_max_pages', type=int, default=500,
+                        help='Number of pages after which the WebDriver of a process is restarted (0 to never restart).')
+    parser.add_argument('--driver_max_rss_mb', type=int, default=2048,
+                        help='Resident memory (MB) of the browser processes above which the WebDriver is restarted (0 to disable).')
 
-    # Get the list of all CPC files in the directory provided by the user.
-    # Then iterate over the CPC files (each file corresponds to a specific CPC class).
-    for CPC_file in os.listdir(args.CPC_class_dir):
-        CPC_file_path = os.path.join(args.CPC_class_dir, CPC_file)
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Shared directory (e.g. on /vast) distributing the patents between several nodes as leased work units; each node runs the script with the same work directory.')
+    parser.add_argument('--unit_size', type=int, default=200,
+                        help='Number of patents per work unit.')
+    parser.add_argument('--lease_ttl', type=int, default=DEFAULT_LEASE_TTL,
+                        help='Seconds after which the unit of a node that stopped renewing its lease is taken over by another node.')
+
+    parser.add_argument('--validation_cache', type=str, default='/vast/marco/Data_Google_Patent/validation_cache.jsonl',
+                        help='Cache of the verdicts of the patent ID pre-validation stage (empty string to disable the pre-validation).')
+    parser.add_argument('--validation_workers', type=int, default=16,
+                        help='Number of concurrent lightweight requests checking the patent IDs before scraping.')
+
+    parser.add_argument('--repair_list', type=str, default=None,
+                        help='Repair list written by validate_dataset.py: only the broken query patents it lists are scraped again.')
 
-        if CPC_file in args.CPC_to_exclude:
-            print(f'CPC: {CPC_file} already scraped.')
-            continue
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help='File where the per-stage timing metrics are exported periodically: JSON lines, or a Prometheus textfile if it ends with .prom.')
+    parser.add_argument('--metrics_interval', type=int, default=60,
+                        help='Seconds between two exports of the metrics.')
+
+    args = parser.parse_args()
+    if args.repair_list and args.work_dir:
+        parser.error('--repair_list cannot be used with --work_dir: the work units of a finished scrape are already done.')
+    try:
+        args.ledger = node_ledger_path(args.ledger, args.work_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    context_options = {'backend': args.backend, 'archive_dir': args.archive_dir, 'json_dir_output': args.json_dir_output, 'output_format': args.output_format,
+                       'driver_max_pages': args.driver_max_pages, 'driver_max_rss_mb': args.driver_max_rss_mb,
+                       'base_url': args.base_url, 'rate_limit_file': args.rate_limit_file, 'max_rate': args.max_rate, 'image_workers': args.image_workers,
+                       'optional_fields': args.optional_fields}
+
+    # Load the ledger in bulk once: skip decisions are then dictionary lookups.
+    ledger_conn, ledger = open_and_load_ledger(args.ledger, 'query', args.json_dir_output)
+    repairs = None
+    if args.repair_list:
+        # Discard the broken files and forget the ledger entries of the listed patents, then scrape only them
+        repairs = {}
+        for item in apply_repair_list(args.repair_list, 'query', ledger_conn, args.json_dir_output):
+            repairs.setdefault(item['CPC_class'], set()).add(item['patent_ID'])
+        ledger = load_ledger(ledger_conn, 'query')
+    metrics = Metrics('query', args.metrics_file, args.metrics_interval)
+    # Invalid patent IDs are ruled out with lightweight requests, paced by the rate limiter of the node
+    validator = PatentValidator(args.validation_cache, args.base_url, args.validation_workers,
+                                RateLimiter(args.rate_limit_file, max_rate=args.max_rate) if args.rate_limit_file else None) if args.validation_cache else None
+
+    # Get the list of all CPC files in the directory provided by the user.
+    CPC_files = [CPC_file for CPC_file in os.listdir(args.CPC_class_dir) if CPC_file not in args.CPC_to_exclude]
+    for CPC_file in set(os.listdir(args.CPC_class_dir)) - set(CPC_files):
+        print(f'CPC: {CPC_file} already scraped.')
+    if repairs is not None:
+        CPC_files = [CPC_file for CPC_file in CPC_files if os.path.splitext(CPC_file)[0] in repairs]
 
-        print(f'\nStarting scraping for CPC: {CPC_file}')
-        scrape_queries_from_CPC(CPC_file_path, args.front_imgs_dir_output, args.json_dir_output)
-        print(f'Completed scraping for CPC: {CPC_file}')
+    if args.work_dir:
+        # Plan the patents of the CPC files that are in no work unit yet (identical on every node, the first node to write
+        # a unit wins), then scrape the units claimed by this node
+        work_queue = WorkQueue(args.work_dir, 'query', args.lease_ttl)
+        planned = work_queue.planned_items()
+        for CPC_file in sorted(CPC_files):
+            CPC_class, patent_IDs = read_CPC_patent_IDs(os.path.join(args.CPC_class_dir, CPC_file))
+            work_queue.plan_new_items([[patent_ID, CPC_class] for patent_ID in patent_IDs], args.unit_size, CPC_class, planned)
+        scrape_query_units(work_queue, args.front_imgs_dir_output, ledger_conn, ledger, context_options, args.workers, args.max_attempts, args.store_dir, metrics, validator)
 
-            
+    elif args.workers > 1:
+        # Split every CPC file into patent-level work items processed by the worker pool.
+        items = []
+        for CPC_file in CPC_files:
+            CPC_class, patent_IDs = read_CPC_patent_IDs(os.path.join(args.CPC_class_dir, CPC_file), repairs)
+            patent_IDs = filter_valid(filter_scraped(patent_IDs, CPC_class, ledger, args.max_attempts), CPC_class, validator, ledger_conn)
+            items.extend((patent_ID, CPC_class) for patent_ID in patent_IDs)
 
+        print(f'\nStarting scraping of {len(items)} query patents with {args.workers} workers')
+        handle_item = partial(scrape_query_item, front_imgs_dir_output=args.front_imgs_dir_output, store_dir=args.store_dir)
+        for result in tqdm(run_workers(items, handle_item, args.workers, **context_options), total=len(items)):
+            metrics.record(result)
+            if 'error' in result:
+                print(f"Worker failed on {result['item']}: {result['error']}")
+            else:
+                record_result(ledger_conn, 'query', result)
+        print('Completed scraping')
 
+    else:
+        # Iterate over the CPC files (each file corresponds to a specific CPC class).
+        for CPC_file in CPC_files:
+            CPC_file_path = os.path.join(args.CPC_class_dir, CPC_file)
+            print(f'\nStarting scraping for CPC: {CPC_file}')
+            scrape_queries_from_CPC(CPC_file_path, args.front_imgs_dir_output, ledger_conn, ledger, context_options, args.max_attempts, args.store_dir, metrics, validator, repairs)
+            print(f'Completed scraping for CPC: {CPC_file}')
 
+    if validator is not None:
+        validator.close()
 
+    # Export the final metrics and print where the time went
+    metrics.close()
@@ -3,9 +3,14 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from collections import deque
+from urllib.parse import quote
 import re
 import os
+import time
 import requests
+from metrics import timed_stage
 
 # To use Firefox driver
 from selenium.webdriver.firefox.options import Options
@@ -17,18 +22,49 @@ from selenium.webdriver.firefox.service import Service
 #from webdriver_manager.chrome import ChromeDriverManager
 
 
-def setup_driver():
+# Base URL of the patent pages (overridden e.g. to benchmark against a local server).
+GOOGLE_PATENTS_URL = 'https://patents.google.com'
+# Hosts of third-party requests (analytics, ads) that the extractors never need.
+BLOCKED_HOSTS = ['google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'googlesyndication.com', 'googleadservices.com']
 
-    """Set up and return a headless Firefox WebDriver."""
+
+
+def lean_profile_preferences():
+    '''
+    Returns the Firefox preferences of the lean browser profile: no images, no downloadable fonts, no prefetching,
+    no media and no requests to the BLOCKED_HOSTS (routed by a proxy auto-config script to a closed local port).
+    The image URLs are still read from the src attributes, and stylesheets are kept because the layout of the page is needed.
+    '''
+    blocked = ' || '.join(f"dnsDomainIs(host, '{host}')" for host in BLOCKED_HOSTS)
+    pac_script = f"function FindProxyForURL(url, host) {{ if ({blocked}) return 'PROXY 127.0.0.1:9'; return 'DIRECT'; }}"
+    return {
+        'permissions.default.image': 2,  # Do not load images
+        'gfx.downloadable_fonts.enabled': False,  # Do not download web fonts
+        'browser.display.use_document_fonts': 0,
+        'network.prefetch-next': False,
+        'network.dns.disablePrefetch': True,
+        'network.http.speculative-parallel-limit': 0,
+        'media.autoplay.default': 5,  # Block all media autoplay
+        'browser.cache.disk.enable': False,  # Pages are fetched once, the disk cache only costs I/O
+        'network.proxy.type': 2,
+        'network.proxy.autoconfig_url': 'data:text/javascript,' + quote(pac_script),
+    }
+
+
+
+def setup_driver(lean=True):
+
+    """Set up and return a headless Firefox WebDriver (with the lean profile of lean_profile_preferences() if lean=True)."""
     # Initialize FirefoxOptions
     firefox_options = Options()
     firefox_path = "/usr/bin/firefox"  # Set the path to the Firefox binary
     firefox_options.binary_location = firefox_path  # Set Firefox as the binary
     firefox_options.add_argument("--headless")  # Run Firefox in headless mode
-    firefox_options.add_argument("--log-level=0")  # Suppress all logs (equivalent logging level for Firefox)
-    firefox_options.add_argument("--disable-web-security")  # Optional: might help with web security issues
-    firefox_options.add_argument("--no-sandbox")  # Not supported in Firefox, will be ignored
-    firefox_options.add_argument("--disable-dev-shm-usage")  # Not needed for Firefox
+    if lean:
+        for name, value in lean_profile_preferences().items():
+            firefox_options.set_preference(name, value)
+        # Return from driver.get() at DOMContentLoaded: the extractors wait for the rendered elements they need
+        firefox_options.page_load_strategy = 'eager'
     service = Service(executable_path="/usr/bin/geckodriver")  # Path to the GeckoDriver executable
     driver = webdriver.Firefox(service=service, options=firefox_options)
 
@@ -49,6 +85,119 @@ def setup_driver():
 
 
 
+class AdaptiveTimeout:
+    '''
+    Timeout derived from the observed durations of a wait: once enough successful waits are observed, it is the p95 of
+    the last window successful durations times a safety margin, bounded by minimum and maximum. Until then the initial
+    timeout is used. Waits that time out are counted separately, not as durations: pages that never render (404s,
+    throttling interstitials) would otherwise push the timeout up to the maximum. When more than max_timeout_rate of the
+    last window waits timed out, the timeout is raised by a single bounded step (step times the timeout of the successful
+    waits), so it never compounds.
+    '''
+    def __init__(self, initial=10, minimum=2, maximum=30, margin=1.5, window=200, min_samples=20, step=1.25, max_timeout_rate=0.05):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.margin = margin
+        self.min_samples = min_samples
+        self.step = step
+        self.max_timeout_rate = max_timeout_rate
+        self.durations = deque(maxlen=window) # Durations of the successful waits
+        self.timed_out = deque(maxlen=window) # Whether each wait timed out
+
+    def observe(self, duration):
+        ''' Records a successful wait of duration seconds. '''
+        self.durations.append(duration)
+        self.timed_out.append(False)
+
+    def observe_timeout(self):
+        ''' Records a wait that timed out. '''
+        self.timed_out.append(True)
+
+    def timeout(self):
+        if len(self.durations) < self.min_samples:
+            return self.initial
+        durations = sorted(self.durations)
+        p95 = durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+        timeout = p95 * self.margin
+        if sum(self.timed_out) > self.max_timeout_rate * len(self.timed_out):
+            timeout *= self.step
+        return min(self.maximum, max(self.minimum, timeout))
+
+
+
+# Time for the patent-result element to finish rendering after a navigation (one per process).
+PAGE_RENDER_TIMEOUT = AdaptiveTimeout()
+# Time for the full image viewer to render after a click on the image carousel.
+OVERLAY_RENDER_TIMEOUT = AdaptiveTimeout(initial=10, minimum=1)
+# Metadata of the drawings of the patent, with the URL of each full-size image.
+XPATH_FULL_IMG_META = '//li[@itemprop="images"]//meta[@itemprop="full"]'
+# The title is rendered together with the rest of patent-result: once it is there, every section of the patent is.
+XPATH_RENDERED_PAGE = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div[1]/div/h1'
+# Number of waits that timed out in this process, used to tell a timeout from a missing element in the stage outcomes.
+WAIT_STATS = {'timeouts': 0}
+
+
+
+def wait_for_element(driver, timeout, xpath, adaptive=None):
+    '''
+    Waits up to timeout seconds for the element at xpath and returns it.
+    With timeout=None the page is already rendered, so the element is looked up once without waiting:
+    a missing section is reported immediately instead of after a full timeout.
+    With an AdaptiveTimeout, its current timeout is used and the waiting time (or the timeout) is recorded in it.
+    Raises NoSuchElementException or TimeoutException when the element is not found.
+    '''
+    if adaptive is not None:
+        timeout = adaptive.timeout()
+    if timeout is None:
+        elements = driver.find_elements(By.XPATH, xpath)
+        if not elements:
+            raise NoSuchElementException(xpath)
+        return elements[0]
+
+    start_time = time.time()
+    try:
+        element = WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.XPATH, xpath)))
+    except TimeoutException:
+        WAIT_STATS['timeouts'] += 1
+        if adaptive is not None:
+            adaptive.observe_timeout()
+        raise
+    if adaptive is not None:
+        adaptive.observe(time.time() - start_time)
+    return element
+
+
+
+def wait_page_ready(driver):
+    '''
+    Waits until the patent-result element has rendered, with a timeout adapted to the render times observed so far.
+    Returns True if the page is ready, False on timeout.
+    '''
+    try:
+        wait_for_element(driver, None, XPATH_RENDERED_PAGE, adaptive=PAGE_RENDER_TIMEOUT)
+        return True
+    except (TimeoutException, NoSuchElementException):
+        return False
+
+
+
+
+def click(driver, element):
+    '''
+    Clicks an element through JavaScript: unlike a native click, it does not require the element to be visible,
+    e.g. an image thumbnail whose image is not loaded by the lean browser profile.
+    '''
+    driver.execute_script('arguments[0].click();', element)
+
+
+
+def patent_url(patent_ID, base_url=GOOGLE_PATENTS_URL):
+    ''' Returns the URL of the English page of a patent. '''
+    return f"{base_url}/patent/{patent_ID}/en?oq={patent_ID}"
+
+
+
 def get_patent_PN_from_citation_node(node_text, url):
     ''' 
     This function is used inside the get_citations() function.
@@ -79,22 +228,23 @@ def get_patent_PN_from_citation_node(node_text, url):
 
 
 
-def get_citations(driver, url):
+def get_citations(driver, url, navigate=True, ready=False):
     '''
     This function navigates to a given URL using a Selenium WebDriver, locates an HTML element containing 
     citation information using XPath, extracts the text, and then parses it to return the patent IDs of the 
     citations. 
     '''
-    # Navigate to the given URL
-    driver.get(url)  
+    # Navigate to the given URL (skipped when the page is already loaded)
+    if navigate:
+        driver.get(url)
     # Define the Xpath to point the HTML node where patent citations are listed.
     xpath_citations_title ='/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div/div/div[3]/h3[1]'
     xpath_citations = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div/div/div[3]/div[1]'
     try:
-        citations_title_node = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.XPATH, xpath_citations_title)))
+        citations_title_node = wait_for_element(driver, None if ready else 5, xpath_citations_title)
         # Ensure the section title for ""
         if re.search(r'^Patent Citations', citations_title_node.text): 
-            citations_node = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.XPATH, xpath_citations)))
+            citations_node = wait_for_element(driver, None if ready else 5, xpath_citations)
             citations = get_patent_PN_from_citation_node(citations_node.text, url)
             return citations
     except Exception as e:
@@ -103,17 +253,18 @@ def get_citations(driver, url):
 
 
 
-def get_title(driver, url):
+def get_title(driver, url, navigate=True, ready=False):
     '''
     This function navigates to a given URL using a Selenium WebDriver, locates an HTML element containing 
     the title text using XPath. If successful, the text of the title is extracted and returned.
     '''
-    # Navigate to the given URL
-    driver.get(url)  
+    # Navigate to the given URL (skipped when the page is already loaded)
+    if navigate:
+        driver.get(url)
     # Define the Xpath to point the HTML node where title text is contained.
     xpath_title = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div[1]/div/h1'
     try:
-        title_node = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.XPATH, xpath_title)))
+        title_node = wait_for_element(driver, None if ready else 5, xpath_title)
         title_text = title_node.text
         return title_text.strip() if title_text else None
     except Exception as e:
@@ -122,17 +273,18 @@ def get_title(driver, url):
 
 
 
-def get_abstract(driver, url):
+def get_abstract(driver, url, navigate=True, ready=False):
     '''
     This function navigates to a given URL using a Selenium WebDriver, locates an HTML element containing 
     the abstract text using XPath. If successful, the abstract is extracted and returned.
     '''
-    # Navigate to the given URL
-    driver.get(url)  
+    # Navigate to the given URL (skipped when the page is already loaded)
+    if navigate:
+        driver.get(url)
     # Define the Xpath to point the HTML node where title abstract is contained.
     xpath_abstract = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div/div/div[1]/div[1]/section[1]/patent-text/div/section/abstract/div'
     try:
-        abstract_node = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.XPATH, xpath_abstract)))
+        abstract_node = wait_for_element(driver, None if ready else 5, xpath_abstract)
         abstract_text = abstract_node.text
         return abstract_text.strip() if abstract_text else None
     except Exception as e:
@@ -141,17 +293,18 @@ def get_abstract(driver, url):
 
 
 
-def get_first_claim(driver, url):
+def get_first_claim(driver, url, navigate=True, ready=False):
     '''
     This function navigates to a given URL using a Selenium WebDriver, locates an HTML element containing 
     the fisrt claim text using XPath. If successful, the text of the claim is extracted and returned.
     '''
-    # Navigate to the given URL
-    driver.get(url)  
+    # Navigate to the given URL (skipped when the page is already loaded)
+    if navigate:
+        driver.get(url)
     # Define the Xpath to point the HTML node where first calim text is contained.
     xpath_fst_claim = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div/div/div[2]/div[2]/section/patent-text/div/section/div/div[1]/div'
     try:
-        fst_claim_node = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, xpath_fst_claim)))
+        fst_claim_node = wait_for_element(driver, None if ready else 10, xpath_fst_claim)
         fst_claim_text = fst_claim_node.text
         return fst_claim_text.strip() if fst_claim_text else None
     except Exception as e:
@@ -182,14 +335,15 @@ def get_CPC_classes_from_HTML_node(node_text, url):
 
 
 
-def get_CPC_classes(driver, url):
+def get_CPC_classes(driver, url, navigate=True, ready=False):
     '''
     This function navigates to a given URL and clicks on a thumbnail to open a full classification viewer.
     It then locates the expanded classification viewer using a specified XPath, extracts the text,
     and then parses it to return the CPC classes. 
     '''
-    # Navigate to the given URL
-    driver.get(url)
+    # Navigate to the given URL (skipped when the page is already loaded)
+    if navigate:
+        driver.get(url)
     
     # Define the Xpath to find the thumbnail of the classification viewer.
     thumbnail_xpath  = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div/div/div[1]/div[1]/section[3]/classification-viewer/div/div/div[1]'
@@ -199,15 +353,15 @@ def get_CPC_classes(driver, url):
     try:
         # Try to click the thumbnail
         try:
-            thumbnail = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.XPATH, thumbnail_xpath)))
-            thumbnail.click() # # Click the thumbnail to expand the classification viewer
+            thumbnail = wait_for_element(driver, None if ready else 10, thumbnail_xpath)
+            click(driver, thumbnail) # # Click the thumbnail to expand the classification viewer
         except Exception as e:
             #print(f"Could not click CPC thumbnail for: {url}")
             # Continue execution even if click fails
             pass 
 
         # try to Get CPC classes regardless of whether the click succeeded, because some patents may not have the classification viewer.
-        CPC_node = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, xpath_CPC_classes)))
+        CPC_node = wait_for_element(driver, None if ready else 10, xpath_CPC_classes)
         CPC_classes = get_CPC_classes_from_HTML_node(CPC_node.text, url)
         #print(f"Succesfully retrieved CPC class for: {url}")
         return CPC_classes
@@ -217,22 +371,30 @@ def get_CPC_classes(driver, url):
         return None
         
 
-def get_front_img_url(driver, url):
+def get_front_img_url(driver, url, navigate=True, ready=False):
     '''
-    This function navigates to a given URL and clicks on a thumbnail to open a full image viewer.
-    It then locates the full image using a specified XPath, extracts the src attribute (image URL), and returns it. 
+    This function navigates to a given URL and reads the URL of the full-size front image from the image metadata
+    of the page (the same markup used by the HTML backend), without any interaction.
+    Only if the metadata is not there, it clicks on a thumbnail to open a full image viewer,
+    locates the full image using a specified XPath, extracts the src attribute (image URL), and returns it.
     '''
-    # Navigate to the given URL
-    driver.get(url) 
+    # Navigate to the given URL (skipped when the page is already loaded)
+    if navigate:
+        driver.get(url)
+    # The full-size URL of every drawing is listed in the image metadata of the page
+    full_img_urls = driver.find_elements(By.XPATH, XPATH_FULL_IMG_META)
+    if full_img_urls and full_img_urls[0].get_attribute('content'):
+        return full_img_urls[0].get_attribute('content')
     # Define the Xpath to the thumbnail of the full image viewer.
     thumbnail_xpath  = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div/div/div[1]/div[1]/section[2]/image-carousel/div/img[1]'
     # Define the Xpath to point the HTML node of the full image viewer where the front image url is loacated.
     xpath_front_img = '/html/body/search-app/search-result/search-ui/div/div/div/div/div/result-container/patent-result/div/div[2]/div[2]/image-viewer/div/div[2]/div[1]/img'
     try:
         # Try to click the thumbnail if it exists
-        thumbnail = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.XPATH, thumbnail_xpath)))
-        thumbnail.click() # # Click to open full image viewer
-        front_img_node = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, xpath_front_img)))
+        thumbnail = wait_for_element(driver, None if ready else 10, thumbnail_xpath)
+        click(driver, thumbnail) # # Click to open full image viewer
+        # The viewer renders after the click, so it is always waited for (with the timeout adapted to its render times)
+        front_img_node = wait_for_element(driver, 10, xpath_front_img, adaptive=OVERLAY_RENDER_TIMEOUT if ready else None)
         front_img_url = front_img_node.get_attribute('src')
         if front_img_url:
             #print(f"Successfully found image URL: {front_img_url}")
@@ -246,6 +408,41 @@ def get_front_img_url(driver, url):
 
 
 
+def save_img(front_img_url, filename, save_dir, session=None, timeout=30):
+    '''
+    This function downloads the image at front_img_url and saves it in save_dir as <filename>.png.
+    It is used by download_img() and by the image downloader of the scrapers (image_downloader.py), which passes
+    its pooled session with retries. The image is written to a temporary file renamed once complete,
+    so an interrupted download never leaves a truncated PNG.
+    '''
+    tmp_filepath = None
+    try:
+        os.makedirs(save_dir, exist_ok=True)
+        filename = f'{filename}.png'
+        filepath = os.path.join(save_dir, filename)
+
+        # Download the image
+        response = (session or requests).get(front_img_url, stream=True, timeout=timeout)
+        response.raise_for_status()
+
+        # Save the image
+        tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=65536):
+                if chunk:
+                    f.write(chunk)
+        os.replace(tmp_filepath, filepath)
+        #print(f"Successfully downloaded image to: {filepath}")
+        return filepath
+
+    except Exception as e:
+        #print(f"Error downloading image from: {front_img_url} Message: {e}")
+        if tmp_filepath is not None and os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        return None
+
+
+
 def download_img(driver, url, filename, save_dir):
     '''
     This function downloads and saves the front image of a patent using its URL.
@@ -255,28 +452,78 @@ def download_img(driver, url, filename, save_dir):
     try:
         front_img_url = get_front_img_url(driver, url)
         if front_img_url:
-            os.makedirs(save_dir, exist_ok=True)
-            filename = f'{filename}.png'
-            filepath = os.path.join(save_dir, filename)
-            
-            # Download the image
-            response = requests.get(front_img_url, stream=True)
-            response.raise_for_status() 
-            
-            # Save the image
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            #print(f"Successfully downloaded image to: {filepath}")
-            return filepath
-        
+            return save_img(front_img_url, filename, save_dir)
+
     except Exception as e:
         #print(f"Error downloading image from: {url} Message: {e}")
         return None
 
 
 
+# Fields returned by extract_all(), in extraction order, with the function used to extract each of them.
+# The click-based extractors come last because they open overlays on top of the page.
+PATENT_FIELDS = {
+    'abstract': get_abstract,
+    'citations': get_citations,
+    'title': get_title,
+    'first_claim': get_first_claim,
+    'CPC_classes': get_CPC_classes,
+    'front_img_url': get_front_img_url,
+}
 
 
-    
+
+def extract_all(driver, url, fields=None, keep_html=False):
+    '''
+    This function navigates to a given URL only once and extracts every requested field from the rendered page.
+    Once the patent-result element has rendered (see wait_page_ready()), the extractors check for their section
+    without waiting, so a patent without e.g. citations or images does not wait for a timeout; if the page is not
+    ready in time, they fall back to waiting for each section.
+    It returns a dictionary with one key per field (None when the field could not be extracted) and the key
+    "missing" listing the names of the fields that failed, in extraction order.
+    With keep_html=True, the HTML of the rendered page is also returned under the key "html" (e.g. to archive it),
+    and the key "html_source" is 'rendered'.
+    The key "stages" holds the duration and outcome ('ok', 'missing' or 'timeout') of the navigation, of the wait
+    for the page to render and of every extractor (named after the extractor function, as in failed_stage()).
+    '''
+    fields = list(PATENT_FIELDS) if fields is None else [field for field in PATENT_FIELDS if field in fields]
+    result = {'url': url}
+    missing = []
+    stages = {}
+
+    # Navigate to the given URL (a single page load for all the fields)
+    start_time = time.time()
+    driver.get(url)
+    timed_stage(stages, 'navigate', start_time, 'ok')
+    start_time = time.time()
+    ready = wait_page_ready(driver)
+    timed_stage(stages, 'wait_page_ready', start_time, 'ok' if ready else 'timeout')
+    for field in fields:
+        start_time = time.time()
+        timeouts = WAIT_STATS['timeouts']
+        try:
+            value = PATENT_FIELDS[field](driver, url, navigate=False, ready=ready)
+        except Exception as e:
+            #print(f"Error extracting {field} from: {url} Message: {e}")
+            value = None
+        result[field] = value if value else None
+        if not value:
+            missing.append(field)
+        outcome = 'ok' if value else 'timeout' if WAIT_STATS['timeouts'] > timeouts else 'missing'
+        timed_stage(stages, PATENT_FIELDS[field].__name__, start_time, outcome)
+
+    result['missing'] = missing
+    result['stages'] = stages
+    if keep_html:
+        result['html'] = driver.page_source
+        result['html_source'] = 'rendered'
+    return result
+
+
+
+def failed_stage(missing):
+    '''
+    Returns the name of the extractor function responsible for the first missing field reported by extract_all(),
+    or None if nothing is missing.
+    '''
+    return PATENT_FIELDS[missing[0]].__name__ if missing else None
@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+from dataset_io import MANIFEST_DIR, class_record_files
+from scrape_ledger import open_ledger, load_ledger
+
+
+# Fields every record must have (not null), by record type.
+REQUIRED_FIELDS = {
+    'query': ['title', 'abstract', 'CPC_class', 'first_claim', 'front_img', 'citations_by_examiner', 'citations', 'all_citations'],
+    'document': ['query_ID', 'title', 'abstract', 'CPC_class', 'first_claim', 'front_img'],
+}
+# Extensions of the front images saved by the scrapers.
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Outcome of the image checks of a worker process {path: error message or None}: images shared by several records are checked once.
+_checked_images = {}
+
+
+
+def check_image(path):
+    ''' Returns None if the image exists and decodes completely, otherwise the reason why it does not. '''
+    if path not in _checked_images:
+        if not os.path.exists(path):
+            _checked_images[path] = 'missing'
+        else:
+            try:
+                with Image.open(path) as image:
+                    image.load()
+                _checked_images[path] = None
+            except Exception as e:
+                _checked_images[path] = f'undecodable: {e}'
+    return _checked_images[path]
+
+
+
+def identify_record_file(filename, CPC_class, record_type):
+    '''
+    Returns (patent_ID, query_ID) from the name of a record file: <CPC>_<patent_ID>.json for queries
+    and <CPC>_<query patent_ID>_<patent_ID>.json for documents, or (None, None) if the name does not match.
+    '''
+    name = filename.split('.json')[0]
+    if not name.startswith(f'{CPC_class}_'):
+        return None, None
+    if record_type == 'query':
+        return name[len(CPC_class) + 1:], ''
+    if '_' not in name[len(CPC_class) + 1:]:
+        return None, None
+    query_patent_ID, patent_ID = name[len(CPC_class) + 1:].split('_', 1)
+    return patent_ID, f'{CPC_class}_{query_patent_ID}'
+
+
+
+def identify_partial_line(line):
+    ''' Returns (patent_ID, query_ID) recovered from a JSON line cut by a crash (patent_ID is None if it was lost). '''
+    patent_ID = re.search(r'"patent_ID": "([^"]*)"', line)
+    query_ID = re.search(r'"query_ID": "([^"]*)"', line)
+    return (patent_ID.group(1) if patent_ID else None), (query_ID.group(1) if query_ID else '')
+
+
+
+def check_record(record, CPC_class, record_type, optional_fields=()):
+    '''
+    Returns the problems of a parsed record (a list of (problem, detail)) and the broken front image, if any.
+    The optional fields of the acceptance policy of the scrapers may be null.
+    '''
+    problems = []
+    if record.get('type') != record_type or record.get('cls') != CPC_class:
+        problems.append(('misplaced', f"type {record.get('type')} of CPC {record.get('cls')}"))
+    missing = [field for field in REQUIRED_FIELDS[record_type] if record.get(field) is None and field not in optional_fields]
+    if missing:
+        problems.append(('missing_fields', ', '.join(missing)))
+    if record_type == 'query' and not missing and record['all_citations'] != record['citations_by_examiner'] + record['citations']:
+        problems.append(('inconsistent_citations', 'all_citations != citations_by_examiner + citations'))
+    broken_img = None
+    if record.get('front_img'):
+        error = check_image(record['front_img'])
+        if error is not None:
+            problems.append(('broken_image', f"{record['front_img']} {error}"))
+            broken_img = record['front_img'] if error != 'missing' else None
+    return problems, broken_img
+
+
+
+def validate_CPC_dir(root, CPC_class, record_type, front_imgs_dir=None, optional_fields=()):
+    '''
+    Validates the records of a CPC class of a dataset (JSON files and JSON lines shards). Runs in a worker process.
+    Meant for a dataset no scraper is writing to: the last line of an open shard would be reported as truncated.
+    A record written several times in shards is validated as iter_records() reads it: only the last one written.
+    For queries, the images of front_imgs_dir/<CPC> not referenced by any record are also reported.
+
+    Returns a dictionary with the number of records, the problems found (each with the identity of the broken item,
+    when known, and the files to discard before it is fetched again), the keys (patent_ID, query_ID) of the records
+    and, for documents, the location of each record by query_ID (to check that the query exists).
+    '''
+    summary = {'CPC_class': CPC_class, 'type': record_type, 'records': 0, 'problems': [], 'keys': [], 'references': []}
+    CPC_dir = os.path.join(root, CPC_class)
+
+    def report(problem, detail, location, patent_ID=None, query_ID='', discard=()):
+        summary['problems'].append({'problem': problem, 'role': record_type, 'CPC_class': CPC_class, 'patent_ID': patent_ID,
+                                    'query_ID': query_ID, 'location': location, 'detail': detail, 'discard': [path for path in discard if path]})
+
+    def validate(record, location, is_file):
+        summary['records'] += 1
+        patent_ID = record.get('patent_ID')
+        query_ID = record.get('query_ID') or ''
+        summary['keys'].append((patent_ID, query_ID))
+        if record_type == 'document' and query_ID:
+            summary['references'].append((query_ID, patent_ID, location))
+        if record_type == 'query' and record.get('front_img'):
+            referenced_imgs.add(os.path.abspath(record['front_img']))
+        problems, broken_img = check_record(record, CPC_class, record_type, optional_fields)
+        for problem, detail in problems:
+            # A JSON file is rewritten by the scrapers, a record in a shard is superseded by the new one (see iter_records())
+            report(problem, detail, location, patent_ID, query_ID, [location if is_file else None, broken_img])
+
+    referenced_imgs = set()
+    for filename in sorted(os.listdir(CPC_dir)):
+        if filename.endswith('.json.tmp'):
+            path = os.path.join(CPC_dir, filename)
+            report('stale_tmp', 'temporary file left by an interrupted write', path, discard=[path])
+    # Last record written of each (patent_ID, query_ID), with its location
+    latest, truncated = {}, []
+    for path in class_record_files(CPC_dir):
+        if path.endswith('.json'):
+            try:
+                with open(path, 'r') as f:
+                    record = json.load(f)
+            except ValueError as e:
+                # Cut by a crash during json.dump
+                patent_ID, query_ID = identify_record_file(os.path.basename(path), CPC_class, record_type)
+                summary['records'] += 1
+                report('truncated_json', str(e), path, patent_ID, query_ID, [path])
+                continue
+            latest[(record.get('patent_ID'), record.get('query_ID') or '')] = (record, path, True)
+        else:
+            with open(path, 'r') as f:
+                for n_line, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError as e:
+                        truncated.append((identify_partial_line(line), f'line {n_line}: {e}', path))
+                        continue
+                    latest[(record.get('patent_ID'), record.get('query_ID') or '')] = (record, path, False)
+    for record, location, is_file in latest.values():
+        validate(record, location, is_file)
+    for (patent_ID, query_ID), detail, path in truncated:
+        # Cut by a crash while appending to a shard, unless the item was written again since
+        if (patent_ID, query_ID) not in latest:
+            summary['records'] += 1
+            report('truncated_line', detail, path, patent_ID, query_ID)
+
+    if front_imgs_dir is not None and os.path.isdir(os.path.join(front_imgs_dir, CPC_class)):
+        img_dir = os.path.join(front_imgs_dir, CPC_class)
+        for filename in sorted(os.listdir(img_dir)):
+            path = os.path.abspath(os.path.join(img_dir, filename))
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS and path not in referenced_imgs:
+                report('orphan_image', 'no record references this image', path)
+    return summary
+
+
+
+def repair_items(problems):
+    '''
+    Groups the problems by broken item into the repair list: one entry per item to fetch again
+    {'role', 'CPC_class', 'patent_ID', 'query_ID', 'problems', 'discard'}. Problems without an identifiable item are not repairable.
+    '''
+    items = {}
+    for problem in problems:
+        if not problem['patent_ID']:
+            continue
+        key = (problem['role'], problem['CPC_class'], problem['patent_ID'], problem['query_ID'])
+        item = items.setdefault(key, {'role': problem['role'], 'CPC_class': problem['CPC_class'], 'patent_ID': problem['patent_ID'],
+                                      'query_ID': problem['query_ID'], 'problems': [], 'discard': []})
+        if problem['problem'] not in item['problems']:
+            item['problems'].append(problem['problem'])
+        item['discard'].extend(path for path in problem['discard'] if path not in item['discard'])
+    return list(items.values())
+
+
+
+def validate_dataset(json_dir_query, json_dir_document, front_imgs_dir=None, ledger_path=None, workers=None, report_path=None, optional_fields=()):
+    '''
+    Validates the query and document datasets with a pool of processes (one task per CPC class and record type),
+    streaming each problem to the report file (JSON lines) as the tasks complete. Once every CPC class is validated,
+    checks that each document references an existing query and, when a ledger is given, that every patent the ledger
+    records as done has a record. Returns the list of problems.
+    '''
+    tasks = []
+    for root, record_type in ((json_dir_query, 'query'), (json_dir_document, 'document')):
+        if root and os.path.isdir(root):
+            tasks.extend((root, CPC_class, record_type) for CPC_class in sorted(os.listdir(root))
+                         if CPC_class != MANIFEST_DIR and os.path.isdir(os.path.join(root, CPC_class)))
+
+    problems = []
+    report = open(report_path, 'w') if report_path else None
+
+    def add_problems(new_problems):
+        problems.extend(new_problems)
+        if report is not None:
+            for problem in new_problems:
+                report.write(json.dumps(problem) + '\n')
+            report.flush()
+
+    keys = {'query': set(), 'document': set()}
+    references = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(validate_CPC_dir, root, CPC_class, record_type, front_imgs_dir if record_type == 'query' else None, optional_fields)
+                   for root, CPC_class, record_type in tasks]
+        for future in as_completed(futures):
+            summary = future.result()
+            add_problems(summary['problems'])
+            keys[summary['type']].update((patent_ID, summary['CPC_class'], query_ID) for patent_ID, query_ID in summary['keys'])
+            references.extend((summary['CPC_class'],) + reference for reference in summary['references'])
+            print(f"Records: {summary['records']}\t Problems: {len(summary['problems'])}\t CPC: {summary['CPC_class']}\t Type: {summary['type']}")
+
+    # Documents of a query without record: the query is fetched again
+    orphans = []
+    for CPC_class, query_ID, patent_ID, location in references:
+        if not query_ID.startswith(f'{CPC_class}_'):
+            continue
+        query_patent_ID = query_ID[len(CPC_class) + 1:]
+        if (query_patent_ID, CPC_class, '') not in keys['query']:
+            orphans.append({'problem': 'missing_query', 'role': 'query', 'CPC_class': CPC_class, 'patent_ID': query_patent_ID, 'query_ID': '',
+                            'location': location, 'detail': f'referenced by document {patent_ID}', 'discard': []})
+    add_problems(orphans)
+
+    # Patents recorded as done without a record (e.g. lost with the partial last line of a shard)
+    if ledger_path and os.path.exists(ledger_path):
+        conn = open_ledger(ledger_path)
+        for role in ('query', 'document'):
+            missing = [{'problem': 'missing_record', 'role': role, 'CPC_class': CPC_class, 'patent_ID': patent_ID, 'query_ID': query_ID,
+                        'location': ledger_path, 'detail': 'done in the ledger', 'discard': []}
+                       for (patent_ID, CPC_class, query_ID), entry in load_ledger(conn, role).items()
+                       if entry['status'] == 'done' and (patent_ID, CPC_class, query_ID) not in keys[role]]
+            add_problems(missing)
+        conn.close()
+
+    if report is not None:
+        report.close()
+    return problems
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Validate the scraped dataset (records, citations, front images, references between documents and queries) '
+                                                 'and write the list of broken items to fetch again.')
+
+    parser.add_argument('--json_dir_query', type=str, default='/vast/marco/Data_Google_Patent/json/query',
+                        help='Directory of the records of the query patents.')
+    parser.add_argument('--json_dir_document', type=str, default='/vast/marco/Data_Google_Patent/json/document',
+                        help='Directory of the records of the document patents.')
+    parser.add_argument('--front_imgs_dir', type=str, default='/vast/marco/Data_Google_Patent/front_imgs/query',
+                        help='Directory of the front images of the query patents, checked for images without a record.')
+    parser.add_argument('--ledger', type=str, default='/vast/marco/Data_Google_Patent/scrape_ledger.sqlite',
+                        help='SQLite ledger of the scrapers: patents recorded as done must have a record (ignored if it does not exist).')
+    parser.add_argument('--report', type=str, default='/vast/marco/Data_Google_Patent/validation_report.jsonl',
+                        help='JSON lines file where every problem found is written as soon as its CPC class is validated.')
+    parser.add_argument('--repair_list', type=str, default='/vast/marco/Data_Google_Patent/repair_list.jsonl',
+                        help='JSON lines file of the broken items, to pass to the scrapers with --repair_list.')
+    parser.add_argument('--optional_fields', type=str, nargs='*', default=[], choices=['title', 'abstract', 'CPC_class', 'first_claim', 'front_img'],
+                        help='Fields the records may have null, as in the acceptance policy (--optional_fields) of the scrapers.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes validating CPC classes in parallel.')
+
+    args = parser.parse_args()
+
+    problems = validate_dataset(args.json_dir_query, args.json_dir_document, args.front_imgs_dir, args.ledger, args.workers, args.report, args.optional_fields)
+    items = repair_items(problems)
+    with open(args.repair_list, 'w') as f:
+        for item in items:
+            f.write(json.dumps(item) + '\n')
+
+    counts = {}
+    for problem in problems:
+        counts[problem['problem']] = counts.get(problem['problem'], 0) + 1
+    for problem, count in sorted(counts.items()):
+        print(f'{problem}: {count}')
+    print(f"Found {len(problems)} problems. {sum(item['role'] == 'query' for item in items)} query and "
+          f"{sum(item['role'] == 'document' for item in items)} document patents to repair, listed in {args.repair_list}.")
@@ -0,0 +1,207 @@
+import os
+import json
+import hashlib
+import time
+import random
+import socket
+import threading
+from contextlib import contextmanager
+
+
+# Seconds after which the lease of a unit is considered abandoned (its node died) unless renewed.
+DEFAULT_LEASE_TTL = 600
+
+
+
+def _write_exclusive(path, data):
+    '''
+    Creates path with the JSON data only if it does not exist yet, atomically: the data is written to a private
+    temporary file that is then hard-linked to path (link fails if path exists), so readers never see a partial file.
+    Returns True if the file was created.
+    '''
+    tmp_path = f'{path}.{socket.gethostname()}-{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    try:
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+
+class WorkQueue:
+    '''
+    Coordinator-free distribution of work units between the nodes sharing a directory (e.g. on /vast):
+    - units/<unit_ID>.json: the items of each unit, written once by whichever node plans them first and never changed
+      (the ID of a unit is a hash of its items, see plan_new_items());
+    - leases/<unit_ID>.lease: the node working on a unit, created atomically, renewed by a heartbeat thread
+      and taken over by another node once it expires (the owner died);
+    - done/<unit_ID>: marker of a completed unit.
+    '''
+    def __init__(self, work_dir, role, lease_ttl=DEFAULT_LEASE_TTL):
+        self.root = os.path.join(work_dir, role)
+        self.lease_ttl = lease_ttl
+        self.owner = f'{socket.gethostname()}-{os.getpid()}'
+        self.incomplete = set() # Units processed by this node that must not be marked done
+        for subdir in ('units', 'leases', 'done'):
+            os.makedirs(os.path.join(self.root, subdir), exist_ok=True)
+
+    def _path(self, subdir, unit_ID, extension=''):
+        return os.path.join(self.root, subdir, f'{unit_ID}{extension}')
+
+    def plan(self, units):
+        '''
+        Writes the units {unit_ID: items} that do not exist yet. Every node computes the same deterministic partition,
+        so planning is idempotent and the first node to write a unit wins. Returns the number of units created.
+        '''
+        return sum(_write_exclusive(self._path('units', unit_ID, '.json'), items) for unit_ID, items in units.items())
+
+    def planned_items(self):
+        ''' Returns the items of every unit planned so far, as tuples. '''
+        planned = set()
+        for unit_ID in self.unit_IDs():
+            with open(self._path('units', unit_ID, '.json'), 'r') as f:
+                planned.update(map(tuple, json.load(f)))
+        return planned
+
+    def plan_new_items(self, items, unit_size, prefix, planned):
+        '''
+        Plans the items that are in no unit yet (planned, as returned by planned_items(), is updated) into new units
+        of partition_by_content(). The existing units never change, so items seen after the first planning
+        (e.g. queries scraped since) are scheduled in new units instead of shifting the boundaries of the planned ones.
+        Returns the number of units created.
+        '''
+        new_items = sorted({tuple(item) for item in items} - planned)
+        planned.update(new_items)
+        return self.plan(partition_by_content([list(item) for item in new_items], unit_size, prefix))
+
+    def unit_IDs(self):
+        return sorted(filename[:-len('.json')] for filename in os.listdir(os.path.join(self.root, 'units')) if filename.endswith('.json'))
+
+    def is_done(self, unit_ID):
+        return os.path.exists(self._path('done', unit_ID))
+
+    def progress(self):
+        ''' Returns the number of completed units and the total number of units. '''
+        unit_IDs = self.unit_IDs()
+        return sum(self.is_done(unit_ID) for unit_ID in unit_IDs), len(unit_IDs)
+
+    def _read_lease(self, unit_ID):
+        try:
+            with open(self._path('leases', unit_ID, '.lease'), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _try_lease(self, unit_ID):
+        ''' Takes the lease of a unit if it is free or expired. Returns True if this node now holds it. '''
+        lease_path = self._path('leases', unit_ID, '.lease')
+        lease = {'owner': self.owner, 'expires': time.time() + self.lease_ttl}
+        if _write_exclusive(lease_path, lease):
+            return True
+        current = self._read_lease(unit_ID)
+        if current is None or current['expires'] > time.time():
+            return False
+        # Expired lease: only the node whose rename succeeds may take it over
+        try:
+            os.rename(lease_path, f'{lease_path}.expired-{self.owner}')
+        except FileNotFoundError:
+            return False
+        os.remove(f'{lease_path}.expired-{self.owner}')
+        print(f"Taking over unit {unit_ID} from {current['owner']} (lease expired).")
+        return _write_exclusive(lease_path, lease)
+
+    def _renew(self, unit_ID):
+        ''' Extends the lease of a unit held by this node. Returns False if the lease was lost to another node. '''
+        current = self._read_lease(unit_ID)
+        if current is None or current['owner'] != self.owner:
+            return False
+        lease_path = self._path('leases', unit_ID, '.lease')
+        tmp_path = f'{lease_path}.{self.owner}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'owner': self.owner, 'expires': time.time() + self.lease_ttl}, f)
+        os.replace(tmp_path, lease_path)
+        return True
+
+    def _release(self, unit_ID):
+        current = self._read_lease(unit_ID)
+        if current is not None and current['owner'] == self.owner:
+            os.remove(self._path('leases', unit_ID, '.lease'))
+
+    def claim(self):
+        '''
+        Claims a unit that is neither done nor leased by a live node, scanning the units from a random position
+        so that nodes starting together do not contend for the same units.
+        Returns (unit_ID, items), or None if no unit can be claimed now.
+        '''
+        unit_IDs = self.unit_IDs()
+        start = random.randrange(len(unit_IDs)) if unit_IDs else 0
+        for unit_ID in unit_IDs[start:] + unit_IDs[:start]:
+            if self.is_done(unit_ID) or not self._try_lease(unit_ID):
+                continue
+            if self.is_done(unit_ID): # Completed by another node in the meantime
+                self._release(unit_ID)
+                continue
+            with open(self._path('units', unit_ID, '.json'), 'r') as f:
+                return unit_ID, json.load(f)
+        return None
+
+    def mark_incomplete(self, unit_ID):
+        ''' Releases the unit being processed without marking it done (e.g. throttled items), so it is claimed again later. '''
+        self.incomplete.add(unit_ID)
+
+    @contextmanager
+    def next_unit(self, poll_interval=30):
+        '''
+        Claims the next unit and holds its lease (renewed in the background) while the with block processes it.
+        The unit is marked done when the block exits normally, unless mark_incomplete() was called;
+        on errors its lease is released for another attempt.
+        When every remaining unit is leased by other nodes, waits for them to be completed or to expire.
+        Yields (unit_ID, items), or None once every unit is done.
+        '''
+        unit = self.claim()
+        while unit is None:
+            done, total = self.progress()
+            if done == total:
+                yield None
+                return
+            time.sleep(poll_interval)
+            unit = self.claim()
+
+        unit_ID = unit[0]
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_ttl / 3):
+                if not self._renew(unit_ID):
+                    print(f'Lease of unit {unit_ID} lost to another node.')
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield unit
+            if unit_ID in self.incomplete:
+                self.incomplete.discard(unit_ID)
+            else:
+                open(self._path('done', unit_ID), 'w').close()
+        finally:
+            stop.set()
+            thread.join()
+            self._release(unit_ID)
+
+
+
+def partition_by_content(items, unit_size, prefix):
+    '''
+    Splits a list of items into units of at most unit_size items, in order, keyed by content: {f'{prefix}-<hash of the items>': items}.
+    Nodes partitioning the same items write the same units.
+    '''
+    units = {}
+    for i in range(0, len(items), unit_size):
+        unit_items = items[i:i + unit_size]
+        units[f"{prefix}-{hashlib.sha1(json.dumps(unit_items).encode()).hexdigest()[:16]}"] = unit_items
+    return units
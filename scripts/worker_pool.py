@@ -0,0 +1,149 @@
+import queue
+from contextlib import contextmanager
+import multiprocessing as mp
+from html_scraping import ManagedDriver, setup_session
+from page_archive import PageArchiveWriter
+from dataset_io import setup_sink
+from rate_limiter import RateLimiter
+from image_downloader import ImageDownloader
+from scraping_functions import GOOGLE_PATENTS_URL
+
+
+def setup_scraping_context(backend='selenium', archive_dir=None, json_dir_output=None, output_format='json', driver_max_pages=500, driver_max_rss_mb=2048,
+                           base_url=GOOGLE_PATENTS_URL, rate_limit_file=None, max_rate=10.0, image_workers=4, optional_fields=()):
+    '''
+    Creates the long-lived scraping resources owned by one worker process (or by the main process in sequential mode):
+    a WebDriver (started on first use and recycled after driver_max_pages pages or above driver_max_rss_mb MB), for the HTML backend a pooled HTTP session,
+    a writer of the raw page archive when archive_dir is given (with the Selenium backend, a pooled HTTP session fetching
+    the served HTML of the pages for it), the output sink of the scraped records
+    and, when rate_limit_file is given, the rate limiter shared through that file by every process of the node.
+    The front images are downloaded by a pool of image_workers threads with a pooled session.
+    The patent pages are requested from base_url.
+    optional_fields is the acceptance policy of the scraped patents: the fields (e.g. 'front_img') a patent can be accepted without.
+    '''
+    return {
+        'driver': ManagedDriver(max_pages=driver_max_pages, max_rss_mb=driver_max_rss_mb),
+        'session': setup_session() if backend == 'html' else None,
+        'archive': PageArchiveWriter(archive_dir) if archive_dir else None,
+        'archive_session': setup_session() if archive_dir and backend != 'html' else None,
+        'sink': setup_sink(json_dir_output, output_format) if json_dir_output else None,
+        'limiter': RateLimiter(rate_limit_file, max_rate=max_rate) if rate_limit_file else None,
+        'images': ImageDownloader(workers=image_workers),
+        'base_url': base_url,
+        'optional_fields': list(optional_fields),
+    }
+
+
+
+def close_scraping_context(context):
+    ''' Releases the resources created by setup_scraping_context(). '''
+    # Pending downloads first: their callbacks still write to the sink
+    context['images'].close()
+    context['driver'].quit()
+    if context['session'] is not None:
+        context['session'].close()
+    if context['archive'] is not None:
+        context['archive'].close()
+    if context['archive_session'] is not None:
+        context['archive_session'].close()
+    if context['sink'] is not None:
+        context['sink'].close()
+
+
+
+@contextmanager
+def scraping_context(**context_options):
+    ''' Context manager around setup_scraping_context(): the resources (and the browser) are released on exit, even on errors. '''
+    context = setup_scraping_context(**context_options)
+    try:
+        yield context
+    finally:
+        close_scraping_context(context)
+
+
+
+def _worker_loop(task_queue, result_queue, handle_item, context_options):
+    '''
+    Main loop of a worker process: pulls work items from the shared task queue until it receives None,
+    processes each of them with handle_item(context, item) and pushes the result to the result queue.
+    handle_item may also return None and push the result later with context['emit'] (e.g. once the image of the item is downloaded).
+    '''
+    with scraping_context(**context_options) as context:
+        context['emit'] = result_queue.put
+        while True:
+            try:
+                item = task_queue.get_nowait()
+            except queue.Empty:
+                # No work queued: complete the deferred results before blocking, the next items may depend on them
+                context['images'].poll(wait_all=True)
+                item = task_queue.get()
+            if item is None:
+                break
+            try:
+                result = handle_item(context, item)
+            except Exception as e:
+                result = {'item': item, 'status': 'failed', 'stage': 'worker', 'error': str(e)}
+            if result is not None:
+                result_queue.put(result)
+
+
+
+class WorkerPool:
+    '''
+    Pool of n_workers processes, each owning its own long-lived WebDriver, that pull work items from a shared queue.
+    Items can be submitted at any time, also while iterating over results(), so that the results of some items
+    can feed new items (e.g. the documents of a scraped query).
+
+    handle_item(context, item) must be a module-level function (or a functools.partial of one)
+    so that it can be sent to the worker processes. context_options are passed to setup_scraping_context().
+    '''
+    def __init__(self, handle_item, n_workers, **context_options):
+        ctx = mp.get_context('spawn')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.pending = 0 # Items submitted whose result has not been returned yet
+        self.workers = [ctx.Process(target=_worker_loop, args=(self.task_queue, self.result_queue, handle_item, context_options)) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, item):
+        self.task_queue.put(item)
+        self.pending += 1
+
+    def results(self):
+        ''' Yields the result of each submitted item as soon as it is available, until no item is pending. '''
+        while self.pending > 0:
+            try:
+                result = self.result_queue.get(timeout=5)
+            except queue.Empty:
+                # Stop waiting if every worker died without returning the remaining results
+                if not any(worker.is_alive() for worker in self.workers):
+                    print(f"All workers exited with {self.pending} work items not processed.")
+                    return
+                continue
+            self.pending -= 1
+            yield result
+
+    def close(self):
+        ''' Stops the workers once they have processed the queued items. '''
+        for _ in self.workers:
+            self.task_queue.put(None) # One stop signal per worker
+        for worker in self.workers:
+            worker.join(timeout=60)
+            if worker.is_alive():
+                worker.terminate()
+
+
+
+def run_workers(items, handle_item, n_workers, **context_options):
+    '''
+    Processes the work items with a WorkerPool of n_workers processes.
+    Yields the result of each item as soon as it is available.
+    '''
+    pool = WorkerPool(handle_item, n_workers, **context_options)
+    try:
+        for item in items:
+            pool.submit(item)
+        yield from pool.results()
+    finally:
+        pool.close()